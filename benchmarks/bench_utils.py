@@ -0,0 +1,96 @@
+# benchmarks/bench_utils.py
+# Общие помощники нагрузочных тестов: перцентили задержек, RSS процесса сервера, запись результатов в JSON.
+import json
+import os
+import time
+
+try:
+    import psutil # Необязательно: RSS на платформах без /proc
+except ImportError:
+    psutil = None
+
+
+def latency_summary(latencies_seconds: list[float]) -> dict:
+    """Точные перцентили по всем замерам (в миллисекундах)."""
+    if not latencies_seconds:
+        return {"count": 0, "avg_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    ordered = sorted(latencies_seconds)
+    count = len(ordered)
+
+    def percentile(q: float) -> float:
+        return round(ordered[min(count - 1, int(q * count))] * 1000, 3)
+
+    return {
+        "count": count,
+        "avg_ms": round(sum(ordered) / count * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def _proc_children(pid: int) -> list[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _proc_rss_bytes(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024 # Значение в кБ
+    except OSError:
+        return None
+    return None
+
+
+def read_rss_bytes(pid: int, include_children: bool = True) -> int | None:
+    """RSS процесса (и его дочерних процессов - воркеров режима --workers). None - процесс недоступен."""
+    if os.path.exists(f"/proc/{pid}/status"):
+        pids = [pid]
+        if include_children:
+            i = 0
+            while i < len(pids): # Обход дерева процессов в ширину
+                pids.extend(_proc_children(pids[i]))
+                i += 1
+        sizes = [size for size in map(_proc_rss_bytes, pids) if size is not None]
+        return sum(sizes) if sizes else None
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + (process.children(recursive=True) if include_children else [])
+            return sum(p.memory_info().rss for p in processes)
+        except psutil.Error:
+            return None
+    return None
+
+
+def write_results(results: dict, output_path: str | None, prefix: str) -> str:
+    """Пишет результаты в JSON; без пути - <prefix>_<дата_время>.json в текущем каталоге."""
+    if not output_path:
+        output_path = f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return output_path
+
+
+def load_results(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare_value(name: str, baseline, current) -> str:
+    """Строка сравнения метрики с базовым прогоном: значение, было, изменение в %."""
+    if not isinstance(baseline, (int, float)) or not isinstance(current, (int, float)):
+        return f"  {name}: {current} (было {baseline})"
+    if baseline == 0:
+        return f"  {name}: {current} (было 0)"
+    return f"  {name}: {current} (было {baseline}, {(current - baseline) / baseline * 100:+.1f}%)"
@@ -0,0 +1,303 @@
+# benchmarks/load_generator.py
+# Нагрузочный генератор: N одновременных клиентов делают то же, что client/main_client.py -
+#   TCP: рукопожатие профиля (update_profile) с повторным использованием session_id из ответа;
+#   UDP: датаграммы location_update с заданной частотой (с session_id, как только он получен).
+# Считает пропускную способность, p50/p95/p99 задержек, долю ошибок и RSS процесса сервера
+# по времени; результаты пишет в JSON, чтобы прогоны можно было сравнивать (--compare).
+#
+# Пример (сервер запускать с --no-rate-limit, иначе ответы упрутся в лимиты частоты):
+#   python server/all_in_one_server.py --weather-provider static --no-rate-limit
+#   python benchmarks/load_generator.py --clients 100 --duration 30 --server-pid <PID сервера>
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+# Добавляем корень проекта в PYTHONPATH (для модулей из shared)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from shared.tcp_framing import FramedTcpClient, FrameProtocolError
+from shared.codec import CODEC_JSON, CODEC_MSGPACK, SUPPORTED_CODECS, decode as decode_message, encode_location
+from benchmarks.bench_utils import latency_summary, read_rss_bytes, write_results, load_results, compare_value
+
+TCP_PROTOCOLS = ("framed", "legacy")
+BASE_LATITUDE, BASE_LONGITUDE = 55.75, 37.61 # Клиенты "гуляют" вокруг центра Москвы
+
+
+class ProtocolStats:
+    """Счетчики одного клиента по одному протоколу. Пишет только поток клиента,
+    поток сэмплера лишь читает целые значения - замки не нужны."""
+    __slots__ = ("requests", "errors", "latencies", "errors_by_kind")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latencies: list[float] = []
+        self.errors_by_kind: dict[str, int] = {}
+
+    def ok(self, seconds: float):
+        self.requests += 1
+        self.latencies.append(seconds)
+
+    def error(self, kind: str):
+        self.requests += 1
+        self.errors += 1
+        self.errors_by_kind[kind] = self.errors_by_kind.get(kind, 0) + 1
+
+
+class SimulatedClient:
+    def __init__(self, index: int, args):
+        self.index = index
+        self.args = args
+        self.session_id: str | None = None
+        self.tcp = ProtocolStats()
+        self.udp = ProtocolStats()
+        self.latitude = BASE_LATITUDE + random.uniform(-0.05, 0.05)
+        self.longitude = BASE_LONGITUDE + random.uniform(-0.05, 0.05)
+        self._framed: FramedTcpClient | None = None
+        if args.tcp_protocol == "framed":
+            codecs = SUPPORTED_CODECS if args.codec == CODEC_MSGPACK else (CODEC_JSON,)
+            self._framed = FramedTcpClient(args.host, args.tcp_port, connect_timeout=args.timeout, codecs=codecs)
+
+    # ---- TCP: рукопожатие профиля ----
+
+    def handshake_payload(self) -> dict:
+        payload = {"action": "update_profile", "name": f"bench_{self.index}", "age": 20 + self.index % 50}
+        if self.session_id:
+            payload["session_id"] = self.session_id
+        return payload
+
+    def _request_legacy(self, payload: dict) -> dict:
+        """Как send_tcp_message_legacy: новое соединение на запрос, один JSON в ответ."""
+        with socket.create_connection((self.args.host, self.args.tcp_port), timeout=self.args.timeout) as s:
+            s.sendall(json.dumps(payload).encode('utf-8'))
+            response_bytes = s.recv(4096)
+        if not response_bytes:
+            raise ConnectionError("Сервер закрыл соединение без ответа")
+        return json.loads(response_bytes.decode('utf-8'))
+
+    def tcp_handshake(self):
+        payload = self.handshake_payload()
+        started_at = time.perf_counter()
+        try:
+            if self._framed is not None:
+                response = self._framed.request(payload, timeout=self.args.timeout)
+            else:
+                response = self._request_legacy(payload)
+        except (TimeoutError, socket.timeout):
+            self.tcp.error("timeout"); return
+        except FrameProtocolError:
+            self.tcp.error("protocol"); return
+        except (ConnectionError, OSError):
+            self.tcp.error("connection"); return
+        except ValueError:
+            self.tcp.error("invalid_response"); return
+        elapsed = time.perf_counter() - started_at
+        if response.get("status") != "success":
+            self.tcp.error("rate_limited" if "retry_after" in response else "server_error")
+            return
+        self.tcp.ok(elapsed)
+        if self.args.session_reuse:
+            self.session_id = response.get("session_id") or self.session_id
+
+    # ---- UDP: геолокация ----
+
+    def location_datagram(self) -> bytes:
+        self.latitude += random.uniform(-0.0005, 0.0005)
+        self.longitude += random.uniform(-0.0005, 0.0005)
+        if self.args.codec == CODEC_MSGPACK:
+            return encode_location(self.latitude, self.longitude, self.session_id)
+        payload = {"latitude": self.latitude, "longitude": self.longitude, "action": "location_update"}
+        if self.session_id:
+            payload["session_id"] = self.session_id
+        return json.dumps(payload).encode('utf-8')
+
+    def udp_location_update(self, sock: socket.socket):
+        datagram = self.location_datagram()
+        started_at = time.perf_counter()
+        try:
+            sock.sendto(datagram, (self.args.host, self.args.udp_port))
+            data_bytes, _ = sock.recvfrom(1024)
+            response = decode_message(data_bytes)
+        except socket.timeout:
+            self.udp.error("timeout"); return # Сервер молча отбрасывает датаграммы сверх лимита частоты
+        except OSError:
+            self.udp.error("connection"); return
+        except ValueError:
+            self.udp.error("invalid_response"); return
+        if "hint" not in response:
+            self.udp.error("server_error"); return
+        self.udp.ok(time.perf_counter() - started_at)
+
+    # ---- Циклы клиента ----
+
+    def run_tcp(self, start_at: float, stop_at: float):
+        run_at_rate(self.tcp_handshake, self.args.tcp_rate, start_at, stop_at)
+        if self._framed is not None:
+            self._framed.close()
+
+    def run_udp(self, start_at: float, stop_at: float):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.args.timeout)
+            run_at_rate(lambda: self.udp_location_update(sock), self.args.udp_rate, start_at, stop_at)
+
+
+def run_at_rate(operation, rate_per_second: float, start_at: float, stop_at: float):
+    """Вызывает operation с частотой rate (по расписанию, без догоняющих пачек);
+    rate <= 0 - замкнутый цикл, следующий вызов сразу после ответа."""
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+    next_at = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= stop_at:
+            return
+        if next_at > now:
+            time.sleep(min(next_at, stop_at) - now)
+            continue
+        operation()
+        next_at = max(next_at + interval, time.monotonic() - interval) # Отставание не копим
+
+
+def totals(clients: list[SimulatedClient], protocol: str) -> tuple[int, int]:
+    requests = errors = 0
+    for client in clients:
+        stats = getattr(client, protocol)
+        requests += stats.requests
+        errors += stats.errors
+    return requests, errors
+
+
+def sample_timeline(clients: list[SimulatedClient], args, started_at: float, stop_event: threading.Event, timeline: list):
+    """Раз в --sample-interval: запросы/ошибки за интервал по протоколам и RSS сервера."""
+    previous = {"tcp": (0, 0), "udp": (0, 0)}
+    previous_at = started_at
+    while not stop_event.wait(args.sample_interval):
+        now = time.monotonic()
+        point = {"t": round(now - started_at, 3)}
+        for protocol in ("tcp", "udp"):
+            requests, errors = totals(clients, protocol)
+            interval_requests = requests - previous[protocol][0]
+            point[f"{protocol}_rps"] = round(interval_requests / (now - previous_at), 1)
+            point[f"{protocol}_errors"] = errors - previous[protocol][1]
+            previous[protocol] = (requests, errors)
+        if args.server_pid:
+            point["server_rss_bytes"] = read_rss_bytes(args.server_pid)
+        previous_at = now
+        timeline.append(point)
+        print(f"[Bench] t={point['t']:.0f}s TCP {point['tcp_rps']}/s (ошибок {point['tcp_errors']}), "
+              f"UDP {point['udp_rps']}/s (ошибок {point['udp_errors']})"
+              + (f", RSS сервера {point['server_rss_bytes'] / 1048576:.1f} МБ" if point.get("server_rss_bytes") else ""))
+
+
+def protocol_report(clients: list[SimulatedClient], protocol: str, duration_seconds: float) -> dict:
+    requests, errors = totals(clients, protocol)
+    latencies = []
+    errors_by_kind: dict[str, int] = {}
+    for client in clients:
+        stats = getattr(client, protocol)
+        latencies.extend(stats.latencies)
+        for kind, count in stats.errors_by_kind.items():
+            errors_by_kind[kind] = errors_by_kind.get(kind, 0) + count
+    return {
+        "requests": requests,
+        "errors": errors,
+        "error_rate": round(errors / requests, 6) if requests else 0.0,
+        "throughput_rps": round((requests - errors) / duration_seconds, 1) if duration_seconds else 0.0,
+        "latency": latency_summary(latencies),
+        "errors_by_kind": errors_by_kind,
+    }
+
+
+def run_load(args) -> dict:
+    clients = [SimulatedClient(i, args) for i in range(args.clients)]
+    started_at = time.monotonic()
+    stop_at = started_at + args.duration
+    threads = []
+    for client in clients:
+        start_at = started_at + (args.ramp_up * client.index / args.clients if args.clients else 0) # Плавный старт
+        if args.tcp_rate >= 0:
+            threads.append(threading.Thread(target=client.run_tcp, args=(start_at, stop_at), daemon=True))
+        if args.udp_rate > 0:
+            threads.append(threading.Thread(target=client.run_udp, args=(start_at, stop_at), daemon=True))
+    timeline: list[dict] = []
+    stop_sampler = threading.Event()
+    sampler = threading.Thread(target=sample_timeline, args=(clients, args, started_at, stop_sampler, timeline), daemon=True)
+    print(f"[Bench] {args.clients} клиентов, {args.duration} с, TCP {args.tcp_protocol}/{args.codec} "
+          f"({args.tcp_rate or 'макс.'} запр./с на клиента), UDP {args.udp_rate} датаграмм/с на клиента")
+    sampler.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0.0, stop_at - time.monotonic()) + args.timeout + 1)
+    stop_sampler.set()
+    sampler.join()
+    duration_seconds = time.monotonic() - started_at
+    return {
+        "benchmark": "load_generator",
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - duration_seconds)),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "duration_seconds": round(duration_seconds, 3),
+        "tcp": protocol_report(clients, "tcp", duration_seconds),
+        "udp": protocol_report(clients, "udp", duration_seconds),
+        "sessions_established": sum(1 for client in clients if client.session_id),
+        "timeline": timeline,
+    }
+
+
+def print_report(results: dict, baseline: dict | None = None):
+    for protocol in ("tcp", "udp"):
+        report = results[protocol]
+        latency = report["latency"]
+        print(f"[Bench] {protocol.upper()}: {report['requests']} запросов, {report['throughput_rps']} успешных/с, "
+              f"ошибок {report['error_rate'] * 100:.2f}% {report['errors_by_kind'] or ''}")
+        print(f"[Bench]   задержка p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, p99 {latency['p99_ms']} мс, max {latency['max_ms']} мс")
+        if baseline and protocol in baseline:
+            base = baseline[protocol]
+            print("[Bench]   сравнение с базовым прогоном:")
+            print(compare_value("throughput_rps", base["throughput_rps"], report["throughput_rps"]))
+            print(compare_value("error_rate", base["error_rate"], report["error_rate"]))
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                print(compare_value(key, base["latency"][key], latency[key]))
+    rss_values = [point["server_rss_bytes"] for point in results["timeline"] if point.get("server_rss_bytes")]
+    if rss_values:
+        print(f"[Bench] RSS сервера: начало {rss_values[0] / 1048576:.1f} МБ, максимум {max(rss_values) / 1048576:.1f} МБ, "
+              f"конец {rss_values[-1] / 1048576:.1f} МБ")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный генератор: TCP рукопожатия профиля и UDP геолокация")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=5000)
+    parser.add_argument("--udp-port", type=int, default=5002)
+    parser.add_argument("--clients", type=int, default=50, help="Число одновременных клиентов")
+    parser.add_argument("--duration", type=float, default=30, help="Длительность прогона, секунд")
+    parser.add_argument("--ramp-up", type=float, default=2, help="Клиенты стартуют равномерно за это время, секунд")
+    parser.add_argument("--tcp-protocol", choices=TCP_PROTOCOLS, default="framed",
+                        help="framed - постоянное соединение (как send_tcp_message), legacy - соединение на запрос")
+    parser.add_argument("--codec", choices=(CODEC_JSON, CODEC_MSGPACK), default=CODEC_JSON,
+                        help="msgpack - согласовать MessagePack по TCP и слать геолокацию struct-пакетом")
+    parser.add_argument("--tcp-rate", type=float, default=1.0,
+                        help="Рукопожатий в секунду на клиента (0 - без пауз, отрицательное - TCP не нагружать)")
+    parser.add_argument("--udp-rate", type=float, default=5.0, help="Датаграмм location_update в секунду на клиента (0 - без UDP)")
+    parser.add_argument("--no-session-reuse", dest="session_reuse", action="store_false",
+                        help="Не передавать session_id: каждое рукопожатие создает новую сессию")
+    parser.add_argument("--timeout", type=float, default=5, help="Таймаут ответа, секунд")
+    parser.add_argument("--server-pid", type=int, default=None, help="PID сервера для замера RSS (вместе с воркерами)")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Интервал точек временного ряда, секунд")
+    parser.add_argument("--output", default=None, help="Файл результатов JSON (по умолчанию load_<дата_время>.json)")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    bench_results = run_load(bench_args)
+    print_report(bench_results, load_results(bench_args.compare) if bench_args.compare else None)
+    print(f"[Bench] Результаты записаны в {write_results(bench_results, bench_args.output, 'load')}")
@@ -0,0 +1,129 @@
+# benchmarks/location_history_bench.py
+# История геолокаций сессий (server/location_history.py) на 100k активных сессий.
+#
+# Заводит --sessions сессий, присылает каждой --updates геолокаций (случайное блуждание) и замеряет:
+#   - прирост RSS процесса на сессию (массивы буферов + словарь session_id -> слот + строки id)
+#     против оценки из заголовка модуля;
+#   - скорость записи точек и задержку запросов last_position / speed_mps / distance_m / track;
+#   - время очистки простаивающих сессий (expire_idle) и паузы записи из соседнего потока во время нее.
+#
+# Пример:
+#   python benchmarks/location_history_bench.py --sessions 100000 --points 32
+#   python benchmarks/location_history_bench.py --sessions 100000 --compare location_history_20260101_120000.json
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+# Добавляем корень проекта в PYTHONPATH (для модулей из server)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from server.location_history import LocationHistory
+from benchmarks.bench_utils import latency_summary, read_rss_bytes, write_results, load_results, compare_value
+
+
+def time_calls(call, session_ids: list) -> dict:
+    latencies = []
+    for session_id in session_ids:
+        started_at = time.perf_counter()
+        call(session_id)
+        latencies.append(time.perf_counter() - started_at)
+    return latency_summary(latencies)
+
+
+def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    positions = [(rng.uniform(55.55, 55.95), rng.uniform(37.35, 37.85)) for _ in range(args.sessions)] # Не в замере памяти
+    rss_before = read_rss_bytes(os.getpid(), include_children=False)
+    history = LocationHistory(args.points, max_sessions=args.sessions)
+    session_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.sessions)] # Как id сессий сервера
+
+    started_at = time.perf_counter()
+    timestamp = 1_000_000.0
+    for _ in range(args.updates):
+        timestamp += 1.0
+        for i, session_id in enumerate(session_ids):
+            latitude, longitude = positions[i]
+            positions[i] = latitude, longitude = latitude + rng.uniform(-1e-4, 1e-4), longitude + rng.uniform(-1e-4, 1e-4)
+            history.record(session_id, timestamp, latitude, longitude)
+    record_seconds = time.perf_counter() - started_at
+    del positions
+    rss_after = read_rss_bytes(os.getpid(), include_children=False)
+
+    sample = rng.sample(session_ids, min(args.queries, len(session_ids)))
+    results = {
+        "sessions": len(history), "points_per_session": args.points, "updates_per_session": args.updates,
+        "bytes_per_session": round((rss_after - rss_before) / args.sessions, 1) if rss_before and rss_after else None,
+        "array_bytes_per_session": round(history.array_bytes() / args.sessions, 1),
+        "records_per_second": round(args.updates * args.sessions / record_seconds),
+        "last_position": time_calls(history.last_position, sample),
+        "speed_mps": time_calls(history.speed_mps, sample),
+        "distance_m": time_calls(history.distance_m, sample),
+        "track": time_calls(history.track, sample),
+    }
+
+    # Очистка половины сессий, пока другой поток пишет точки оставшимся
+    for session_id in session_ids[::2]:
+        history.record(session_id, timestamp + 10.0, 55.75, 37.62)
+    writer_latencies, writer_stop = [], threading.Event()
+
+    def write_during_expire():
+        i = 0
+        while not writer_stop.is_set():
+            started_at = time.perf_counter()
+            history.record(session_ids[i % len(session_ids)], timestamp + 20.0, 55.75, 37.62) # Четные - не простаивают
+            writer_latencies.append(time.perf_counter() - started_at)
+            i += 2
+
+    writer_thread = threading.Thread(target=write_during_expire)
+    writer_thread.start()
+    started_at = time.perf_counter()
+    expired = history.expire_idle(timestamp + 5.0)
+    results["expire_idle"] = {"expired": expired, "seconds": round(time.perf_counter() - started_at, 3),
+                              "record_during_expire": latency_summary(writer_latencies)}
+    writer_stop.set()
+    writer_thread.join()
+    return results
+
+
+def print_report(results: dict, baseline: dict | None = None):
+    print(f"[History Bench] {results['sessions']} сессий по {results['points_per_session']} точек: ~{results['bytes_per_session']} байт на сессию "
+          f"(массивы {results['array_bytes_per_session']}), запись {results['records_per_second']} точек/с")
+    for query in ("last_position", "speed_mps", "distance_m", "track"):
+        print(f"[History Bench] {query}: p50 {results[query]['p50_ms']} мс, p99 {results[query]['p99_ms']} мс")
+    expire = results["expire_idle"]
+    print(f"[History Bench] expire_idle: {expire['expired']} сессий за {expire['seconds']} с; "
+          f"запись в это время p99 {expire['record_during_expire']['p99_ms']} мс, max {expire['record_during_expire']['max_ms']} мс")
+    if baseline:
+        print(compare_value("bytes_per_session", baseline.get("bytes_per_session"), results["bytes_per_session"]))
+        print(compare_value("records_per_second", baseline.get("records_per_second"), results["records_per_second"]))
+        print(compare_value("speed_mps p99_ms", baseline.get("speed_mps", {}).get("p99_ms"), results["speed_mps"]["p99_ms"]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="История геолокаций на 100k сессий")
+    parser.add_argument("--sessions", type=int, default=100_000, help="Число активных сессий")
+    parser.add_argument("--points", type=int, default=32, help="Точек в кольцевом буфере сессии")
+    parser.add_argument("--updates", type=int, default=40, help="Геолокаций на сессию (больше --points - буфер проходит по кругу)")
+    parser.add_argument("--queries", type=int, default=20_000, help="Запросов каждого вида")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Файл результатов JSON (по умолчанию location_history_<дата_время>.json)")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    bench_results = {
+        "benchmark": "location_history",
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(bench_args).items() if key not in ("output", "compare")},
+        **run_benchmark(bench_args),
+    }
+    print_report(bench_results, load_results(bench_args.compare) if bench_args.compare else None)
+    print(f"[History Bench] Результаты записаны в {write_results(bench_results, bench_args.output, 'location_history')}")
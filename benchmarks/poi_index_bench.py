@@ -0,0 +1,194 @@
+# benchmarks/poi_index_bench.py
+# Пространственный индекс точек интереса (server/poi_index.py) на миллионе POI.
+#
+# Генерирует --pois случайных точек в прямоугольнике --bbox (равномерно или, с --clusters, кучками вокруг
+# случайных центров - как POI в городах; запросы - из того же распределения), строит индекс и замеряет:
+#   - время построения и прирост RSS процесса на индекс (байт на POI);
+#   - задержку nearest() (k ближайших в радиусе) по --queries случайным запросам;
+#   - сверку с полным перебором (scan_nearest) на --verify запросах и во сколько раз индекс быстрее;
+#   - с --csv: время загрузки файла (разбор CSV + построение) и задержку запросов, пока в соседнем
+#     потоке идет перезагрузка (так поток приема UDP видит перезагрузку POI).
+#
+# Пример:
+#   python benchmarks/poi_index_bench.py --pois 1000000 --queries 20000 --csv
+#   python benchmarks/poi_index_bench.py --pois 1000000 --bbox=-60,-180,70,180 --clusters 200
+#   python benchmarks/poi_index_bench.py --pois 1000000 --compare poi_index_20260101_120000.json
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+# Добавляем корень проекта в PYTHONPATH (для модулей из server)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from server.poi_index import PoiDataset, PoiIndex
+from benchmarks.bench_utils import latency_summary, read_rss_bytes, write_results, load_results, compare_value
+
+
+def parse_bbox(value: str) -> tuple[float, float, float, float]:
+    try:
+        south, west, north, east = (float(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ожидается ЮГ,ЗАПАД,СЕВЕР,ВОСТОК, получено {value!r}")
+    if not (south < north and west < east):
+        raise argparse.ArgumentTypeError(f"Пустой прямоугольник: {value!r}")
+    return south, west, north, east
+
+
+def random_points(rng: random.Random, count: int, bbox: tuple, centers: list, sigma: float) -> tuple[array, array]:
+    south, west, north, east = bbox
+    if not centers:
+        return (array('d', [rng.uniform(south, north) for _ in range(count)]),
+                array('d', [rng.uniform(west, east) for _ in range(count)]))
+    latitudes, longitudes = array('d'), array('d')
+    for _ in range(count):
+        center_latitude, center_longitude = rng.choice(centers)
+        latitudes.append(min(north, max(south, rng.gauss(center_latitude, sigma))))
+        longitudes.append(min(east, max(west, rng.gauss(center_longitude, sigma))))
+    return latitudes, longitudes
+
+
+def time_queries(poi_index: PoiIndex, queries: list, k: int, radius_m: float) -> tuple[list[float], int]:
+    """Задержка каждого запроса и сколько POI найдено всего."""
+    latencies, found = [], 0
+    for latitude, longitude in queries:
+        started_at = time.perf_counter()
+        found += len(poi_index.nearest(latitude, longitude, k, radius_m))
+        latencies.append(time.perf_counter() - started_at)
+    return latencies, found
+
+
+def verify(poi_index: PoiIndex, queries: list, k: int, radius_m: float) -> dict:
+    """Сверка nearest() с полным перебором; расхождение - другие номера POI при различимых расстояниях."""
+    mismatches, index_seconds, scan_seconds = 0, 0.0, 0.0
+    for latitude, longitude in queries:
+        started_at = time.perf_counter()
+        by_index = poi_index.nearest(latitude, longitude, k, radius_m)
+        index_seconds += time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        by_scan = poi_index.scan_nearest(latitude, longitude, k, radius_m)
+        scan_seconds += time.perf_counter() - started_at
+        if len(by_index) != len(by_scan) or any(abs(a[0] - b[0]) > 1e-6 for a, b in zip(by_index, by_scan)):
+            mismatches += 1
+    return {"queries": len(queries), "mismatches": mismatches,
+            "scan_avg_ms": round(scan_seconds / max(1, len(queries)) * 1000, 3),
+            "speedup": round(scan_seconds / index_seconds, 1) if index_seconds else None}
+
+
+def write_poi_csv(path: str, latitudes: array, longitudes: array):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("latitude,longitude,name,hint\n")
+        for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            f.write(f"{latitude:.6f},{longitude:.6f},POI {i},\n")
+
+
+def run_reload(args, latitudes: array, longitudes: array, queries: list) -> dict:
+    """Загрузка файла POI и запросы к старому индексу, пока новый строится в соседнем потоке."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "pois.csv")
+        write_poi_csv(path, latitudes, longitudes)
+        dataset = PoiDataset(path)
+        dataset.reload()
+        first_load_seconds = dataset.last_load_seconds
+        reload_thread = threading.Thread(target=dataset.reload, kwargs={"force": True})
+        reload_thread.start()
+        latencies, query_number = [], 0
+        while reload_thread.is_alive():
+            latitude, longitude = queries[query_number % len(queries)]
+            query_number += 1
+            started_at = time.perf_counter()
+            dataset.index.nearest(latitude, longitude, args.k, args.radius)
+            latencies.append(time.perf_counter() - started_at)
+        reload_thread.join()
+        return {"file_bytes": os.path.getsize(path), "load_seconds": round(first_load_seconds, 3),
+                "reload_seconds": round(dataset.last_load_seconds, 3), "loads": dataset.loads,
+                "queries_during_reload": latency_summary(latencies)}
+
+
+def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    south, west, north, east = args.bbox
+    centers = [(rng.uniform(south, north), rng.uniform(west, east)) for _ in range(args.clusters)]
+    latitudes, longitudes = random_points(rng, args.pois, args.bbox, centers, args.cluster_sigma)
+    names, hints = [f"POI {i}" for i in range(args.pois)], [""] * args.pois
+    query_latitudes, query_longitudes = random_points(rng, args.queries, args.bbox, centers, args.cluster_sigma)
+    queries = list(zip(query_latitudes, query_longitudes))
+
+    rss_before = read_rss_bytes(os.getpid(), include_children=False)
+    started_at = time.perf_counter()
+    poi_index = PoiIndex(latitudes, longitudes, names, hints, args.cell_degrees)
+    build_seconds = time.perf_counter() - started_at
+    rss_after = read_rss_bytes(os.getpid(), include_children=False)
+
+    latencies, found = time_queries(poi_index, queries, args.k, args.radius)
+    results = {
+        "pois": len(poi_index), "cells": len(poi_index.cells), "cell_degrees": round(poi_index.cell_degrees, 6),
+        "build_seconds": round(build_seconds, 3),
+        "index_bytes_per_poi": round((rss_after - rss_before) / args.pois, 1) if rss_before and rss_after else None,
+        "query": latency_summary(latencies),
+        "queries_per_second": round(len(latencies) / sum(latencies)) if latencies else None,
+        "avg_found": round(found / max(1, len(queries)), 2),
+        "verify": verify(poi_index, queries[:args.verify], args.k, args.radius),
+    }
+    if args.csv:
+        del poi_index # Во время перезагрузки и так живут два индекса - третий не держим
+        results["reload"] = run_reload(args, latitudes, longitudes, queries)
+    return results
+
+
+def print_report(results: dict, baseline: dict | None = None):
+    query = results["query"]
+    print(f"[POI Bench] {results['pois']} POI, {results['cells']} ячеек по {results['cell_degrees']} град.: построение {results['build_seconds']} с, "
+          f"~{results['index_bytes_per_poi']} байт на POI")
+    print(f"[POI Bench] nearest(k={results['config']['k']}, {results['config']['radius']} м): p50 {query['p50_ms']} мс, p99 {query['p99_ms']} мс, "
+          f"{results['queries_per_second']} запросов/с, в среднем найдено {results['avg_found']}")
+    checked = results["verify"]
+    print(f"[POI Bench] Сверка с перебором: {checked['queries']} запросов, расхождений {checked['mismatches']}, "
+          f"перебор {checked['scan_avg_ms']} мс на запрос (индекс быстрее в {checked['speedup']} раз)")
+    if "reload" in results:
+        reload = results["reload"]
+        during = reload["queries_during_reload"]
+        print(f"[POI Bench] Файл {reload['file_bytes']} байт: загрузка {reload['load_seconds']} с, перезагрузка {reload['reload_seconds']} с; "
+              f"запросы во время перезагрузки p50 {during['p50_ms']} мс, p99 {during['p99_ms']} мс, max {during['max_ms']} мс")
+    if baseline:
+        print(compare_value("build_seconds", baseline.get("build_seconds"), results["build_seconds"]))
+        print(compare_value("query p50_ms", baseline.get("query", {}).get("p50_ms"), query["p50_ms"]))
+        print(compare_value("query p99_ms", baseline.get("query", {}).get("p99_ms"), query["p99_ms"]))
+        print(compare_value("index_bytes_per_poi", baseline.get("index_bytes_per_poi"), results["index_bytes_per_poi"]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Пространственный индекс POI на миллионе точек")
+    parser.add_argument("--pois", type=int, default=1_000_000, help="Число точек интереса")
+    parser.add_argument("--queries", type=int, default=20_000, help="Число запросов nearest()")
+    parser.add_argument("--verify", type=int, default=200, help="Сколько запросов сверить с полным перебором")
+    parser.add_argument("--k", type=int, default=3, help="Сколько ближайших POI искать")
+    parser.add_argument("--radius", type=float, default=1000.0, help="Радиус поиска, метров")
+    parser.add_argument("--bbox", type=parse_bbox, default=parse_bbox("55.55,37.35,55.95,37.85"),
+                        help="Прямоугольник точек и запросов ЮГ,ЗАПАД,СЕВЕР,ВОСТОК (по умолчанию - Москва)")
+    parser.add_argument("--clusters", type=int, default=0, help="Число кучек точек (0 - равномерно по прямоугольнику)")
+    parser.add_argument("--cluster-sigma", type=float, default=0.05, help="Разброс точек вокруг центра кучки, градусов")
+    parser.add_argument("--cell-degrees", type=float, default=None, help="Размер ячейки сетки (по умолчанию - по плотности точек)")
+    parser.add_argument("--csv", action="store_true", help="Замерить загрузку файла CSV и запросы во время перезагрузки")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Файл результатов JSON (по умолчанию poi_index_<дата_время>.json)")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    bench_results = {
+        "benchmark": "poi_index",
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: (list(value) if key == "bbox" else value) for key, value in vars(bench_args).items() if key not in ("output", "compare")},
+        **run_benchmark(bench_args),
+    }
+    print_report(bench_results, load_results(bench_args.compare) if bench_args.compare else None)
+    print(f"[POI Bench] Результаты записаны в {write_results(bench_results, bench_args.output, 'poi_index')}")
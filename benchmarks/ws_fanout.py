@@ -0,0 +1,308 @@
+# benchmarks/ws_fanout.py
+# Задержка рассылки WebSocket (broadcast_server_events) при тысячах подписчиков.
+#
+# Для каждого размера (--subscribers 1000,5000,10000) открывается K подписчиков в нескольких
+# процессах, после чего рассылка запускается тестовым хуком сервера (сообщение ws_test_broadcast,
+# сервер должен быть запущен с --ws-test-hooks) вместо случайной паузы 60-300 с.
+# Каждый подписчик записывает время получения day_event и data_update; считаются распределение
+# задержки доставки по клиентам и полное время рассылки (до последнего получившего).
+# Время - time.time() одной машины: клиенты и сервер должны работать на одном хосте.
+# С --server-pid (или --spawn-server) считается и память сервера на простаивающее соединение:
+# прирост RSS после подключения подписчиков, деленный на их число. Python редко возвращает
+# память системе, поэтому точнее всего - один размер на запуск сервера.
+#
+# Пример:
+#   python benchmarks/ws_fanout.py --spawn-server --subscribers 1000,5000,10000 --rounds 3
+#   python benchmarks/ws_fanout.py --spawn-server --subscribers 10000 --server-args="--ws-lean"
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import websockets # type: ignore
+
+# Добавляем корень проекта в PYTHONPATH (для модулей из shared)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from shared.codec import CODEC_JSON, CODEC_MSGPACK, SUPPORTED_CODECS, decode as decode_message
+from benchmarks.bench_utils import latency_summary, read_rss_bytes, write_results, load_results, compare_value
+
+try:
+    import resource # Нет на Windows
+except ImportError:
+    resource = None
+
+SERVER_SCRIPT_PATH = os.path.join(PROJECT_ROOT, "server", "all_in_one_server.py")
+MESSAGE_TYPES = ("day_event", "data_update")
+MESSAGE_TIMESTAMP_FIELDS = {"day_event": "timestamp_event", "data_update": "timestamp_update"}
+
+
+def raise_fd_limit():
+    """Поднимает мягкий лимит открытых файлов до жесткого: каждый подписчик - сокет.
+    Запущенный с --spawn-server сервер наследует поднятый лимит."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ========================
+# Процесс подписчиков
+# ========================
+async def receive_round(websocket, not_before: float, deadline: float) -> list:
+    """Ждет day_event и data_update этой рассылки; возвращает время получения каждого (None - не пришло)."""
+    received = dict.fromkeys(MESSAGE_TYPES)
+    try:
+        while None in received.values():
+            message = await asyncio.wait_for(websocket.recv(), timeout=max(0.0, deadline - time.monotonic()))
+            received_at = time.time()
+            data = decode_message(message)
+            message_type = data.get("type")
+            # Сообщения прошлых (или случайных, не запрошенных хуком) рассылок не учитываем
+            if message_type in received and data.get(MESSAGE_TIMESTAMP_FIELDS[message_type], 0) >= not_before:
+                received[message_type] = received_at
+    except (asyncio.TimeoutError, websockets.ConnectionClosed, ValueError): # type: ignore
+        pass
+    return [received[message_type] for message_type in MESSAGE_TYPES]
+
+
+async def open_subscriber(uri: str, codec: str, semaphore: asyncio.Semaphore, open_timeout: float):
+    async with semaphore: # Не открываем тысячи рукопожатий разом - очередь accept сервера переполнится
+        websocket = await websockets.connect(uri, open_timeout=open_timeout, ping_interval=None, max_queue=None) # type: ignore
+        if codec == CODEC_MSGPACK:
+            await websocket.send(json.dumps({"action": "ws_identify", "accept_codecs": list(SUPPORTED_CODECS)}))
+            await asyncio.wait_for(websocket.recv(), timeout=open_timeout) # ws_identified
+        return websocket
+
+
+async def subscriber_group(group_index: int, uri: str, count: int, args, commands, results):
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    opened = await asyncio.gather(*(open_subscriber(uri, args.codec, semaphore, args.round_timeout) for _ in range(count)),
+                                  return_exceptions=True)
+    websockets_open = [ws for ws in opened if not isinstance(ws, BaseException)]
+    results.put(("ready", group_index, len(websockets_open), len(opened) - len(websockets_open)))
+    loop = asyncio.get_running_loop()
+    while True:
+        command = await loop.run_in_executor(None, commands.get)
+        if command is None:
+            break
+        round_index, not_before = command
+        deadline = time.monotonic() + args.round_timeout
+        receivers = [asyncio.create_task(receive_round(ws, not_before, deadline)) for ws in websockets_open]
+        await asyncio.sleep(0) # Даем получателям начать ожидание
+        results.put(("armed", group_index))
+        triggered_at = None
+        if group_index == 0 and websockets_open:
+            await loop.run_in_executor(None, commands.get) # Координатор дождался готовности всех процессов
+            triggered_at = time.time()
+            # По одному производителю на тип: раунд - ровно один day_event и один data_update
+            await websockets_open[0].send(json.dumps({"action": "ws_test_broadcast", "producers": ["day_event", "weather"]}))
+        received = await asyncio.gather(*receivers)
+        results.put(("round", group_index, round_index, triggered_at, received))
+    await asyncio.gather(*(ws.close() for ws in websockets_open), return_exceptions=True)
+
+
+def run_subscriber_group(group_index: int, uri: str, count: int, args, commands, results):
+    raise_fd_limit()
+    asyncio.run(subscriber_group(group_index, uri, count, args, commands, results))
+
+
+# ========================
+# Координатор
+# ========================
+def fetch_server_fanout(metrics_url: str | None) -> tuple[float, int] | None:
+    """Сумма и число замеров all_in_one_ws_broadcast_fanout_seconds из /metrics сервера."""
+    if not metrics_url:
+        return None
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=5) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return None
+    values = {}
+    for line in text.splitlines():
+        if line.startswith("all_in_one_ws_broadcast_fanout_seconds_sum ") or line.startswith("all_in_one_ws_broadcast_fanout_seconds_count "):
+            name, value = line.split()
+            values[name.rsplit("_", 1)[1]] = float(value)
+    return (values["sum"], int(values["count"])) if len(values) == 2 else None
+
+
+def run_size(subscribers: int, args) -> dict:
+    uri = f"ws://{args.host}:{args.ws_port}"
+    groups = max(1, min(args.client_processes, subscribers))
+    context = multiprocessing.get_context("spawn" if sys.platform == "win32" else "fork")
+    results = context.Queue()
+    commands = [context.Queue() for _ in range(groups)]
+    processes = [
+        context.Process(target=run_subscriber_group, daemon=True,
+                        args=(i, uri, subscribers // groups + (1 if i < subscribers % groups else 0), args, commands[i], results))
+        for i in range(groups)
+    ]
+    rss_before_bytes = read_rss_bytes(args.server_pid) if args.server_pid else None
+    for process in processes:
+        process.start()
+
+    connected = failed = 0
+    connect_started_at = time.monotonic()
+    for _ in range(groups):
+        _, _, group_connected, group_failed = results.get()
+        connected += group_connected
+        failed += group_failed
+    connect_seconds = time.monotonic() - connect_started_at
+    print(f"[WS Bench] {subscribers} подписчиков: подключено {connected}, ошибок {failed}, за {connect_seconds:.1f} с")
+    time.sleep(args.round_pause) # Соединения простаивают: сервер дообработал рукопожатия
+    rss_connected_bytes = read_rss_bytes(args.server_pid) if args.server_pid else None
+    bytes_per_connection = (round((rss_connected_bytes - rss_before_bytes) / connected)
+                            if rss_before_bytes is not None and rss_connected_bytes is not None and connected else None)
+    if bytes_per_connection is not None:
+        print(f"[WS Bench]   память сервера на простаивающее соединение: ~{bytes_per_connection} байт")
+
+    server_fanout_before = fetch_server_fanout(args.metrics_url)
+    delivery = {message_type: [] for message_type in MESSAGE_TYPES}
+    rounds = []
+    for round_index in range(args.rounds):
+        not_before = time.time()
+        for queue in commands:
+            queue.put((round_index, not_before))
+        for _ in range(groups):
+            results.get() # armed
+        commands[0].put("trigger") # Рассылку запрашивает первый подписчик процесса 0
+        triggered_at = None
+        received = []
+        for _ in range(groups):
+            _, _, _, group_triggered_at, group_received = results.get()
+            triggered_at = group_triggered_at or triggered_at
+            received.extend(group_received)
+        round_report = {"round": round_index}
+        for i, message_type in enumerate(MESSAGE_TYPES):
+            latencies = [times[i] - triggered_at for times in received if times[i] is not None]
+            delivery[message_type].extend(latencies)
+            round_report[message_type] = {
+                "received": len(latencies),
+                "missed": len(received) - len(latencies),
+                "first_ms": round(min(latencies) * 1000, 3) if latencies else None,
+                "fanout_ms": round(max(latencies) * 1000, 3) if latencies else None, # До последнего получившего
+            }
+        rounds.append(round_report)
+        print(f"[WS Bench]   раунд {round_index + 1}: " + ", ".join(
+            f"{message_type} до последнего {round_report[message_type]['fanout_ms']} мс (не получили {round_report[message_type]['missed']})"
+            for message_type in MESSAGE_TYPES))
+        time.sleep(args.round_pause)
+    server_fanout_after = fetch_server_fanout(args.metrics_url)
+
+    rss_bytes = read_rss_bytes(args.server_pid) if args.server_pid else None
+    for queue in commands:
+        queue.put(None)
+    for process in processes:
+        process.join(timeout=30)
+        if process.is_alive():
+            process.terminate()
+
+    report = {
+        "subscribers": subscribers,
+        "connected": connected,
+        "connect_failed": failed,
+        "connect_seconds": round(connect_seconds, 3),
+        "rounds": rounds,
+        # Время от запроса рассылки до получения - по всем клиентам всех раундов
+        "delivery": {message_type: latency_summary(latencies) for message_type, latencies in delivery.items()},
+        "fanout_ms": {message_type: latency_summary([r[message_type]["fanout_ms"] / 1000 for r in rounds if r[message_type]["fanout_ms"] is not None])
+                      for message_type in MESSAGE_TYPES},
+        "server_rss_bytes": rss_bytes,
+        "server_rss_before_bytes": rss_before_bytes,
+        "server_rss_connected_bytes": rss_connected_bytes,
+        "server_bytes_per_connection": bytes_per_connection,
+    }
+    if server_fanout_before and server_fanout_after and server_fanout_after[1] > server_fanout_before[1]:
+        # Время цикла отправки на стороне сервера (гистограмма ws_broadcast_fanout), среднее по сообщениям
+        report["server_fanout_avg_ms"] = round((server_fanout_after[0] - server_fanout_before[0])
+                                               / (server_fanout_after[1] - server_fanout_before[1]) * 1000, 3)
+    return report
+
+
+def spawn_server(args) -> subprocess.Popen:
+    command = [sys.executable, SERVER_SCRIPT_PATH, "--ws-test-hooks", "--weather-provider", "static",
+               "--no-rate-limit", "--log-level", "warning"] + shlex.split(args.server_args)
+    server_process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline: # Ждем, пока WS порт начнет принимать соединения
+        try:
+            socket.create_connection((args.host, args.ws_port), timeout=1).close()
+            return server_process
+        except OSError:
+            if server_process.poll() is not None:
+                break
+            time.sleep(0.2)
+    server_process.kill()
+    raise RuntimeError(f"Сервер не начал слушать WS порт {args.ws_port}")
+
+
+def print_report(results: dict, baseline: dict | None = None):
+    baseline_sizes = {size["subscribers"]: size for size in (baseline or {}).get("sizes", [])}
+    for size in results["sizes"]:
+        fanout = size["fanout_ms"]["day_event"]
+        delivery = size["delivery"]["day_event"]
+        print(f"[WS Bench] {size['subscribers']} подписчиков: рассылка day_event p50 {fanout['p50_ms']} мс, max {fanout['max_ms']} мс; "
+              f"доставка клиенту p50 {delivery['p50_ms']} мс, p95 {delivery['p95_ms']} мс, p99 {delivery['p99_ms']} мс"
+              + (f"; на сервере в среднем {size['server_fanout_avg_ms']} мс" if "server_fanout_avg_ms" in size else "")
+              + (f"; ~{size['server_bytes_per_connection']} байт на соединение" if size.get("server_bytes_per_connection") else ""))
+        base = baseline_sizes.get(size["subscribers"])
+        if base:
+            print(compare_value("fanout p50_ms", base["fanout_ms"]["day_event"]["p50_ms"], fanout["p50_ms"]))
+            print(compare_value("delivery p99_ms", base["delivery"]["day_event"]["p99_ms"], delivery["p99_ms"]))
+            if size.get("server_bytes_per_connection"):
+                print(compare_value("bytes_per_connection", base.get("server_bytes_per_connection"), size["server_bytes_per_connection"]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Задержка рассылки WebSocket при тысячах подписчиков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ws-port", type=int, default=8765)
+    parser.add_argument("--subscribers", default="1000,5000,10000", help="Размеры через запятую")
+    parser.add_argument("--rounds", type=int, default=3, help="Рассылок на каждый размер")
+    parser.add_argument("--round-pause", type=float, default=1.0, help="Пауза между рассылками, секунд")
+    parser.add_argument("--round-timeout", type=float, default=60, help="Сколько ждать сообщения рассылки, секунд")
+    parser.add_argument("--client-processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Процессов-подписчиков (один цикл событий на 10k соединений сам становится узким местом)")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="Одновременных WS рукопожатий в процессе")
+    parser.add_argument("--codec", choices=(CODEC_JSON, CODEC_MSGPACK), default=CODEC_JSON,
+                        help="msgpack - подписчики согласуют MessagePack через ws_identify")
+    parser.add_argument("--spawn-server", action="store_true", help="Запустить сервер (с --ws-test-hooks) на время прогона")
+    parser.add_argument("--server-args", default="", help="Дополнительные флаги сервера для --spawn-server, например --server-args=\"--ws-lean\"")
+    parser.add_argument("--server-pid", type=int, default=None, help="PID сервера для замера RSS")
+    parser.add_argument("--metrics-url", default="http://127.0.0.1:9108/metrics",
+                        help="Метрики сервера: время цикла рассылки на стороне сервера (пусто - не читать)")
+    parser.add_argument("--output", default=None, help="Файл результатов JSON (по умолчанию ws_fanout_<дата_время>.json)")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    raise_fd_limit()
+    spawned_server = spawn_server(bench_args) if bench_args.spawn_server else None
+    if spawned_server is not None and not bench_args.server_pid:
+        bench_args.server_pid = spawned_server.pid
+    try:
+        bench_results = {
+            "benchmark": "ws_fanout",
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {key: value for key, value in vars(bench_args).items() if key not in ("output", "compare")},
+            "sizes": [run_size(int(size), bench_args) for size in bench_args.subscribers.split(",") if size.strip()],
+        }
+    finally:
+        if spawned_server is not None:
+            spawned_server.terminate()
+            spawned_server.wait(timeout=10)
+    print_report(bench_results, load_results(bench_args.compare) if bench_args.compare else None)
+    print(f"[WS Bench] Результаты записаны в {write_results(bench_results, bench_args.output, 'ws_fanout')}")
@@ -20,6 +20,9 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
+from shared.tcp_framing import get_framed_client, close_framed_clients, FrameProtocolError
+from shared.codec import CODEC_MSGPACK, SUPPORTED_CODECS, decode as decode_message, encode_location
+
 # ========================
 # Конфигурация и глобальные переменные
 # ========================
@@ -32,9 +35,16 @@ CLIENT_EVENT_CACHE_FILE = os.path.join(project_root, "client_event_cache.json")
 MAX_CLIENT_CACHE_SIZE = 100 # Макс. событий в кэше клиента
 CLIENT_CACHE_EXPIRY_DAYS = 7 # Дней до устаревания события в кэше
 
+TCP_USE_FRAMED_PROTOCOL = True # Постоянное соединение с фреймами (shared/tcp_framing.py); False - старый протокол "запрос-соединение"
+legacy_tcp_servers: set = set() # (ip, port) серверов, не поддерживающих фреймированный протокол
+
 ws_listener_thread: threading.Thread | None = None # Поток для WebSocket
 ws_listener_task: asyncio.Task | None = None       # Задача asyncio внутри потока
 ws_stop_event = asyncio.Event()                     # Событие для остановки WebSocket
+WS_TOPICS = ("day_event", "data_update")
+ws_subscription: dict | None = None # {"topics": [...], "regions": [...]} для subscribe при подключении; None - все события
+ws_last_seq = 0 # seq последнего полученного события рассылки - при переподключении сервер повторит пропущенное
+ws_event_epoch: str | None = None # Запуск сервера, к которому относится ws_last_seq
 
 # ========================
 # Локальный кэш событий клиента (Пункт 6 ТЗ)
@@ -239,9 +249,33 @@ def send_profile_interactive():
     except ValueError: print("Возраст должен быть числом.")
     except Exception as e: print(f"Ошибка подготовки данных профиля: {e}")
 
-def send_tcp_message(ip: str, port: int, payload_dict: dict) -> dict | None:
-    # ... (код без изменений, как в вашем файле) ...
+def handle_tcp_response(response_data: dict) -> dict:
     global current_session_id
+    print("TCP: Ответ сервера (JSON):", response_data)
+    if response_data.get("status") == "success" and "session_id" in response_data:
+        new_session_id = response_data["session_id"]
+        if current_session_id != new_session_id: current_session_id = new_session_id; print(f"TCP: Сессия установлена/обновлена. SID: {current_session_id}")
+    elif "message" in response_data: print(f"TCP: Сообщение от сервера: {response_data['message']}")
+    return response_data
+
+def send_tcp_message(ip: str, port: int, payload_dict: dict) -> dict | None:
+    """Отправляет запрос по постоянному фреймированному соединению; если сервер
+    его не поддерживает - запоминает это и использует старый протокол."""
+    if not TCP_USE_FRAMED_PROTOCOL or (ip, port) in legacy_tcp_servers:
+        return send_tcp_message_legacy(ip, port, payload_dict)
+    print(f"TCP: Запрос (постоянное соединение) -> {ip}:{port}, Payload: {payload_dict}")
+    try:
+        return handle_tcp_response(get_framed_client(ip, port).request(payload_dict, timeout=10))
+    except FrameProtocolError as e_proto:
+        print(f"TCP: Сервер {ip}:{port} не поддерживает фреймированный протокол ({e_proto}). Переход на старый протокол.")
+        legacy_tcp_servers.add((ip, port))
+        return send_tcp_message_legacy(ip, port, payload_dict)
+    except TimeoutError: print(f"TCP: Таймаут {ip}:{port}."); return None
+    except ConnectionRefusedError: print(f"TCP: Отказ в соединении с {ip}:{port}."); return None
+    except Exception as e: print(f"TCP: Общая ошибка {ip}:{port}: {e}"); return None
+
+def send_tcp_message_legacy(ip: str, port: int, payload_dict: dict) -> dict | None:
+    """Старый протокол: новое соединение на каждый запрос, один JSON в ответ."""
     print(f"TCP: Попытка -> {ip}:{port}, Payload: {payload_dict}")
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -250,12 +284,7 @@ def send_tcp_message(ip: str, port: int, payload_dict: dict) -> dict | None:
             if not response_bytes: print("TCP: Сервер закрыл соединение без ответа."); return None
             response_str = response_bytes.decode('utf-8')
             try:
-                response_data = json.loads(response_str); print("TCP: Ответ сервера (JSON):", response_data)
-                if response_data.get("status") == "success" and "session_id" in response_data:
-                    new_session_id = response_data["session_id"]
-                    if current_session_id != new_session_id: current_session_id = new_session_id; print(f"TCP: Сессия установлена/обновлена. SID: {current_session_id}")
-                elif "message" in response_data: print(f"TCP: Сообщение от сервера: {response_data['message']}")
-                return response_data
+                return handle_tcp_response(json.loads(response_str))
             except json.JSONDecodeError: print(f"TCP: Ответ не JSON: '{response_str}'"); return {"raw_response": response_str}
     except socket.timeout: print(f"TCP: Таймаут {ip}:{port}."); return None
     except ConnectionRefusedError: print(f"TCP: Отказ в соединении с {ip}:{port}."); return None
@@ -267,23 +296,46 @@ def send_tcp_message(ip: str, port: int, payload_dict: dict) -> dict | None:
 # ========================
 async def websocket_listener_logic(uri: str, ws_port_for_log: int):
     # ... (код без изменений, как в моем предыдущем полном ответе client/main_client.py) ...
-    global ws_stop_event
+    global ws_stop_event, ws_last_seq, ws_event_epoch
     ws_stop_event.clear()
     print(f"WS: Попытка подключения к {uri} (порт {ws_port_for_log})..."); add_event_to_client_cache("websocket_attempt", {"uri": uri}, "client")
     try:
         async with websockets.connect(uri, open_timeout=10, close_timeout=5, ping_interval=20, ping_timeout=15) as websocket: # type: ignore
             print(f"WS: Успешно подключено к {uri}. Ожидание событий..."); add_event_to_client_cache("websocket_connect", {"uri": uri, "status": "connected"}, "client")
-            if current_session_id: await websocket.send(json.dumps({"action": "ws_identify", "session_id": current_session_id}))
+            # Подписка до ws_identify: повтор пропущенных событий учитывает подписку
+            if ws_subscription: await websocket.send(json.dumps({"action": "subscribe", **ws_subscription}))
+            identify_payload = {"action": "ws_identify", "accept_codecs": list(SUPPORTED_CODECS), "accept_batch": True} # Сервер ответит ws_identified с выбранным кодеком
+            if current_session_id: identify_payload["session_id"] = current_session_id
+            if ws_event_epoch: identify_payload.update({"last_seq": ws_last_seq, "epoch": ws_event_epoch})
+            await websocket.send(json.dumps(identify_payload))
             while not ws_stop_event.is_set():
                 try:
                     message = await asyncio.wait_for(websocket.recv(), timeout=1.0)
                     try:
-                        data = json.loads(message); print("\nWS: << Получено событие от сервера >>")
-                        if data.get("type") == "day_event": print(f"  Событие дня: {data.get('event_name', 'N/A')}\n  Описание: {data.get('description', 'N/A')}"); add_event_to_client_cache("day_event", data, uri)
-                        elif data.get("type") == "data_update": print(f"  Обновление данных: {data.get('source', 'N/A')}\n  Содержание: {data.get('content', {})}"); add_event_to_client_cache("data_update", data, uri)
-                        else: print(f"  Неизвестный тип: {data.get('type')}\n  Данные: {data}"); add_event_to_client_cache("unknown_ws_message", data, uri)
-                        print("-" * 30)
-                    except json.JSONDecodeError: print(f"WS: Получено не JSON: {message[:200]}"); add_event_to_client_cache("invalid_ws_json", {"raw_message": message[:200]}, uri)
+                        data = decode_message(message) # Текстовый кадр - JSON, бинарный - MessagePack
+                        # Пакет событий одного окна рассылки (accept_batch) разбираем как отдельные сообщения
+                        for data in (data.get("events") or [] if data.get("type") == "batch" else [data]):
+                            if data.get("type") == "ws_identified":
+                                print(f"WS: Сервер подтвердил подписку, кодек: {data.get('codec')}, сессия привязана: {data.get('session_bound', False)}")
+                                if data.get("session_error"): print(f"WS: {data['session_error']} Отправьте профиль и переподключите WS для адресных уведомлений.")
+                                if data.get("epoch") and data["epoch"] != ws_event_epoch:
+                                    if ws_event_epoch: ws_last_seq = 0 # Сервер перезапущен: нумерация событий началась заново
+                                    ws_event_epoch = data["epoch"]
+                                continue
+                            if data.get("type") == "replay_gap": print(f"WS: Часть пропущенных событий потеряна ({data.get('reason')}): доступны с seq {data.get('oldest_seq')}."); continue
+                            if data.get("type") == "replay_complete":
+                                if data.get("replayed"): print(f"WS: Получено пропущенных событий: {data['replayed']}.")
+                                continue
+                            if isinstance(data.get("seq"), int): ws_last_seq = max(ws_last_seq, data["seq"])
+                            if data.get("type") == "weather_alert": print(f"\nWS: !!! {data.get('message')}"); add_event_to_client_cache("weather_alert", data, uri); continue
+                            if data.get("type") == "subscribed": print(f"WS: Подписки: {data.get('subscriptions')}"); continue
+                            if data.get("type") == "subscription_error": print(f"WS: Подписка отклонена: {data.get('message')}"); continue
+                            print("\nWS: << Получено событие от сервера >>")
+                            if data.get("type") == "day_event": print(f"  Событие дня: {data.get('event_name', 'N/A')}\n  Описание: {data.get('description', 'N/A')}"); add_event_to_client_cache("day_event", data, uri)
+                            elif data.get("type") == "data_update": print(f"  Обновление данных: {data.get('source', 'N/A')}\n  Содержание: {data.get('content', {})}"); add_event_to_client_cache("data_update", data, uri)
+                            else: print(f"  Неизвестный тип: {data.get('type')}\n  Данные: {data}"); add_event_to_client_cache("unknown_ws_message", data, uri)
+                            print("-" * 30)
+                    except ValueError: print(f"WS: Не удалось разобрать сообщение: {message[:200]!r}"); add_event_to_client_cache("invalid_ws_json", {"raw_message": repr(message[:200])}, uri)
                 except asyncio.TimeoutError: continue
                 except websockets.ConnectionClosedOK: print("WS: Соединение закрыто сервером (OK)."); break # type: ignore
                 except websockets.ConnectionClosedError as cc_err: print(f"WS: Соединение закрыто с ошибкой: {cc_err}"); break # type: ignore
@@ -318,6 +370,19 @@ def start_ws_listener_thread():
     ws_listener_thread = threading.Thread(target=run_loop_in_thread, daemon=True); ws_listener_thread.start()
     print("WS: Слушатель запущен в фоне. ('стоп ws' для остановки).")
 
+def set_ws_subscription_interactive():
+    global ws_subscription
+    topics_str = input(f"Типы событий через запятую ({', '.join(WS_TOPICS)}; пусто - все): ").strip()
+    regions_str = input("Регионы через запятую (пусто - все): ").strip()
+    topics = [t.strip() for t in topics_str.split(",") if t.strip()]
+    regions = [r.strip().lower() for r in regions_str.split(",") if r.strip()]
+    ws_subscription = {}
+    if topics: ws_subscription["topics"] = topics
+    if regions: ws_subscription["regions"] = regions
+    if not ws_subscription: ws_subscription = None; print("WS: Подписка на все события.")
+    else: print(f"WS: Подписка сохранена: {ws_subscription}")
+    if ws_listener_thread and ws_listener_thread.is_alive(): print("WS: Применится при переподключении ('стоп ws', затем 'слушать ws').")
+
 def stop_ws_listener_sync():
     # ... (код без изменений, как в моем предыдущем полном ответе client/main_client.py) ...
     global ws_listener_task, ws_stop_event, ws_listener_thread
@@ -346,6 +411,10 @@ def send_location_interactive():
     except ValueError: print("Ошибка: широта и долгота должны быть числами.")
     except Exception as e: print(f"Ошибка подготовки геолокации: {e}")
 
+def server_accepts_binary(config: dict) -> bool:
+    """Сервер подтвердил MessagePack при согласовании кодека по TCP (см. shared/codec.py)."""
+    return TCP_USE_FRAMED_PROTOCOL and get_framed_client(config["ip"], config["tcp_port"]).codec == CODEC_MSGPACK
+
 def send_udp_message(payload_dict: dict) -> dict | None:
     # ... (код без изменений, как в вашем файле) ...
     if not current_server_name: print("UDP: Сервер не выбран."); return None # Добавил проверку
@@ -354,9 +423,13 @@ def send_udp_message(payload_dict: dict) -> dict | None:
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
         sock.settimeout(5)
         try:
-            sock.sendto(json.dumps(payload_dict).encode('utf-8'), UDP_SERVER_ADDR)
+            if payload_dict.get("action") == "location_update" and server_accepts_binary(config):
+                datagram = encode_location(payload_dict["latitude"], payload_dict["longitude"], payload_dict.get("session_id"))
+            else:
+                datagram = json.dumps(payload_dict).encode('utf-8')
+            sock.sendto(datagram, UDP_SERVER_ADDR)
             data_bytes, server_addr_from = sock.recvfrom(1024)
-            response_data = json.loads(data_bytes.decode('utf-8')); print(f"UDP: Ответ от {server_addr_from}:", response_data)
+            response_data = decode_message(data_bytes); print(f"UDP: Ответ от {server_addr_from}:", response_data)
             return response_data
         except socket.timeout: print(f"UDP: Сервер {UDP_SERVER_ADDR} не ответил."); return None
         except ConnectionRefusedError: print(f"UDP: Отказ в соединении {UDP_SERVER_ADDR}."); return None
@@ -369,6 +442,7 @@ COMMAND_ACTIONS = {
     "отправить профиль": send_profile_interactive,
     "слушать ws": start_ws_listener_thread,
     "стоп ws": stop_ws_listener_sync,
+    "подписка ws": set_ws_subscription_interactive,
     "отправить геолокацию": send_location_interactive,
     "выбрать сервер": select_server,
     "добавить сервер": add_server_interactive,
@@ -443,4 +517,5 @@ if __name__ == "__main__":
     except Exception as e_main: print(f"Критическая ошибка в клиенте: {e_main}"); import traceback; traceback.print_exc()
     finally:
         stop_ws_listener_sync() # Гарантированная попытка остановить WS при любом выходе
+        close_framed_clients() # Закрываем постоянные TCP соединения
         print("Клиент полностью завершил работу.")
\ No newline at end of file
@@ -57,6 +57,12 @@ PUBLIC_ALPHA_VANTAGE_URL = "https://www.alphavantage.co/query"
 PUBLIC_GRAPH_HOPPER_URL = "https://graphhopper.com/api/1/route"
 PUBLIC_GRAPH_HOPPER_GEOCODE_URL = "https://graphhopper.com/api/1/geocode"
 
+# ========================
+# Связь с приватным сервером
+# ========================
+PRIVATE_SERVER_TCP_FRAMED = True # Постоянное соединение с фреймами (shared/tcp_framing.py); False - старый протокол
+PRIVATE_SERVER_TCP_TIMEOUT = 12 # Секунд на ответ приватного сервера
+
 # ========================
 # Пути
 # ========================
@@ -10,7 +10,32 @@ from .utils import translate_city_for_public_api
 from .config import (
     PUBLIC_WEATHER_API_KEY, PUBLIC_WEATHER_API_CURRENT_URL, PUBLIC_WEATHER_API_FORECAST_URL,
     PUBLIC_OWM_API_KEY, PUBLIC_OWM_AIR_POLLUTION_URL,
+    PRIVATE_SERVER_TCP_FRAMED, PRIVATE_SERVER_TCP_TIMEOUT,
 )
+from shared.tcp_framing import get_framed_client, FrameProtocolError
+
+# Серверы, не поддерживающие фреймированный протокол (переключаемся на старый)
+_legacy_protocol_servers: set = set()
+
+def _request_private_server(server_ip: str, server_tcp_port: int, payload: dict) -> dict | None:
+    """Отправляет запрос приватному серверу. По умолчанию - через постоянное
+    фреймированное соединение, иначе (или для старого сервера) - новое соединение на запрос.
+    Возвращает разобранный JSON ответа или None, если сервер закрыл соединение без ответа."""
+    if PRIVATE_SERVER_TCP_FRAMED and (server_ip, server_tcp_port) not in _legacy_protocol_servers:
+        try:
+            return get_framed_client(server_ip, server_tcp_port).request(payload, timeout=PRIVATE_SERVER_TCP_TIMEOUT)
+        except FrameProtocolError as e_proto:
+            print(f"[WeatherServ] Сервер {server_ip}:{server_tcp_port} не поддерживает фреймированный протокол ({e_proto}). Старый протокол.")
+            _legacy_protocol_servers.add((server_ip, server_tcp_port))
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(PRIVATE_SERVER_TCP_TIMEOUT)
+        s.connect((server_ip, server_tcp_port))
+        s.sendall(json.dumps(payload).encode('utf-8'))
+        response_bytes = s.recv(8192)
+        if not response_bytes:
+            return None
+        return json.loads(response_bytes.decode('utf-8'))
 
 def _get_coordinates_public_fallback(location_name_original: str) -> dict | None:
     if not PUBLIC_WEATHER_API_KEY:
@@ -198,36 +223,31 @@ def handle_get_weather_request(
             "date_offset": actual_date_offset, "session_id": current_session_id
         }
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(12)
-                s.connect((server_ip, server_tcp_port))
-                s.sendall(json.dumps(payload_to_server).encode('utf-8'))
-                response_bytes = s.recv(8192)
-                if not response_bytes:
-                    print(f"[WeatherServ<-Сервер] Нет ответа от '{server_name_log}'. Fallback.")
-                    return get_weather_and_air_quality_via_public_apis(city_to_request, actual_date_offset)
-
-                server_data_response = json.loads(response_bytes.decode('utf-8'))
-                new_sid_from_srv = server_data_response.get("session_id")
-                if new_sid_from_srv: session_id_update_callback(new_sid_from_srv)
-
-                if server_data_response.get("status") == "success" and "data" in server_data_response:
-                    print(f"[WeatherServ] Погода успешно получена от '{server_name_log}'.")
-                    server_weather_data = server_data_response["data"]
-                    server_weather_data["source_info_for_speak"] = f"приватного сервера '{server_name_log}'"
-                    server_weather_data["requested_date"] = (datetime.now() + timedelta(days=actual_date_offset)).strftime('%Y-%m-%d')
-                    if base_response_structure["error_message"] and not server_weather_data.get("error_message_server"):
-                        server_weather_data["error_message_server"] = base_response_structure["error_message"] # Переносим ошибку ограничения даты
-                    return server_weather_data
-                else:
-                    error_msg_fs = server_data_response.get("message", "неизвестная ошибка от приватного сервера")
-                    print(f"[WeatherServ] '{server_name_log}' сообщил: '{error_msg_fs}'. Fallback.")
-                    # Сохраняем ошибку от сервера для возможного озвучивания, если публичные API тоже не дадут данных
-                    base_response_structure["error_message_server"] = error_msg_fs 
-                    # Если была ошибка ограничения даты, она важнее общей ошибки сервера
-                    if base_response_structure["error_message"] and "Прогноз на запрошенную дату" in base_response_structure["error_message"]:
-                         pass # Оставляем ошибку ограничения даты
-                    return get_weather_and_air_quality_via_public_apis(city_to_request, actual_date_offset)
+            server_data_response = _request_private_server(server_ip, server_tcp_port, payload_to_server)
+            if server_data_response is None:
+                print(f"[WeatherServ<-Сервер] Нет ответа от '{server_name_log}'. Fallback.")
+                return get_weather_and_air_quality_via_public_apis(city_to_request, actual_date_offset)
+
+            new_sid_from_srv = server_data_response.get("session_id")
+            if new_sid_from_srv: session_id_update_callback(new_sid_from_srv)
+
+            if server_data_response.get("status") == "success" and "data" in server_data_response:
+                print(f"[WeatherServ] Погода успешно получена от '{server_name_log}'.")
+                server_weather_data = server_data_response["data"]
+                server_weather_data["source_info_for_speak"] = f"приватного сервера '{server_name_log}'"
+                server_weather_data["requested_date"] = (datetime.now() + timedelta(days=actual_date_offset)).strftime('%Y-%m-%d')
+                if base_response_structure["error_message"] and not server_weather_data.get("error_message_server"):
+                    server_weather_data["error_message_server"] = base_response_structure["error_message"] # Переносим ошибку ограничения даты
+                return server_weather_data
+            else:
+                error_msg_fs = server_data_response.get("message", "неизвестная ошибка от приватного сервера")
+                print(f"[WeatherServ] '{server_name_log}' сообщил: '{error_msg_fs}'. Fallback.")
+                # Сохраняем ошибку от сервера для возможного озвучивания, если публичные API тоже не дадут данных
+                base_response_structure["error_message_server"] = error_msg_fs 
+                # Если была ошибка ограничения даты, она важнее общей ошибки сервера
+                if base_response_structure["error_message"] and "Прогноз на запрошенную дату" in base_response_structure["error_message"]:
+                     pass # Оставляем ошибку ограничения даты
+                return get_weather_and_air_quality_via_public_apis(city_to_request, actual_date_offset)
 
         except (socket.timeout, ConnectionRefusedError, json.JSONDecodeError, Exception) as e:
             print(f"[WeatherServ] Ошибка с '{server_name_log}': {e}. Fallback.")
@@ -3,10 +3,42 @@ import socket
 import threading
 import asyncio
 import websockets # type: ignore
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory # type: ignore
 import json
 import random
 import time
-import uuid # Для генерации session_id
+import os
+import argparse
+import sys
+import multiprocessing
+import functools
+import zlib
+import math
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+# Добавляем корень проекта в PYTHONPATH (для модулей из shared)
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from shared.tcp_framing import FRAMED_PROTOCOL_MAGIC, FrameDecoder, FrameProtocolError, encode_frame
+from shared.codec import (CODEC_JSON, CODEC_MSGPACK, choose_codec, detect_codec, decode as decode_message,
+                          encode as encode_message, is_packed_location, decode_location)
+from server.session_store import SessionStore
+from server.session_journal import SessionJournal
+from server import weather_service
+from server.metrics import ActionMetrics, ActiveGauge, BroadcastCycleStats, Counter, LatencyHistogram, process_rss_bytes, PrometheusText, start_metrics_http_server
+from server.rate_limit import TokenBucketLimiter
+from server.async_log import server_log, LEVELS_BY_NAME, LOG_FORMATS
+from server.worker_pool import SessionHub, SharedSessionStore, reuse_port_supported
+from server.ws_subscriptions import SubscriptionIndex, SubscriptionError
+from server.event_log import EventLog
+from server.event_scheduler import EventProducer, EventScheduler
+from server.ws_outbox import ClientOutbox, OUTBOX_CONFLATED, OUTBOX_OVERFLOW
+from server.poi_index import PoiDataset
+from server.location_history import LocationHistory
 
 # ========================
 # Настройки портов
@@ -17,105 +49,677 @@ WS_HOST = '0.0.0.0'
 WS_PORT = 8765
 UDP_HOST = '0.0.0.0'
 UDP_PORT = 5002
+# SO_REUSEPORT на TCP/UDP/WS сокетах: включается в воркерах режима --workers N,
+# чтобы несколько процессов слушали одни и те же порты
+SOCKET_REUSE_PORT = False
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+WORKER_INDEX = 0 # Номер воркера в режиме --workers (0 - единственный процесс)
+# HTTP сервер метрик в формате Prometheus (GET /metrics). 0 - выключен.
+# В режиме --workers каждый воркер слушает свой порт: METRICS_PORT + номер воркера.
+METRICS_HOST = '0.0.0.0'
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# ========================
+# Режим TCP сервера: "threaded" (поток на соединение) или "asyncio" (asyncio.start_server)
+# Можно переопределить аргументом --tcp-mode или переменной окружения TCP_SERVER_MODE
+# ========================
+TCP_SERVER_MODES = ("threaded", "asyncio")
+TCP_SERVER_MODE = os.getenv("TCP_SERVER_MODE", "threaded")
+TCP_MAX_CONNECTIONS = int(os.getenv("TCP_MAX_CONNECTIONS", "1000")) # Макс. одновременно обрабатываемых соединений (asyncio)
+TCP_MAX_PENDING_CONNECTIONS = int(os.getenv("TCP_MAX_PENDING_CONNECTIONS", "2000")) # Сколько соединений может ждать свободного слота
+TCP_PENDING_WAIT_SECONDS = 5.0 # Сколько соединение ждет слот, прежде чем получить отказ "server busy"
+TCP_READ_TIMEOUT_SECONDS = float(os.getenv("TCP_READ_TIMEOUT_SECONDS", "10")) # Дедлайн на чтение запроса
+TCP_ACCEPT_BACKLOG = int(os.getenv("TCP_ACCEPT_BACKLOG", "512")) # Очередь accept в ядре
+
+# ========================
+# Режим UDP сервера: "threaded" (блокирующий recvfrom в отдельном потоке) или "asyncio"
+# (DatagramProtocol в цикле событий WebSocket, чтение пачками). Аргумент --udp-mode или UDP_SERVER_MODE
+# ========================
+UDP_SERVER_MODES = ("threaded", "asyncio")
+UDP_SERVER_MODE = os.getenv("UDP_SERVER_MODE", "threaded")
+UDP_MAX_DATAGRAM_BYTES = 1024 # Размер буфера recvfrom
+UDP_RECEIVE_BUFFER_BYTES = int(os.getenv("UDP_RECEIVE_BUFFER_BYTES", str(4 * 1024 * 1024))) # SO_RCVBUF: запас на всплески (0 - как в ОС)
+UDP_BATCH_SIZE = int(os.getenv("UDP_BATCH_SIZE", "256")) # Датаграмм за одно пробуждение цикла (asyncio)
+UDP_OFFLOAD_BATCH_SIZE = int(os.getenv("UDP_OFFLOAD_BATCH_SIZE", "128")) # Пачка от стольких - разбор в пуле потоков (0 - никогда)
+udp_protocol = None # UdpHintProtocol в режиме asyncio
+udp_parse_executor = ThreadPoolExecutor(max_workers=int(os.getenv("UDP_PARSE_WORKERS", "2")), thread_name_prefix="udp-parse")
+
+# ========================
+# Точки интереса для подсказок UDP (server/poi_index.py): CSV latitude,longitude,name[,hint].
+# Подсказка называет ближайшие POI в радиусе; без POI рядом (или без файла) - прежние общие подсказки.
+# Файл перечитывается при изменении (проверка раз в POI_RELOAD_CHECK_SECONDS) в фоновом потоке, прием UDP не ждет.
+# Аргумент --poi-file или POI_DATA_PATH (пустая строка - без POI). В режиме --workers индекс строит каждый воркер.
+# ========================
+POI_DATA_PATH = os.getenv("POI_DATA_PATH", os.path.join(PROJECT_ROOT, "server", "poi_data.csv"))
+POI_RELOAD_CHECK_SECONDS = float(os.getenv("POI_RELOAD_CHECK_SECONDS", "10"))
+POI_HINT_RADIUS_METERS = float(os.getenv("POI_HINT_RADIUS_METERS", "1000"))
+POI_HINT_COUNT = int(os.getenv("POI_HINT_COUNT", "3")) # Сколько ближайших POI назвать в подсказке
+poi_dataset: PoiDataset | None = None
+
+# ========================
+# История геолокаций сессий (server/location_history.py): последние LOCATION_HISTORY_POINTS точек на сессию
+# в кольцевых буферах, ~0.95 КБ на сессию при 32 точках (100k сессий - ~95 МБ); больше LOCATION_HISTORY_MAX_SESSIONS
+# сессий история не заводится. Пишутся только геолокации живых сессий; история сессии без геолокаций дольше
+# SESSION_TIMEOUT_SECONDS освобождается. Запрос - TCP действие "location_history".
+# Аргумент --location-history-points или LOCATION_HISTORY_POINTS (0 - выключено). В режиме --workers история -
+# у воркера, принявшего датаграммы (SO_REUSEPORT направляет датаграммы одного клиента в один воркер).
+# ========================
+LOCATION_HISTORY_POINTS = int(os.getenv("LOCATION_HISTORY_POINTS", "32"))
+LOCATION_HISTORY_MAX_SESSIONS = int(os.getenv("LOCATION_HISTORY_MAX_SESSIONS", "200000"))
+LOCATION_SPEED_WINDOW_SECONDS = 60.0 # Окно средней скорости по умолчанию
+location_history: LocationHistory | None = None
 
 # ========================
-# "База данных" активных сессий (очень упрощенная, в памяти)
-# Формат: { "session_id_1": {"user_name": "some_user", "last_seen": timestamp, "addr": address_tuple}, ... }
+# Протокол TCP: старый (один JSON - один ответ) и фреймированный (см. shared/tcp_framing.py)
+# ========================
+TCP_RECV_CHUNK_SIZE = 65536
+TCP_LEGACY_MAX_PAYLOAD_SIZE = 64 * 1024 # Старый протокол: макс. размер JSON запроса
+TCP_IDLE_TIMEOUT_SECONDS = 300 # Постоянное соединение закрывается после простоя
+TCP_MAX_INFLIGHT_PER_CONNECTION = 64 # Макс. запросов в обработке на одно постоянное соединение
+tcp_frame_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="tcp-frame") # Обработка фреймов (потоковый режим)
+
+# ========================
+# Ограничение частоты (token bucket по IP и по session_id, см. server/rate_limit.py)
+# RATE - в секунду (0 - без ограничения), BURST - запас на короткие всплески.
+# В режиме --workers лимиты считаются в каждом воркере отдельно.
+# ========================
+TCP_CONNECTION_RATE_PER_IP = float(os.getenv("TCP_CONNECTION_RATE_PER_IP", "20")) # Новые соединения; сверх лимита закрываются без ответа
+TCP_CONNECTION_BURST_PER_IP = 50
+TCP_REQUEST_RATE_PER_IP = float(os.getenv("TCP_REQUEST_RATE_PER_IP", "100")) # Запросы (фреймы и запросы старого протокола)
+TCP_REQUEST_BURST_PER_IP = 200
+TCP_REQUEST_RATE_PER_SESSION = float(os.getenv("TCP_REQUEST_RATE_PER_SESSION", "20"))
+TCP_REQUEST_BURST_PER_SESSION = 40
+UDP_RATE_PER_IP = float(os.getenv("UDP_RATE_PER_IP", "50")) # Датаграммы сверх лимита отбрасываются без ответа
+UDP_BURST_PER_IP = 100
+UDP_RATE_PER_SESSION = float(os.getenv("UDP_RATE_PER_SESSION", "10"))
+UDP_BURST_PER_SESSION = 20
+
+def create_rate_limiters() -> dict[str, TokenBucketLimiter]:
+    return {
+        "tcp_connection_ip": TokenBucketLimiter(TCP_CONNECTION_RATE_PER_IP, TCP_CONNECTION_BURST_PER_IP),
+        "tcp_request_ip": TokenBucketLimiter(TCP_REQUEST_RATE_PER_IP, TCP_REQUEST_BURST_PER_IP),
+        "tcp_request_session": TokenBucketLimiter(TCP_REQUEST_RATE_PER_SESSION, TCP_REQUEST_BURST_PER_SESSION),
+        "udp_ip": TokenBucketLimiter(UDP_RATE_PER_IP, UDP_BURST_PER_IP),
+        "udp_session": TokenBucketLimiter(UDP_RATE_PER_SESSION, UDP_BURST_PER_SESSION),
+    }
+
+rate_limiters = create_rate_limiters() # Пересоздаются в __main__, если лимиты изменены аргументами
+
+# ========================
+# "База данных" активных сессий (в памяти, потокобезопасная - см. server/session_store.py)
+# Формат записи: {"user_name": "some_user", "last_seen": timestamp, "addr": address_tuple, "tcp_connection_time": timestamp}
 # ========================
-active_sessions = {}
 SESSION_TIMEOUT_SECONDS = 30 * 60 # 30 минут жизни сессии без активности
+MAX_SESSION_ID_LENGTH = 64 # Свои id - uuid4 (36 символов); session_id клиента длиннее или не строкой не принимается
+SESSION_CLEANUP_INTERVAL_SECONDS = 5 # Очистка снимает только истекшие записи, поэтому ее можно запускать часто
+active_sessions = SessionStore(SESSION_TIMEOUT_SECONDS)
+# В режиме --workers промах кэша сессий воркера - синхронный запрос к хабу главного процесса
+# (server/worker_pool.py), поэтому в цикле событий (asyncio TCP, ws_identify, пачки UDP) сессии трогаются из пула потоков
+SESSION_CALLS_BLOCK = False
+# Каталог журнала сессий (снапшот + append-only лог). None - сессии только в памяти.
+SESSION_STORE_DIR = os.getenv("SESSION_STORE_DIR")
+session_journal: SessionJournal | None = None
+
+# ========================
+# Лог горячих путей (server/async_log.py): запись в очередь, вывод фоновым потоком.
+# Переполнение очереди не тормозит запросы - записи отбрасываются (счетчик в /metrics).
+# ========================
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info") # debug - в том числе полные payload каждого запроса
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text") # text - как прежде "[TCP] ...", json - строка JSON на запись
+LOG_QUEUE_SIZE = 10_000
+# Частые события пишем не все: событие -> каждое N-е сообщение
+LOG_SAMPLE_EVERY = {"tcp.session_confirmed": 100, "tcp.payload": 100, "tcp.busy": 100, "udp.location": 100}
+
+# ========================
+# Метрики горячих путей (server/metrics.py): счетчики без замков, читаются при запросе /metrics
+# ========================
+tcp_accepted_connections = Counter()
+tcp_active_handlers = ActiveGauge() # Обрабатываемые сейчас TCP соединения (оба режима)
+udp_received_datagrams = Counter()
+udp_offloaded_batches = Counter()
+ws_broadcast_fanout = LatencyHistogram() # Рассылка одного сообщения всем WS клиентам; пишет только цикл событий
 
 # ========================
-# Локальный кэш событий (для WebSocket)
+# Рассылка событий WebSocket (broadcast_server_events)
 # ========================
-server_event_cache = [] # Хранит последние N событий, генерируемых сервером
-MAX_SERVER_CACHE_SIZE = 20
+# Производители событий: имя -> (период, разброс), секунд; каждый срабатывает по своему расписанию.
+# "Данные меняются каждые 1-5 минут". Переопределяются флагом --ws-producer ИМЯ=ПЕРИОД[:РАЗБРОС]
+WS_EVENT_PRODUCERS = {
+    "day_event": (180.0, 120.0),
+    "weather": (120.0, 60.0),
+    "economy": (300.0, 120.0),
+    "monsters": (240.0, 120.0),
+}
+WS_TOPICS = ("day_event", "data_update") # Типы событий, на которые можно подписаться (server/ws_subscriptions.py)
+SERVERS_CONFIG_PATH = os.path.join(PROJECT_ROOT, "servers_config.json")
+
+def load_server_regions(config_path: str) -> tuple[str, ...]:
+    """Регионы событий - списки "regions" всех серверов из servers_config.json (тот же файл читает клиент)."""
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            servers_config = json.load(f)
+    except (OSError, ValueError):
+        return ()
+    regions = []
+    for server_config in servers_config.values() if isinstance(servers_config, dict) else ():
+        for region in server_config.get("regions", []) if isinstance(server_config, dict) else ():
+            region = str(region).strip().lower()
+            if region not in regions:
+                regions.append(region)
+    return tuple(regions)
+
+SERVER_REGIONS = load_server_regions(SERVERS_CONFIG_PATH)
+# Рассылка пишет сообщение всем клиентам сразу, не дожидаясь отправки (websockets.broadcast).
+# Клиент, у которого через дедлайн после рассылки буфер отправки выше верхней отметки транспорта или
+# не уменьшился (не читает сокет), отключается - его буфер не растет бесконечно. Медленный, но читающий клиент остается
+WS_SEND_DEADLINE_SECONDS = float(os.getenv("WS_SEND_DEADLINE_SECONDS", "2"))
+ws_evicted_clients = Counter()
+# Очереди отправки клиентов (--ws-outbox, server/ws_outbox.py) вместо дедлайна: отстающему клиенту
+# кадры ставятся в его очередь, которую разбирает своя задача-писатель; data_update с той же темой
+# и регионом сливаются (остается последнее значение), day_event и пакеты хранятся до WS_OUTBOX_MAX_KEPT,
+# после чего клиент отключается. Быстрые клиенты получают кадр сразу, очередь им не создается.
+WS_CLIENT_OUTBOX = os.getenv("WS_CLIENT_OUTBOX") == "1"
+WS_OUTBOX_MAX_KEPT = int(os.getenv("WS_OUTBOX_MAX_KEPT", "100"))
+WS_OUTBOX_DIRECT_WRITE_BYTES = 32 * 1024 # Буфер отправки не больше этого - пишем напрямую, без очереди
+ws_outboxes: dict = {} # websocket -> ClientOutbox (только у отстающих клиентов)
+ws_conflated_messages = Counter()
+ws_outbox_overflows = Counter()
+# Пакетный режим (выключен при 0): события, опубликованные за окно, уходят клиенту одним кадром
+# {"type": "batch", "events": [...]} - если клиент прислал в ws_identify "accept_batch": true;
+# остальным клиентам - по кадру на событие, как раньше
+WS_BATCH_WINDOW_SECONDS = float(os.getenv("WS_BATCH_WINDOW_SECONDS", "0"))
+ws_batch_clients: set = set() # Соединения, согласившиеся на пакеты
+ws_pending_batch: list = [] # События, ждущие отправки в текущем окне
+ws_batch_flush_handle: asyncio.TimerHandle | None = None # Отправка текущего окна (ws_flush_batch)
+# permessage-deflate: deflate - настройки websockets по умолчанию (контекст сжатия на соединение),
+# deflate-no-context - каждое сообщение сжимается отдельно (меньше памяти на соединение, хуже сжатие), none - без сжатия
+WS_COMPRESSION_MODES = ("deflate", "deflate-no-context", "none")
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "deflate") # В экономном режиме (--ws-lean) по умолчанию none
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", "12")) # 9..15: меньше - меньше памяти, хуже сжатие
+# Оценка сжатого размера в статистике цикла: zlib прогоняется на одном кадре из N, остальные - по коэффициенту выборки
+WS_DEFLATE_SAMPLE_EVERY = max(1, int(os.getenv("WS_DEFLATE_SAMPLE_EVERY", "50")))
+ws_deflate_frames = 0 # Кадров, прошедших через оценку (только цикл событий WS)
+ws_deflate_ratio: float | None = None # Скользящее среднее "сжатый / исходный размер" по выборке
+ws_cycle_stats = BroadcastCycleStats() # Кадры и байты на клиента за цикл рассылки
+# Экономный режим соединений (--ws-lean) для 10k+ простаивающих подписчиков. Клиент шлет лишь короткие
+# ws_identify/subscribe, поэтому входящие сообщения ограничены WS_LEAN_MAX_MESSAGE_BYTES (больше - закрытие 1009),
+# а очередь входящих - WS_LEAN_MAX_QUEUE кадрами (дальше websockets перестает читать сокет).
+# Бюджет памяти соединения = худший случай очереди входящих + буфер отправки: соединение, у которого
+# буфер отправки вышел за остаток бюджета, отключается сразу, не дожидаясь дедлайна отправки.
+# permessage-deflate держит на соединение десятки КБ контекстов zlib, поэтому по умолчанию в этом режиме выключен.
+WS_LEAN_CONNECTIONS = os.getenv("WS_LEAN_CONNECTIONS") == "1"
+WS_LEAN_MAX_MESSAGE_BYTES = int(os.getenv("WS_LEAN_MAX_MESSAGE_BYTES", "4096"))
+WS_LEAN_MAX_QUEUE = int(os.getenv("WS_LEAN_MAX_QUEUE", "4"))
+WS_CONNECTION_MEMORY_BUDGET_BYTES = int(os.getenv("WS_CONNECTION_MEMORY_BUDGET_BYTES", "65536"))
+ws_baseline_rss_bytes: int | None = None # RSS до приема WS соединений - база оценки памяти на соединение
+# Тестовый хук для нагрузочных тестов (benchmarks/ws_fanout.py): при --ws-test-hooks сообщение
+# {"action": "ws_test_broadcast", "producers": [...]} от WS клиента запускает производителей
+# (по умолчанию всех) сразу, не дожидаясь расписания
+WS_TEST_HOOKS = os.getenv("WS_TEST_HOOKS") == "1"
+ws_scheduler: EventScheduler | None = None # Создается в цикле событий в broadcast_server_events
+
+# ========================
+# Локальный кэш событий (для WebSocket): кольцевой буфер для повтора пропущенного при переподключении.
+# Каждое событие рассылки получает "seq" (подряд с 1). Клиент присылает в ws_identify "last_seq"
+# и "epoch" и получает пропущенные события до возобновления живого потока (ws_replay_events).
+# Новое соединение не получает рассылку, пока не догонит ее из буфера (ws_catch_up): так повторенные
+# события всегда приходят раньше живых. Догоняет ws_identify, а клиента без ws_identify - таймер
+# через WS_REPLAY_HOLD_SECONDS после подключения (события за это время он получит с задержкой, но все).
+# ========================
+MAX_SERVER_CACHE_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "1000"))
+WS_REPLAY_HOLD_SECONDS = float(os.getenv("WS_REPLAY_HOLD_SECONDS", "1"))
+server_event_cache: deque = deque(maxlen=MAX_SERVER_CACHE_SIZE) # События рассылки (с "seq") по возрастанию seq
+ws_last_event_seq = 0 # seq последнего разосланного события
+ws_event_epoch = "" # Меняется при каждом запуске WS сервера: seq другого запуска (или воркера) несравнимы
+
+# ========================
+# Долговременный журнал событий рассылки (server/event_log.py): сегменты на диске, переживают перезапуск.
+# С журналом нумерация seq и epoch продолжаются между запусками, буфер повтора прогревается из журнала,
+# а WS клиенты могут запрашивать историю: {"action": "event_history", "type", "from_ts", "to_ts", "limit", "after_seq"}.
+# В режиме --workers у каждого воркера свой подкаталог worker-N (своя нумерация seq).
+# ========================
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR")
+EVENT_LOG_SEGMENT_BYTES = int(os.getenv("EVENT_LOG_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+EVENT_LOG_RETENTION_SECONDS = float(os.getenv("EVENT_LOG_RETENTION_SECONDS", str(7 * 24 * 3600)))
+EVENT_LOG_MAX_BYTES = int(os.getenv("EVENT_LOG_MAX_BYTES", str(1024 * 1024 * 1024)))
+WS_HISTORY_MAX_PAGE = 500 # Максимальный размер страницы ответа event_history
+event_log: EventLog | None = None
 
 # ========================
 # TCP Server (настройка профиля и управление сессиями)
 # ========================
+# ========================
+# Реестр действий TCP: поле "action" в payload -> (основное имя, обработчик(client_payload, addr) -> dict ответа)
+# Метрики пишутся под основным именем, синонимы учитываются вместе с ним.
+# ========================
+TCP_ACTION_HANDLERS: dict = {}
+# Действия, которые могут долго ждать внешние сервисы: в asyncio-режиме выполняются в пуле потоков
+BLOCKING_TCP_ACTIONS: set = set()
+DEFAULT_TCP_ACTION = "profile_sync" # Для payload без "action" (старые клиенты)
+tcp_action_metrics = ActionMetrics() # Запросы, ошибки и задержки по каждому действию
+
+def tcp_action(*names: str, blocking: bool = False):
+    """Регистрирует обработчик действия; первое имя - основное, остальные - синонимы."""
+    def register(handler):
+        for name in names:
+            TCP_ACTION_HANDLERS[name] = (names[0], handler)
+            if blocking:
+                BLOCKING_TCP_ACTIONS.add(name)
+        return handler
+    return register
+
+def is_valid_session_id(session_id) -> bool:
+    """session_id от клиента годится ключом лимитеров и хранилища сессий (строка разумной длины)."""
+    return isinstance(session_id, str) and len(session_id) <= MAX_SESSION_ID_LENGTH
+
+def check_tcp_rate_limit(client_payload: dict, addr) -> dict | None:
+    """None - запрос разрешен, иначе JSON-ответ об ошибке с retry_after (секунды до следующей попытки)."""
+    retry_after = rate_limiters["tcp_request_ip"].acquire(addr[0])
+    if not retry_after and client_payload.get("session_id"):
+        retry_after = rate_limiters["tcp_request_session"].acquire(client_payload["session_id"])
+    if retry_after:
+        return {"status": "error", "message": "Rate limit exceeded, slow down.", "retry_after": round(retry_after, 3)}
+    return None
+
+def process_tcp_payload(client_payload: dict, addr) -> dict:
+    """Обрабатывает запрос клиента по полю "action" и возвращает JSON-ответ (dict).
+    Общая логика для потокового и asyncio режимов TCP сервера. Каждый вызов замеряется."""
+    if not isinstance(client_payload, dict): # Старый протокол принимает любой JSON: массив, число, строку
+        return dict(INVALID_PAYLOAD_RESPONSE)
+    if client_payload.get("session_id") is not None and not is_valid_session_id(client_payload["session_id"]):
+        return {"status": "error", "message": f"Field 'session_id' must be a string of at most {MAX_SESSION_ID_LENGTH} characters."}
+    rate_limited_response = check_tcp_rate_limit(client_payload, addr)
+    if rate_limited_response is not None:
+        return rate_limited_response
+    requested_action = client_payload.get("action") or DEFAULT_TCP_ACTION
+    registered = TCP_ACTION_HANDLERS.get(requested_action) if isinstance(requested_action, str) else None
+    if registered is None:
+        tcp_action_metrics.record("unknown", 0.0, error=True)
+        return {"status": "error", "message": f"Неизвестное действие: '{requested_action}'. Доступны: {', '.join(sorted(TCP_ACTION_HANDLERS))}"}
+    action, handler = registered
+
+    started_at = time.perf_counter()
+    try:
+        response_payload = handler(client_payload, addr)
+    except Exception:
+        tcp_action_metrics.record(action, time.perf_counter() - started_at, error=True)
+        raise
+    tcp_action_metrics.record(action, time.perf_counter() - started_at, error=response_payload.get("status") != "success")
+    return response_payload
+
+@tcp_action("profile_sync", "update_profile")
+def process_session_payload(client_payload: dict, addr) -> dict:
+    """Создает или обновляет сессию по payload клиента (настройка профиля)."""
+    client_session_id = client_payload.get("session_id")
+    if not isinstance(client_payload.get("name", ""), str):
+        return {"status": "error", "message": "Field 'name' must be a string."}
+    # Извлекаем имя пользователя, если есть, или используем IP:Port как идентификатор
+    user_identifier_from_payload = client_payload.get("name", f"{addr[0]}:{addr[1]}")
+
+    current_server_session_id = None
+    session_status_message = ""
+
+    # Клиент прислал существующий ID - продлеваем сессию (и обновляем имя, если оно пришло)
+    existing_session = active_sessions.touch(client_session_id, client_payload.get("name"))
+    if existing_session is not None:
+        current_server_session_id = client_session_id
+        session_status_message = f"Сессия {client_session_id} для '{existing_session['user_name']}' подтверждена и обновлена."
+        server_log.info("TCP", "tcp.session_confirmed", "Сессия {session_id} для '{user_name}' подтверждена и обновлена.",
+                        session_id=client_session_id, user_name=existing_session["user_name"])
+    else:
+        # Клиент прислал невалидный (или истекший) ID или не прислал ID вовсе - генерируем новый
+        current_server_session_id = active_sessions.create(user_identifier_from_payload, addr)
+        session_status_message = f"Для '{user_identifier_from_payload}' создана новая сессия: {current_server_session_id}."
+        server_log.info("TCP", "tcp.session_created", "Для '{user_name}' создана новая сессия: {session_id}.",
+                        session_id=current_server_session_id, user_name=user_identifier_from_payload)
+
+    # Формируем JSON ответ
+    return {
+        "status": "success",
+        "message": f"Профиль '{user_identifier_from_payload}' обработан. {session_status_message}",
+        "session_id": current_server_session_id # Всегда возвращаем актуальный ID
+    }
+
+@tcp_action("get_weather_for_client", blocking=True)
+def process_weather_request(client_payload: dict, addr) -> dict:
+    """get_weather_for_client: погода из общего кэша сервера (см. server/weather_service.py)."""
+    session = active_sessions.touch(client_payload.get("session_id"))
+    session_id = client_payload["session_id"] if session is not None else active_sessions.create(f"{addr[0]}:{addr[1]}", addr)
+
+    city = str(client_payload.get("city") or "").strip()
+    if not city:
+        return {"status": "error", "message": "Не указан город для прогноза погоды.", "session_id": session_id}
+    try:
+        date_offset = max(0, min(int(client_payload.get("date_offset", 0)), 2))
+    except (TypeError, ValueError):
+        return {"status": "error", "message": "Некорректное смещение дня (date_offset).", "session_id": session_id}
+
+    weather_data = weather_service.get_weather(city, date_offset)
+    if weather_data.get("error_message"):
+        return {"status": "error", "message": weather_data["error_message"], "session_id": session_id}
+    alert_text = weather_service.weather_alert_text(weather_data)
+    if alert_text:
+        # Предупреждение уходит только этому пользователю, если он слушает WS
+        push_to_session_threadsafe(session_id, {"type": "weather_alert", "city": weather_data.get("city_resolved"),
+                                                "requested_date": weather_data.get("requested_date"), "message": alert_text})
+    return {"status": "success", "data": dict(weather_data), "session_id": session_id}
+
+@tcp_action("presence")
+def process_presence_request(client_payload: dict, addr) -> dict:
+    """Подключены ли сессии по WebSocket: "session_ids": [...] (или один "session_id")."""
+    session_ids = client_payload.get("session_ids")
+    if session_ids is None:
+        session_ids = [client_payload.get("session_id")]
+    if not isinstance(session_ids, list) or not all(isinstance(session_id, str) for session_id in session_ids):
+        return {"status": "error", "message": "session_ids должен быть списком строк."}
+    return {"status": "success", "presence": {session_id: is_session_connected_ws(session_id) for session_id in session_ids}}
+
+@tcp_action("location_history")
+def process_location_history_request(client_payload: dict, addr) -> dict:
+    """История геолокаций сессии: последняя точка, скорость за "window_seconds", путь; "track": true - и сами точки."""
+    if location_history is None:
+        return {"status": "error", "message": "История геолокаций выключена на сервере."}
+    session_id = client_payload.get("session_id")
+    if not isinstance(session_id, str):
+        return {"status": "error", "message": "Не указан session_id."}
+    try:
+        window_seconds = float(client_payload.get("window_seconds", LOCATION_SPEED_WINDOW_SECONDS))
+    except (TypeError, ValueError):
+        return {"status": "error", "message": "Некорректное окно скорости (window_seconds)."}
+    last_position = location_history.last_position(session_id)
+    if last_position is None:
+        return {"status": "error", "message": "Нет геолокаций этой сессии."}
+    history = {
+        "last_position": dict(zip(("timestamp", "latitude", "longitude"), last_position)),
+        "speed_mps": location_history.speed_mps(session_id, window_seconds),
+        "distance_m": location_history.distance_m(session_id),
+    }
+    if client_payload.get("track"):
+        history["track"] = [list(point) for point in location_history.track(session_id)]
+    return {"status": "success", "data": history}
+
+@tcp_action("stats")
+def process_stats_request(client_payload: dict, addr) -> dict:
+    """Статистика сервера: по действиям (запросы, ошибки, гистограммы задержек), сессиям и кэшу погоды."""
+    return {
+        "status": "success",
+        "data": {
+            "actions": tcp_action_metrics.snapshot(),
+            "sessions": active_sessions.stats(),
+            "weather_cache": weather_service.weather_cache.stats(),
+            "rate_limits": {name: limiter.stats() for name, limiter in rate_limiters.items()},
+            "log": server_log.stats(),
+            "udp": {"mode": UDP_SERVER_MODE, "received": udp_received_datagrams.value,
+                    **(udp_protocol.stats() if udp_protocol is not None else {}),
+                    "offloaded_batches": udp_offloaded_batches.value, "kernel_drops": udp_socket_drops(),
+                    "pois": poi_dataset.stats() if poi_dataset is not None else None,
+                    "location_history": location_history.stats() if location_history is not None else None},
+            "ws": {"connected": len(connected_ws_clients), "bound_sessions": len(ws_session_clients),
+                   "subscriptions": ws_subscriptions.stats(),
+                   "event_log": event_log.stats() if event_log is not None else None,
+                   "broadcast_cycles": ws_cycle_stats.snapshot(),
+                   "producers": ws_scheduler.stats() if ws_scheduler is not None else {},
+                   "memory": ws_memory_report(),
+                   "outbox": {"enabled": WS_CLIENT_OUTBOX, "queued_clients": len(ws_outboxes),
+                              "pending_messages": sum(len(outbox) for outbox in list(ws_outboxes.values())),
+                              "conflated": ws_conflated_messages.value, "overflows": ws_outbox_overflows.value}},
+        }
+    }
+
+def collect_prometheus_metrics() -> str:
+    """Текст для GET /metrics. Вызывается из потока HTTP сервера метрик, горячие пути не блокирует."""
+    metrics = PrometheusText()
+    metrics.counter("all_in_one_tcp_accepted_connections_total", "Принятые TCP соединения.", tcp_accepted_connections.value)
+    metrics.gauge("all_in_one_tcp_active_handlers", "TCP соединения в обработке.", tcp_active_handlers.value)
+    for action, (requests_count, errors_count, latency) in tcp_action_metrics.copy_stats().items():
+        labels = {"action": action}
+        metrics.counter("all_in_one_tcp_requests_total", "TCP запросы по действиям.", requests_count, labels)
+        metrics.counter("all_in_one_tcp_request_errors_total", "TCP запросы, завершившиеся ошибкой.", errors_count, labels)
+        metrics.histogram("all_in_one_tcp_request_duration_seconds", "Время обработки TCP запроса.", latency, labels)
+    metrics.counter("all_in_one_udp_datagrams_total", "Принятые UDP датаграммы (в секунду - rate()).", udp_received_datagrams.value)
+    udp_drops = udp_socket_drops()
+    if udp_drops is not None:
+        metrics.counter("all_in_one_udp_kernel_drops_total", "UDP датаграммы, отброшенные ядром (переполнен буфер приема).", udp_drops)
+    if poi_dataset is not None:
+        poi_stats = poi_dataset.stats()
+        metrics.gauge("all_in_one_udp_pois", "Точки интереса в индексе подсказок UDP.", poi_stats["pois"])
+        metrics.counter("all_in_one_udp_poi_loads_total", "Загрузки файла POI (включая перезагрузки).", poi_stats["loads"])
+        metrics.counter("all_in_one_udp_poi_load_errors_total", "Ошибки загрузки файла POI.", poi_stats["load_errors"])
+    if location_history is not None:
+        history_stats = location_history.stats()
+        metrics.gauge("all_in_one_location_history_sessions", "Сессии с историей геолокаций.", history_stats["sessions"])
+        metrics.gauge("all_in_one_location_history_bytes", "Память кольцевых буферов истории геолокаций.", history_stats["array_bytes"])
+        metrics.counter("all_in_one_location_history_points_total", "Записанные точки истории геолокаций.", history_stats["recorded"])
+    metrics.gauge("all_in_one_ws_connected_clients", "Подключенные WebSocket клиенты.", len(connected_ws_clients))
+    metrics.gauge("all_in_one_ws_bound_sessions", "Сессии, подключенные по WebSocket (ws_identify с session_id).", len(ws_session_clients))
+    bytes_per_connection = ws_memory_report()["avg_bytes_per_connection"]
+    if bytes_per_connection is not None:
+        metrics.gauge("all_in_one_ws_bytes_per_connection", "Оценка памяти на WebSocket соединение (прирост RSS / соединения).", bytes_per_connection)
+    metrics.gauge("all_in_one_ws_subscribed_clients", "WebSocket клиенты с явной подпиской на типы событий/регионы.", ws_subscriptions.stats()["subscribed_clients"])
+    metrics.histogram("all_in_one_ws_broadcast_fanout_seconds", "Рассылка одного сообщения всем WebSocket клиентам.", ws_broadcast_fanout.copy())
+    metrics.counter("all_in_one_ws_evicted_clients_total", "WebSocket клиенты, отключенные за превышение дедлайна отправки.", ws_evicted_clients.value)
+    metrics.gauge("all_in_one_ws_outbox_clients", "WebSocket клиенты с непустой очередью отправки.", len(ws_outboxes))
+    metrics.counter("all_in_one_ws_conflated_messages_total", "data_update, замененные более новыми в очереди отстающего клиента.", ws_conflated_messages.value)
+    metrics.counter("all_in_one_ws_outbox_overflows_total", "WebSocket клиенты, отключенные из-за переполнения очереди отправки.", ws_outbox_overflows.value)
+    metrics.counter("all_in_one_ws_broadcast_frames_total", "Кадры рассылки WebSocket (по одному на клиента).", ws_cycle_stats.total_frames)
+    metrics.counter("all_in_one_ws_broadcast_bytes_total", "Байты рассылки WebSocket до сжатия (сумма по клиентам).", ws_cycle_stats.total_bytes)
+    for name, producer in (ws_scheduler.producers.items() if ws_scheduler is not None else ()):
+        labels = {"producer": name}
+        metrics.histogram("all_in_one_ws_producer_duration_seconds", "Время работы производителя событий WS.", producer.duration.copy(), labels)
+        metrics.counter("all_in_one_ws_producer_skipped_total", "Срабатывания производителя, пропущенные из-за перегрузки.", producer.skipped, labels)
+        metrics.counter("all_in_one_ws_producer_errors_total", "Ошибки производителя событий WS.", producer.errors, labels)
+    if event_log is not None:
+        event_log_stats = event_log.stats()
+        metrics.gauge("all_in_one_event_log_segments", "Сегменты журнала событий на диске.", event_log_stats["segments"])
+        metrics.gauge("all_in_one_event_log_bytes", "Размер журнала событий на диске.", event_log_stats["bytes"])
+    session_stats = active_sessions.stats()
+    metrics.gauge("all_in_one_sessions_active", "Живые сессии.", session_stats["live"])
+    metrics.counter("all_in_one_sessions_created_total", "Созданные сессии.", session_stats["created"])
+    metrics.counter("all_in_one_sessions_expired_total", "Истекшие сессии.", session_stats["expired"])
+    for name, limiter in rate_limiters.items():
+        limiter_stats = limiter.stats()
+        metrics.counter("all_in_one_rate_limit_dropped_total", "Запросы, отклоненные ограничением частоты.", limiter_stats["dropped"], {"limiter": name})
+        metrics.counter("all_in_one_rate_limit_evicted_keys_total", "Ключи, вытесненные из полной таблицы лимитера.", limiter_stats["evicted"], {"limiter": name})
+    metrics.counter("all_in_one_log_records_dropped_total", "Записи лога, отброшенные из-за заполненной очереди.", server_log.dropped.value)
+    metrics.counter("all_in_one_log_records_sampled_out_total", "Записи лога, пропущенные сэмплированием.", server_log.sampled_out.value)
+    weather_cache_stats = weather_service.weather_cache.stats()
+    for result in ("hits", "misses", "coalesced"):
+        metrics.counter("all_in_one_weather_cache_requests_total", "Обращения к кэшу погоды.", weather_cache_stats[result], {"result": result})
+    return metrics.render()
+
+def handle_tcp_request(client_payload: dict, addr) -> dict:
+    """Обрабатывает один запрос; непредвиденные ошибки превращает в JSON-ответ об ошибке,
+    чтобы в постоянном соединении ошибка одного запроса не рвала остальные."""
+    try:
+        return process_tcp_payload(client_payload, addr)
+    except Exception as e:
+        server_log.error("TCP", "tcp.handler_error", "Непредвиденная ошибка при обработке запроса от {addr}: {error}", addr=addr, error=e)
+        return {"status": "error", "message": f"Server error during TCP processing: {str(e)[:100]}"}
+
+async def handle_tcp_request_async(client_payload: dict, addr) -> dict:
+    """asyncio-режим: быстрые действия выполняются прямо в цикле событий,
+    блокирующие (BLOCKING_TCP_ACTIONS) - в пуле потоков, чтобы не останавливать цикл."""
+    action = client_payload.get("action") if isinstance(client_payload, dict) else None
+    if SESSION_CALLS_BLOCK or (isinstance(action, str) and action in BLOCKING_TCP_ACTIONS): # Не строка - ответ "неизвестное действие"
+        return await asyncio.get_running_loop().run_in_executor(tcp_frame_executor, handle_tcp_request, client_payload, addr)
+    return handle_tcp_request(client_payload, addr)
+
+INVALID_FRAME_RESPONSE = {"status": "error", "message": "Invalid JSON received by server.", "request_id": None}
+INVALID_PAYLOAD_RESPONSE = {"status": "error", "message": "Payload must be a JSON object."}
+
+def decode_tcp_frame(frame_body: bytes, addr) -> dict | None:
+    """Разбирает тело фрейма (объект JSON или MessagePack). None - если фрейм невалиден."""
+    try:
+        client_payload = decode_message(frame_body)
+        if not isinstance(client_payload, dict):
+            raise ValueError("ожидался объект")
+    except ValueError as e: # JSONDecodeError, CodecError и UnicodeDecodeError - подклассы ValueError
+        server_log.warning("TCP framed", "tcp.invalid_frame", "Ошибка при разборе фрейма от {addr}: {error}. Данные: '{data!r}'", addr=addr, error=e, data=frame_body[:200])
+        return None
+    server_log.debug("TCP framed", "tcp.payload", "Получен payload от {addr}: {payload}", addr=addr, payload=client_payload)
+    return client_payload
+
+def finish_tcp_frame_response(client_payload: dict, response_payload: dict) -> dict:
+    """Добавляет в ответ request_id запроса и, если клиент предложил кодеки, выбранный кодек."""
+    response_payload["request_id"] = client_payload.get("request_id")
+    if "accept_codecs" in client_payload:
+        response_payload["codec"] = choose_codec(client_payload["accept_codecs"])
+    return response_payload
+
+def process_tcp_frame(frame_body: bytes, addr) -> tuple[dict, str]:
+    """Разбирает тело фрейма и возвращает ответ с тем же request_id и кодек ответа -
+    кодек запроса (на неразобранный фрейм - JSON, его понимают все клиенты)."""
+    client_payload = decode_tcp_frame(frame_body, addr)
+    if client_payload is None:
+        return dict(INVALID_FRAME_RESPONSE), CODEC_JSON
+    return finish_tcp_frame_response(client_payload, handle_tcp_request(client_payload, addr)), detect_codec(frame_body)
+
+TCP_INTERNAL_ERROR_MESSAGE = "Внутренняя ошибка сервера."
+
+def tcp_error_frame(frame_body: bytes, addr, error: Exception) -> bytes:
+    """Фрейм ошибки на запрос, обработка которого упала: с тем же request_id, чтобы клиент
+    с конвейером запросов не ждал ответа до своего таймаута."""
+    server_log.error("TCP framed", "tcp.handler_error", "Ошибка обработки запроса от {addr}: {error!r}", addr=addr, error=error)
+    try:
+        client_payload = decode_message(frame_body)
+        request_id = client_payload.get("request_id") if isinstance(client_payload, dict) else None
+        return encode_frame({"status": "error", "message": TCP_INTERNAL_ERROR_MESSAGE, "request_id": request_id}, detect_codec(frame_body))
+    except Exception: # Даже request_id не разобрать или не закодировать - отвечаем без него
+        return encode_frame({"status": "error", "message": TCP_INTERNAL_ERROR_MESSAGE, "request_id": None}, CODEC_JSON)
+
+def parse_legacy_payload(raw_data_bytes: bytes) -> dict | None:
+    """Старый протокол: один JSON без длины. Возвращает None, если JSON обрезан
+    на границе recv и нужно дочитать; для невалидного JSON бросает исключение."""
+    try:
+        raw_data_str = raw_data_bytes.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if e.reason == "unexpected end of data": # Многобайтный символ разрезан между пакетами
+            return None
+        raise
+    try:
+        return json.loads(raw_data_str)
+    except json.JSONDecodeError as e:
+        if e.pos >= len(raw_data_str) or e.msg.startswith("Unterminated string"):
+            return None
+        raise
+
+def is_framed_protocol_preamble_incomplete(data: bytes) -> bool:
+    return len(data) < len(FRAMED_PROTOCOL_MAGIC) and FRAMED_PROTOCOL_MAGIC.startswith(data)
+
+def serve_framed_tcp_connection(conn, addr, initial_data: bytes):
+    """Постоянное соединение: читаем фреймы и обрабатываем их параллельно в пуле потоков.
+    Ответы отправляются по мере готовности (возможно не по порядку), с request_id."""
+    server_log.debug("TCP framed", "tcp.framed_connection", "Соединение {addr} использует фреймированный протокол.", addr=addr)
+    conn.settimeout(TCP_IDLE_TIMEOUT_SECONDS)
+    decoder = FrameDecoder()
+    send_lock = threading.Lock()
+    inflight_slots = threading.BoundedSemaphore(TCP_MAX_INFLIGHT_PER_CONNECTION)
+    inflight_futures = set()
+
+    def respond(frame_body: bytes):
+        try:
+            try:
+                response_frame = encode_frame(*process_tcp_frame(frame_body, addr))
+            except Exception as e_handle:
+                response_frame = tcp_error_frame(frame_body, addr, e_handle)
+            with send_lock:
+                conn.sendall(response_frame)
+        except OSError as send_err:
+            server_log.warning("TCP framed", "tcp.send_error", "Ошибка при отправке ответа клиенту {addr}: {error}", addr=addr, error=send_err)
+        finally:
+            inflight_slots.release()
+
+    data = initial_data
+    try:
+        while True:
+            for frame_body in decoder.feed(data):
+                inflight_slots.acquire() # Backpressure: не больше N запросов в обработке на соединение
+                future = tcp_frame_executor.submit(respond, frame_body)
+                inflight_futures.add(future)
+                future.add_done_callback(inflight_futures.discard)
+            data = conn.recv(TCP_RECV_CHUNK_SIZE)
+            if not data:
+                break
+    except socket.timeout:
+        server_log.info("TCP framed", "tcp.idle_timeout", "Соединение {addr} простаивало {seconds} с и будет закрыто.", addr=addr, seconds=TCP_IDLE_TIMEOUT_SECONDS)
+    except FrameProtocolError as e_frame:
+        server_log.warning("TCP framed", "tcp.protocol_error", "Нарушение протокола от {addr}: {error}. Соединение закрыто.", addr=addr, error=e_frame)
+    finally:
+        # Даем закончить уже принятым запросам, прежде чем соединение закроется
+        wait_futures(list(inflight_futures), timeout=TCP_READ_TIMEOUT_SECONDS)
+
 def handle_tcp_client(conn, addr):
-    print(f"[TCP] Подключение от {addr}")
-    raw_data_str = "" # Для логгирования в случае ошибки JSON
+    server_log.debug("TCP", "tcp.connection", "Подключение от {addr}", addr=addr)
+    tcp_active_handlers.enter()
+    raw_data_bytes = b"" # Для логгирования в случае ошибки JSON
     try:
-        raw_data_bytes = conn.recv(1024)
+        conn.settimeout(TCP_READ_TIMEOUT_SECONDS)
+        raw_data_bytes = conn.recv(TCP_RECV_CHUNK_SIZE)
+        while raw_data_bytes and is_framed_protocol_preamble_incomplete(raw_data_bytes):
+            more_data = conn.recv(TCP_RECV_CHUNK_SIZE)
+            if not more_data: break
+            raw_data_bytes += more_data
         if not raw_data_bytes:
-            print(f"[TCP] Получены пустые данные от {addr}. Соединение закрыто.")
+            server_log.debug("TCP", "tcp.empty", "Получены пустые данные от {addr}. Соединение закрыто.", addr=addr)
             return # Просто выходим, conn закроется в finally
 
-        raw_data_str = raw_data_bytes.decode('utf-8')
-        client_payload = json.loads(raw_data_str)
-        print(f"[TCP] Получен payload от {addr}: {client_payload}")
-
-        client_session_id = client_payload.get("session_id")
-        # Извлекаем имя пользователя, если есть, или используем IP:Port как идентификатор
-        user_identifier_from_payload = client_payload.get("name", f"{addr[0]}:{addr[1]}")
-
-        current_server_session_id = None
-        session_status_message = ""
-
-        if client_session_id and client_session_id in active_sessions:
-            # Клиент прислал существующий ID, проверяем его (в нашем случае просто обновляем)
-            active_sessions[client_session_id]["last_seen"] = time.time()
-            # Обновляем имя пользователя, если оно изменилось или было установлено
-            if "name" in client_payload:
-                 active_sessions[client_session_id]["user_name"] = user_identifier_from_payload
-            current_server_session_id = client_session_id
-            session_status_message = f"Сессия {client_session_id} для '{active_sessions[client_session_id]['user_name']}' подтверждена и обновлена."
-            print(f"[TCP] {session_status_message}")
-        else:
-            # Клиент прислал невалидный ID или не прислал ID вовсе - генерируем новый
-            current_server_session_id = str(uuid.uuid4())
-            active_sessions[current_server_session_id] = {
-                "user_name": user_identifier_from_payload,
-                "last_seen": time.time(),
-                "addr": addr, # Сохраняем адрес для информации
-                "tcp_connection_time": time.time()
-            }
-            session_status_message = f"Для '{user_identifier_from_payload}' создана новая сессия: {current_server_session_id}."
-            print(f"[TCP] {session_status_message}")
-        
-        # Формируем JSON ответ
-        response_payload = {
-            "status": "success",
-            "message": f"Профиль '{user_identifier_from_payload}' обработан. {session_status_message}",
-            "session_id": current_server_session_id # Всегда возвращаем актуальный ID
-        }
+        if raw_data_bytes.startswith(FRAMED_PROTOCOL_MAGIC):
+            serve_framed_tcp_connection(conn, addr, raw_data_bytes[len(FRAMED_PROTOCOL_MAGIC):])
+            return
+
+        # Старый протокол: дочитываем JSON целиком (раньше обрезался на 1 КБ)
+        client_payload = parse_legacy_payload(raw_data_bytes)
+        while client_payload is None:
+            more_data = conn.recv(TCP_RECV_CHUNK_SIZE)
+            if not more_data or len(raw_data_bytes) + len(more_data) > TCP_LEGACY_MAX_PAYLOAD_SIZE:
+                client_payload = json.loads(raw_data_bytes.decode('utf-8', errors='replace')) # Бросит JSONDecodeError
+                break
+            raw_data_bytes += more_data
+            client_payload = parse_legacy_payload(raw_data_bytes)
+        server_log.debug("TCP", "tcp.payload", "Получен payload от {addr}: {payload}", addr=addr, payload=client_payload)
+
+        response_payload = process_tcp_payload(client_payload, addr)
         conn.sendall(json.dumps(response_payload).encode('utf-8'))
 
     except json.JSONDecodeError as e:
-        error_message = f"Ошибка при разборе JSON от {addr}: {e}. Полученные данные: '{raw_data_str}'"
-        print(f"[TCP] {error_message}")
+        server_log.warning("TCP", "tcp.invalid_json", "Ошибка при разборе JSON от {addr}: {error}. Полученные данные: '{data}'",
+                           addr=addr, error=e, data=raw_data_bytes[:1000].decode('utf-8', errors='replace'))
         try:
             response_payload = {"status": "error", "message": "Invalid JSON received by server."}
             conn.sendall(json.dumps(response_payload).encode('utf-8'))
         except Exception as send_err:
-            print(f"[TCP] Ошибка при отправке JSON-сообщения об ошибке клиенту {addr}: {send_err}")
+            server_log.warning("TCP", "tcp.send_error", "Ошибка при отправке JSON-сообщения об ошибке клиенту {addr}: {error}", addr=addr, error=send_err)
+    except socket.timeout:
+        server_log.info("TCP", "tcp.read_timeout", "Клиент {addr} не прислал данные за {seconds} с. Соединение закрыто.", addr=addr, seconds=TCP_READ_TIMEOUT_SECONDS)
     except ConnectionResetError:
-        print(f"[TCP] Соединение сброшено клиентом {addr} во время обработки.")
+        server_log.info("TCP", "tcp.reset", "Соединение сброшено клиентом {addr} во время обработки.", addr=addr)
     except Exception as e:
-        error_message = f"Непредвиденная ошибка при обработке TCP от {addr}: {e}"
-        print(f"[TCP] {error_message}")
+        server_log.error("TCP", "tcp.unexpected_error", "Непредвиденная ошибка при обработке TCP от {addr}: {error}", addr=addr, error=e)
         try:
             response_payload = {"status": "error", "message": f"Server error during TCP processing: {str(e)[:100]}"}
             conn.sendall(json.dumps(response_payload).encode('utf-8'))
         except Exception as send_err:
-             print(f"[TCP] Ошибка при отправке JSON-сообщения о непредвиденной ошибке клиенту {addr}: {send_err}")
+            server_log.warning("TCP", "tcp.send_error", "Ошибка при отправке JSON-сообщения о непредвиденной ошибке клиенту {addr}: {error}", addr=addr, error=send_err)
     finally:
+        tcp_active_handlers.exit()
         if conn:
             try:
                 conn.close()
-                # print(f"[TCP] Соединение с {addr} закрыто.")
             except Exception as e_close:
-                print(f"[TCP] Ошибка при закрытии соединения с {addr}: {e_close}")
+                server_log.warning("TCP", "tcp.close_error", "Ошибка при закрытии соединения с {addr}: {error}", addr=addr, error=e_close)
 
-def run_tcp_server():
+def start_session_cleanup_thread():
     # Запускаем очистку старых сессий в отдельном потоке, чтобы не блокировать основной
     session_cleanup_thread = threading.Thread(target=periodic_session_cleanup, daemon=True)
     session_cleanup_thread.start()
 
+def run_tcp_server():
+    start_session_cleanup_thread()
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Позволяет переиспользовать адрес
+        if SOCKET_REUSE_PORT:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((TCP_HOST, TCP_PORT))
         s.listen()
         print(f"[TCP] Сервер запущен на {TCP_HOST}:{TCP_PORT}...")
@@ -123,6 +727,10 @@ def run_tcp_server():
         while True: # Цикл приема новых подключений
             try:
                 conn, addr = s.accept()
+                tcp_accepted_connections.inc()
+                if rate_limiters["tcp_connection_ip"].acquire(addr[0]):
+                    conn.close() # Слишком частые подключения: закрываем, не создавая поток
+                    continue
                 # Для каждого клиента создаем новый поток для обработки
                 client_thread = threading.Thread(target=handle_tcp_client, args=(conn, addr), daemon=True)
                 client_thread.start()
@@ -132,182 +740,1155 @@ def run_tcp_server():
                 time.sleep(0.1)
 
 
+# ========================
+# TCP Server, asyncio-режим (один цикл событий вместо потока на соединение)
+# ========================
+tcp_connection_slots: asyncio.Semaphore | None = None # Создается в run_tcp_server_async
+tcp_async_pending_connections = 0 # Соединения, ожидающие свободного слота
+tcp_async_active_connections = 0
+
+async def tcp_async_send_json(writer, payload: dict):
+    writer.write(json.dumps(payload).encode('utf-8'))
+    await writer.drain()
+
+async def serve_framed_tcp_connection_async(reader, writer, addr, initial_data: bytes):
+    """asyncio-вариант serve_framed_tcp_connection: каждый фрейм обрабатывается отдельной задачей."""
+    server_log.debug("TCP async framed", "tcp.framed_connection", "Соединение {addr} использует фреймированный протокол.", addr=addr)
+    decoder = FrameDecoder()
+    write_lock = asyncio.Lock()
+    inflight_slots = asyncio.Semaphore(TCP_MAX_INFLIGHT_PER_CONNECTION)
+    inflight_tasks = set()
+
+    async def respond(frame_body: bytes):
+        try:
+            try:
+                client_payload = decode_tcp_frame(frame_body, addr)
+                if client_payload is None:
+                    response_payload, response_codec = dict(INVALID_FRAME_RESPONSE), CODEC_JSON
+                else:
+                    response_payload = finish_tcp_frame_response(client_payload, await handle_tcp_request_async(client_payload, addr))
+                    response_codec = detect_codec(frame_body)
+                response_frame = encode_frame(response_payload, response_codec)
+            except Exception as e_handle:
+                response_frame = tcp_error_frame(frame_body, addr, e_handle)
+            async with write_lock:
+                writer.write(response_frame)
+                await writer.drain()
+        except (ConnectionError, OSError) as send_err:
+            server_log.warning("TCP async framed", "tcp.send_error", "Ошибка при отправке ответа клиенту {addr}: {error}", addr=addr, error=send_err)
+        finally:
+            inflight_slots.release()
+
+    data = initial_data
+    try:
+        while True:
+            for frame_body in decoder.feed(data):
+                await inflight_slots.acquire()
+                task = asyncio.create_task(respond(frame_body))
+                inflight_tasks.add(task)
+                task.add_done_callback(inflight_tasks.discard)
+            data = await asyncio.wait_for(reader.read(TCP_RECV_CHUNK_SIZE), TCP_IDLE_TIMEOUT_SECONDS)
+            if not data:
+                break
+    except asyncio.TimeoutError:
+        server_log.info("TCP async framed", "tcp.idle_timeout", "Соединение {addr} простаивало {seconds} с и будет закрыто.", addr=addr, seconds=TCP_IDLE_TIMEOUT_SECONDS)
+    except FrameProtocolError as e_frame:
+        server_log.warning("TCP async framed", "tcp.protocol_error", "Нарушение протокола от {addr}: {error}. Соединение закрыто.", addr=addr, error=e_frame)
+    finally:
+        if inflight_tasks:
+            await asyncio.wait(list(inflight_tasks), timeout=TCP_READ_TIMEOUT_SECONDS)
+
+async def handle_tcp_client_async(reader, writer):
+    """Та же логика сессий, что и в handle_tcp_client, но без отдельного потока.
+    Соединения сверх TCP_MAX_CONNECTIONS ждут слот; при переполнении очереди ожидания - отказ."""
+    global tcp_async_pending_connections, tcp_async_active_connections
+    addr = writer.get_extra_info("peername") or ("unknown", 0)
+    tcp_accepted_connections.inc()
+    if rate_limiters["tcp_connection_ip"].acquire(addr[0]):
+        writer.close() # Слишком частые подключения с этого IP
+        return
+
+    # Backpressure: ограничиваем число соединений, ожидающих обработки
+    if tcp_async_pending_connections >= TCP_MAX_PENDING_CONNECTIONS:
+        server_log.warning("TCP async", "tcp.busy", "Очередь ожидания переполнена, отказ {addr}.", addr=addr)
+        try: await tcp_async_send_json(writer, {"status": "error", "message": "Server busy, try again later."})
+        except Exception: pass
+        writer.close()
+        return
+
+    tcp_async_pending_connections += 1
+    try:
+        await asyncio.wait_for(tcp_connection_slots.acquire(), TCP_PENDING_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        server_log.warning("TCP async", "tcp.busy", "Нет свободного слота для {addr} за {seconds} с, отказ.", addr=addr, seconds=TCP_PENDING_WAIT_SECONDS)
+        try: await tcp_async_send_json(writer, {"status": "error", "message": "Server busy, try again later."})
+        except Exception: pass
+        writer.close()
+        return
+    finally:
+        tcp_async_pending_connections -= 1
+
+    tcp_async_active_connections += 1
+    tcp_active_handlers.enter()
+    server_log.debug("TCP async", "tcp.connection", "Подключение от {addr} (активных: {active})", addr=addr, active=tcp_async_active_connections)
+    raw_data_bytes = b""
+    try:
+        raw_data_bytes = await asyncio.wait_for(reader.read(TCP_RECV_CHUNK_SIZE), TCP_READ_TIMEOUT_SECONDS)
+        while raw_data_bytes and is_framed_protocol_preamble_incomplete(raw_data_bytes):
+            more_data = await asyncio.wait_for(reader.read(TCP_RECV_CHUNK_SIZE), TCP_READ_TIMEOUT_SECONDS)
+            if not more_data: break
+            raw_data_bytes += more_data
+        if not raw_data_bytes:
+            server_log.debug("TCP async", "tcp.empty", "Получены пустые данные от {addr}. Соединение закрыто.", addr=addr)
+            return
+
+        if raw_data_bytes.startswith(FRAMED_PROTOCOL_MAGIC):
+            await serve_framed_tcp_connection_async(reader, writer, addr, raw_data_bytes[len(FRAMED_PROTOCOL_MAGIC):])
+            return
+
+        client_payload = parse_legacy_payload(raw_data_bytes)
+        while client_payload is None:
+            more_data = await asyncio.wait_for(reader.read(TCP_RECV_CHUNK_SIZE), TCP_READ_TIMEOUT_SECONDS)
+            if not more_data or len(raw_data_bytes) + len(more_data) > TCP_LEGACY_MAX_PAYLOAD_SIZE:
+                client_payload = json.loads(raw_data_bytes.decode('utf-8', errors='replace')) # Бросит JSONDecodeError
+                break
+            raw_data_bytes += more_data
+            client_payload = parse_legacy_payload(raw_data_bytes)
+        server_log.debug("TCP async", "tcp.payload", "Получен payload от {addr}: {payload}", addr=addr, payload=client_payload)
+
+        response_payload = await handle_tcp_request_async(client_payload, addr)
+        await tcp_async_send_json(writer, response_payload)
+
+    except asyncio.TimeoutError:
+        server_log.info("TCP async", "tcp.read_timeout", "Клиент {addr} не прислал данные за {seconds} с. Соединение закрыто.", addr=addr, seconds=TCP_READ_TIMEOUT_SECONDS)
+    except json.JSONDecodeError as e:
+        server_log.warning("TCP async", "tcp.invalid_json", "Ошибка при разборе JSON от {addr}: {error}. Полученные данные: '{data}'",
+                           addr=addr, error=e, data=raw_data_bytes[:1000].decode('utf-8', errors='replace'))
+        try: await tcp_async_send_json(writer, {"status": "error", "message": "Invalid JSON received by server."})
+        except Exception as send_err: server_log.warning("TCP async", "tcp.send_error", "Ошибка при отправке JSON-сообщения об ошибке клиенту {addr}: {error}", addr=addr, error=send_err)
+    except ConnectionResetError:
+        server_log.info("TCP async", "tcp.reset", "Соединение сброшено клиентом {addr} во время обработки.", addr=addr)
+    except Exception as e:
+        server_log.error("TCP async", "tcp.unexpected_error", "Непредвиденная ошибка при обработке TCP от {addr}: {error}", addr=addr, error=e)
+        try: await tcp_async_send_json(writer, {"status": "error", "message": f"Server error during TCP processing: {str(e)[:100]}"})
+        except Exception as send_err: server_log.warning("TCP async", "tcp.send_error", "Ошибка при отправке JSON-сообщения о непредвиденной ошибке клиенту {addr}: {error}", addr=addr, error=send_err)
+    finally:
+        tcp_async_active_connections -= 1
+        tcp_active_handlers.exit()
+        tcp_connection_slots.release()
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception as e_close:
+            server_log.warning("TCP async", "tcp.close_error", "Ошибка при закрытии соединения с {addr}: {error}", addr=addr, error=e_close)
+
+async def run_tcp_server_async():
+    global tcp_connection_slots
+    start_session_cleanup_thread()
+    tcp_connection_slots = asyncio.Semaphore(TCP_MAX_CONNECTIONS)
+
+    server = await asyncio.start_server(
+        handle_tcp_client_async, TCP_HOST, TCP_PORT,
+        backlog=TCP_ACCEPT_BACKLOG, reuse_address=True, reuse_port=SOCKET_REUSE_PORT
+    )
+    print(f"[TCP async] Сервер запущен на {TCP_HOST}:{TCP_PORT} (макс. соединений: {TCP_MAX_CONNECTIONS}, backlog: {TCP_ACCEPT_BACKLOG})...")
+    async with server:
+        await server.serve_forever()
+
+
 def periodic_session_cleanup():
-    """Периодически удаляет истекшие сессии."""
+    """Периодически удаляет истекшие сессии (инкрементально, только истекшие записи)."""
     while True:
-        time.sleep(SESSION_TIMEOUT_SECONDS / 2) # Проверяем каждые полтаймаута
-        now = time.time()
-        expired_ids = [
-            sid for sid, data in list(active_sessions.items()) # list() для создания копии перед итерацией
-            if now - data.get("last_seen", 0) > SESSION_TIMEOUT_SECONDS
-        ]
+        time.sleep(SESSION_CLEANUP_INTERVAL_SECONDS)
+        expired_ids = active_sessions.expire_due()
+        if location_history is not None:
+            location_history.expire_idle(time.time() - SESSION_TIMEOUT_SECONDS)
         if expired_ids:
-            print(f"[TCP Sessions] Начинается очистка {len(expired_ids)} истекших сессий...")
-            for sid in expired_ids:
-                if sid in active_sessions: # Дополнительная проверка, вдруг сессия обновилась
-                    del active_sessions[sid]
-                    print(f"[TCP Sessions] Истекшая сессия {sid} удалена.")
-        # else:
-        #     print(f"[TCP Sessions] Нет истекших сессий для удаления. Активных: {len(active_sessions)}")
+            stats = active_sessions.stats()
+            print(f"[TCP Sessions] Удалено истекших сессий: {len(expired_ids)}. Активных: {stats['live']}, создано: {stats['created']}, истекло: {stats['expired']}")
 
 
 # ========================
 # WebSocket Server (события и обновления)
 # ========================
 connected_ws_clients = set() # Хранит объекты websocket соединений
+ws_client_codecs: dict = {} # websocket -> кодек, согласованный в ws_identify (по умолчанию JSON текстом)
+ws_subscriptions = SubscriptionIndex(WS_TOPICS, SERVER_REGIONS) # (тип события, регион) -> клиенты
+# Привязка WS соединений к TCP сессиям (ws_identify с session_id) - адресные сообщения без рассылки всем.
+# Меняются только в цикле событий WS; потоки TCP лишь читают (проверка присутствия) и
+# ставят отправку в цикл через push_to_session_threadsafe. В режиме --workers - индекс своего воркера.
+ws_session_clients: dict[str, set] = {} # session_id -> WS соединения этой сессии
+ws_client_sessions: dict = {} # websocket -> session_id
+ws_client_first_live_seq: dict = {} # websocket -> первый seq, который соединение получит рассылкой (старше - только повтором)
+ws_held_clients: dict = {} # websocket -> таймер конца удержания (None - уже догоняет); рассылка их пропускает
+ws_event_loop: asyncio.AbstractEventLoop | None = None
 
 async def ws_register_client(websocket):
     connected_ws_clients.add(websocket)
+    ws_subscriptions.add_client(websocket)
+    ws_client_first_live_seq[websocket] = ws_last_event_seq + 1
+    ws_held_clients[websocket] = asyncio.get_running_loop().call_later(WS_REPLAY_HOLD_SECONDS, ws_hold_expired, websocket)
     remote_addr_str = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}" if websocket.remote_address else "Unknown WS Client"
-    print(f"[WS] Новый клиент подключен: {remote_addr_str} (Всего: {len(connected_ws_clients)})")
+    server_log.info("WS", "ws.connect", "Новый клиент подключен: {addr} (Всего: {total})", addr=remote_addr_str, total=len(connected_ws_clients))
 
 async def ws_unregister_client(websocket):
     connected_ws_clients.discard(websocket) # Используем discard для безопасности
+    ws_client_codecs.pop(websocket, None)
+    ws_subscriptions.remove_client(websocket)
+    ws_unbind_session(websocket)
+    ws_client_first_live_seq.pop(websocket, None)
+    hold = ws_held_clients.pop(websocket, None)
+    if hold is not None:
+        hold.cancel()
+    ws_batch_clients.discard(websocket)
+    outbox = ws_outboxes.pop(websocket, None)
+    if outbox is not None and outbox.writer is not None:
+        outbox.writer.cancel()
     remote_addr_str = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}" if websocket.remote_address else "Unknown WS Client"
-    print(f"[WS] Клиент отключился: {remote_addr_str} (Осталось: {len(connected_ws_clients)})")
+    server_log.info("WS", "ws.disconnect", "Клиент отключился: {addr} (Осталось: {total})", addr=remote_addr_str, total=len(connected_ws_clients))
+
+
+def encode_ws_message(payload: dict, codec: str) -> str | bytes:
+    """JSON - текстовым кадром (как раньше), MessagePack - бинарным."""
+    return json.dumps(payload) if codec == CODEC_JSON else encode_message(payload, codec)
+
+async def ws_handle_client_message(websocket, message: str | bytes):
+    try:
+        client_message = decode_message(message)
+    except ValueError:
+        server_log.warning("WS", "ws.invalid_message", "Неверные данные от {addr}: {data!r}", addr=websocket.remote_address, data=message[:100])
+        return
+    if not isinstance(client_message, dict):
+        return
+    if client_message.get("action") == "ws_identify":
+        await ws_identify(websocket, client_message)
+    elif client_message.get("action") in ("subscribe", "unsubscribe"):
+        await ws_handle_subscription(websocket, client_message)
+    elif client_message.get("action") == "event_history":
+        await ws_handle_event_history(websocket, client_message)
+    elif client_message.get("action") == "ws_test_broadcast" and WS_TEST_HOOKS and ws_scheduler is not None:
+        server_log.info("WS", "ws.test_broadcast", "Рассылка запрошена тестовым хуком от {addr}", addr=websocket.remote_address)
+        producers = client_message.get("producers")
+        ws_scheduler.fire_now(producers if isinstance(producers, list) else None)
+
+async def ws_identify(websocket, client_message: dict):
+    """Согласование кодека и привязка соединения к TCP сессии (если session_id живой)."""
+    reply = {"type": "ws_identified"}
+    if "accept_codecs" in client_message:
+        codec = choose_codec(client_message["accept_codecs"])
+        ws_client_codecs[websocket] = codec
+        reply["codec"] = codec
+    session_id = client_message.get("session_id")
+    if session_id:
+        session = None
+        if isinstance(session_id, str):
+            session = (await asyncio.get_running_loop().run_in_executor(None, active_sessions.touch, session_id)
+                       if SESSION_CALLS_BLOCK else active_sessions.touch(session_id))
+        if session is not None:
+            ws_bind_session(websocket, session_id)
+            reply["session_id"] = session_id
+        else:
+            reply["session_error"] = "Unknown or expired session_id."
+    reply["session_bound"] = websocket in ws_client_sessions
+    if client_message.get("accept_batch"):
+        ws_batch_clients.add(websocket)
+    reply["batch"] = WS_BATCH_WINDOW_SECONDS > 0 and websocket in ws_batch_clients
+    reply["epoch"] = ws_event_epoch
+    reply["current_seq"] = ws_last_event_seq
+    await websocket.send(json.dumps(reply)) # Ответ всегда JSON: клиент еще не знает кодек
+    if "last_seq" in client_message:
+        await ws_replay_events(websocket, client_message["last_seq"], client_message.get("epoch"))
+    elif ws_take_hold(websocket):
+        await ws_catch_up(websocket, ws_client_first_live_seq[websocket])
+
+def ws_take_hold(websocket) -> bool:
+    """Снимает таймер удержания. True - соединение еще не получает рассылку и догонять его теперь вызывающему."""
+    hold = ws_held_clients.get(websocket)
+    if hold is None:
+        return False # Не удерживается или уже догоняет
+    hold.cancel()
+    ws_held_clients[websocket] = None # Рассылка по-прежнему пропускает соединение до конца ws_catch_up
+    return True
+
+def ws_hold_expired(websocket):
+    """Клиент не прислал ws_identify за WS_REPLAY_HOLD_SECONDS: догоняем его события за это время."""
+    if ws_take_hold(websocket):
+        asyncio.create_task(ws_catch_up_after_hold(websocket))
+
+async def ws_catch_up_after_hold(websocket):
+    try:
+        await ws_catch_up(websocket, ws_client_first_live_seq.get(websocket, ws_last_event_seq + 1))
+    except websockets.ConnectionClosed: # type: ignore
+        pass # Отключение доделает ws_unregister_client
+
+async def ws_catch_up(websocket, from_seq: int, replay: bool = False) -> int:
+    """Отправляет удерживаемому соединению события буфера с seq >= from_seq (с учетом подписок), пока не догонит
+    рассылку, и включает ему рассылку. replay - ответ на last_seq: такие события помечены "replayed", после них
+    replay_complete. Возвращает число повторенных событий."""
+    codec = ws_client_codecs.get(websocket, CODEC_JSON)
+    next_seq, replayed, replaying = from_seq, 0, replay
+    while True:
+        oldest_seq = server_event_cache[0]["seq"] if server_event_cache else ws_last_event_seq + 1
+        events = [event for event in islice(server_event_cache, max(0, next_seq - oldest_seq), None)
+                  if ws_subscriptions.is_subscribed(websocket, event["type"], event.get("region"))]
+        next_seq = ws_last_event_seq + 1
+        if events:
+            for event in events:
+                await websocket.send(encode_ws_message({**event, "replayed": True} if replaying else event, codec))
+            replayed += len(events) if replaying else 0
+        elif replaying:
+            # Опубликованное во время отправки replay_complete уйдет следующим проходом - уже без пометки
+            replaying = False
+            await websocket.send(encode_ws_message({"type": "replay_complete", "replayed": replayed, "current_seq": next_seq - 1}, codec))
+        else:
+            break
+    # От проверки буфера выше досюда нет await: следующее событие это соединение получит уже рассылкой
+    ws_held_clients.pop(websocket, None)
+    ws_client_first_live_seq[websocket] = ws_last_event_seq + 1 # Ожидающие пакетного окна уже отправлены здесь
+    return replayed
 
+async def ws_replay_events(websocket, last_seq, epoch):
+    """Повторяет события с seq > last_seq из кольцевого буфера (с учетом подписок), затем replay_complete.
+    Если часть пропущенного уже вытеснена из буфера или seq от другого запуска сервера - сначала replay_gap.
+    Живые события соединение начинает получать только после replay_complete (ws_catch_up)."""
+    if not isinstance(last_seq, int) or isinstance(last_seq, bool) or last_seq < 0:
+        if ws_take_hold(websocket):
+            await ws_catch_up(websocket, ws_client_first_live_seq[websocket])
+        return
+    codec = ws_client_codecs.get(websocket, CODEC_JSON)
+    oldest_seq = server_event_cache[0]["seq"] if server_event_cache else ws_last_event_seq + 1
+    replay_from_seq = last_seq + 1
+    gap_reason = None
+    if epoch is not None and epoch != ws_event_epoch:
+        gap_reason = "server_restarted"
+        replay_from_seq = 1
+    if replay_from_seq < oldest_seq:
+        gap_reason = gap_reason or "gap_too_large"
+    if gap_reason:
+        # Клиент пропустил больше, чем хранит буфер: повторяем то, что есть, но предупреждаем о потере
+        await websocket.send(encode_ws_message({"type": "replay_gap", "reason": gap_reason, "last_seq": last_seq,
+                                                "oldest_seq": oldest_seq, "current_seq": ws_last_event_seq}, codec))
+    if ws_take_hold(websocket):
+        replayed = await ws_catch_up(websocket, replay_from_seq, replay=True)
+        server_log.debug("WS", "ws.replay", "Клиенту {addr} повторено {count} событий после seq {last_seq}",
+                         addr=websocket.remote_address, count=replayed, last_seq=last_seq)
+        return
+    # Повторный ws_identify, когда рассылка соединению уже идет. Снимок до первого await: буфер пополняется
+    # рассылкой. События, пришедшие рассылкой (seq >= first_live_seq), не повторяются - каждое событие
+    # доставляется ровно один раз.
+    first_live_seq = ws_client_first_live_seq.get(websocket, ws_last_event_seq + 1)
+    missed_events = [event for event in islice(server_event_cache, max(0, replay_from_seq - oldest_seq), None)
+                     if event["seq"] < first_live_seq and ws_subscriptions.is_subscribed(websocket, event["type"], event.get("region"))]
+    for event in missed_events:
+        await websocket.send(encode_ws_message({**event, "replayed": True}, codec))
+    await websocket.send(encode_ws_message({"type": "replay_complete", "replayed": len(missed_events), "current_seq": ws_last_event_seq}, codec))
+    server_log.debug("WS", "ws.replay", "Клиенту {addr} повторено {count} событий после seq {last_seq}",
+                     addr=websocket.remote_address, count=len(missed_events), last_seq=last_seq)
 
-async def ws_message_handler(websocket, path):
+def ws_bind_session(websocket, session_id: str):
+    ws_unbind_session(websocket) # Повторный ws_identify с другой сессией перепривязывает соединение
+    ws_session_clients.setdefault(session_id, set()).add(websocket)
+    ws_client_sessions[websocket] = session_id
+
+def ws_unbind_session(websocket):
+    session_id = ws_client_sessions.pop(websocket, None)
+    if session_id is None:
+        return
+    session_clients = ws_session_clients.get(session_id)
+    if session_clients is not None:
+        session_clients.discard(websocket)
+        if not session_clients:
+            del ws_session_clients[session_id]
+
+def is_session_connected_ws(session_id: str | None) -> bool:
+    """Присутствие: есть ли у сессии WS соединение (можно вызывать из любого потока)."""
+    return bool(session_id) and bool(ws_session_clients.get(session_id))
+
+def ws_push_to_session(session_id: str, payload: dict) -> int:
+    """Адресное сообщение соединениям одной сессии - O(1) поиск вместо рассылки всем. Только из цикла событий WS."""
+    clients_by_codec: dict[str, list] = {}
+    for client in ws_session_clients.get(session_id, ()):
+        clients_by_codec.setdefault(ws_client_codecs.get(client, CODEC_JSON), []).append(client)
+    for codec, clients in clients_by_codec.items():
+        websockets.broadcast(clients, encode_ws_message(payload, codec)) # type: ignore
+    return sum(len(clients) for clients in clients_by_codec.values())
+
+def push_to_session_threadsafe(session_id: str | None, payload: dict) -> bool:
+    """Ставит адресное сообщение в цикл событий WS из потока TCP. False - сессия не подключена по WS."""
+    if ws_event_loop is None or not is_session_connected_ws(session_id):
+        return False
+    ws_event_loop.call_soon_threadsafe(ws_push_to_session, session_id, payload)
+    return True
+
+async def ws_handle_subscription(websocket, client_message: dict):
+    action = client_message["action"]
+    try:
+        if action == "subscribe":
+            subscription = ws_subscriptions.subscribe(websocket, client_message.get("topics"), client_message.get("regions"))
+        else:
+            subscription = ws_subscriptions.unsubscribe(websocket, client_message.get("topics"), client_message.get("regions"))
+    except SubscriptionError as e_subscription:
+        reply = {"type": "subscription_error", "action": action, "message": str(e_subscription)}
+    else:
+        server_log.debug("WS", "ws.subscription", "Подписка {addr}: {subscription}", addr=websocket.remote_address, subscription=subscription)
+        reply = {"type": "subscribed", "subscriptions": subscription}
+    await websocket.send(encode_ws_message(reply, ws_client_codecs.get(websocket, CODEC_JSON)))
+
+def parse_event_history_request(client_message: dict) -> tuple:
+    """Проверяет запрос истории: (тип | None, from_ts, to_ts, limit, after_seq). ValueError - неверный запрос."""
+    event_type = client_message.get("type")
+    if event_type is not None and event_type not in WS_TOPICS:
+        raise ValueError(f"Неизвестный тип события: {event_type!r}. Доступны: {list(WS_TOPICS)}")
+    values = []
+    for field, default in (("from_ts", 0.0), ("to_ts", time.time()), ("limit", 100), ("after_seq", 0)):
+        value = client_message.get(field, default)
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+            raise ValueError(f"{field} должен быть неотрицательным числом")
+        values.append(value)
+    from_ts, to_ts, limit, after_seq = values
+    return event_type, float(from_ts), float(to_ts), max(1, min(int(limit), WS_HISTORY_MAX_PAGE)), int(after_seq)
+
+async def ws_handle_event_history(websocket, client_message: dict):
+    """Страница истории событий из журнала. Чтение с диска - в пуле потоков, цикл событий не блокируется.
+    next_after_seq в ответе - курсор следующей страницы (None - страниц больше нет)."""
+    codec = ws_client_codecs.get(websocket, CODEC_JSON)
+    reply = {"type": "event_history", "request_id": client_message.get("request_id")}
+    if event_log is None:
+        reply["error"] = "Журнал событий выключен на сервере."
+    else:
+        try:
+            event_type, from_ts, to_ts, limit, after_seq = parse_event_history_request(client_message)
+            events, next_after_seq = await asyncio.get_running_loop().run_in_executor(
+                None, event_log.query, event_type, from_ts, to_ts, limit, after_seq)
+        except (ValueError, OSError) as e_history:
+            reply["error"] = str(e_history)
+        else:
+            reply["events"] = events
+            reply["next_after_seq"] = next_after_seq
+    await websocket.send(encode_ws_message(reply, codec))
+
+async def ws_message_handler(websocket, path=None): # path передают только старые версии websockets
     await ws_register_client(websocket)
     try:
-        # Можно добавить обработку входящих сообщений от клиента, если нужно
-        # Например, клиент может отправить свой session_id для идентификации
-        # async for message in websocket:
-        #     print(f"[WS] Получено от {websocket.remote_address}: {message[:100]}")
-        #     # Тут может быть логика привязки WebSocket к TCP сессии по session_id
-        
-        # Держим соединение открытым для получения broadcast'ов
-        # Клиент должен поддерживать пинг/понг или периодически слать что-то, чтобы сервер его не закрыл по таймауту
-        while True:
-            await asyncio.sleep(3600) # Просто спим, ожидая broadcast или закрытия соединения
+        # Входящие сообщения клиента (ws_identify, subscribe/unsubscribe); рассылки идут из broadcast_server_events
+        async for message in websocket:
+            await ws_handle_client_message(websocket, message)
     except websockets.ConnectionClosedError as cce: # type: ignore
-        print(f"[WS] Соединение с {websocket.remote_address} закрыто с ошибкой: {cce.reason} (код {cce.code})")
+        server_log.info("WS", "ws.closed_error", "Соединение с {addr} закрыто с ошибкой: {reason} (код {code})", addr=websocket.remote_address, reason=cce.reason, code=cce.code)
     except websockets.ConnectionClosedOK: # type: ignore
-        print(f"[WS] Соединение с {websocket.remote_address} закрыто корректно.")
+        server_log.debug("WS", "ws.closed", "Соединение с {addr} закрыто корректно.", addr=websocket.remote_address)
     except Exception as e_ws_handler:
-        print(f"[WS] Ошибка в обработчике WebSocket для {websocket.remote_address}: {e_ws_handler}")
+        server_log.error("WS", "ws.handler_error", "Ошибка в обработчике WebSocket для {addr}: {error}", addr=websocket.remote_address, error=e_ws_handler)
     finally:
         await ws_unregister_client(websocket)
 
 
+def ws_publish_event(payload: dict) -> list:
+    """Нумерует событие, кладет в кольцевой буфер повтора (и в журнал, если включен) и рассылает подписчикам.
+    В пакетном режиме событие ждет конца окна (ws_flush_batch) и возвращается пустой список клиентов."""
+    global ws_batch_flush_handle
+    global ws_last_event_seq
+    ws_last_event_seq += 1
+    payload["seq"] = ws_last_event_seq
+    server_event_cache.append(payload) # deque(maxlen) вытесняет самое старое событие
+    if event_log is not None:
+        try:
+            event_log.append(payload)
+        except OSError as e_event_log: # Диск не должен останавливать живую рассылку
+            server_log.error("WS", "ws.event_log_error", "Не удалось записать событие {seq} в журнал: {error}", seq=ws_last_event_seq, error=e_event_log)
+    ws_cycle_stats.record_events()
+    if WS_BATCH_WINDOW_SECONDS > 0:
+        ws_pending_batch.append(payload)
+        if ws_batch_flush_handle is None:
+            ws_batch_flush_handle = asyncio.get_running_loop().call_later(WS_BATCH_WINDOW_SECONDS, ws_flush_batch)
+        return []
+    return ws_broadcast(payload)
+
+def ws_broadcast(payload: dict) -> list:
+    """Пишет payload подписчикам его типа и региона без ожидания отправки. Возвращает клиентов рассылки."""
+    clients_by_codec: dict[str, list] = {}
+    for client in ws_subscriptions.recipients(payload["type"], payload.get("region")):
+        if client in ws_held_clients:
+            continue # Получит событие из буфера повтора, догоняя рассылку (ws_catch_up)
+        clients_by_codec.setdefault(ws_client_codecs.get(client, CODEC_JSON), []).append(client)
+    fanout_started_at = time.perf_counter()
+    for codec, clients in clients_by_codec.items():
+        # Сообщение кодируется один раз на кодек; закрытые соединения broadcast пропускает сам
+        ws_send_frame(clients, encode_ws_message(payload, codec), ws_conflation_key(payload))
+    ws_broadcast_fanout.observe(time.perf_counter() - fanout_started_at)
+    return [client for clients in clients_by_codec.values() for client in clients]
+
+def ws_flush_batch() -> list:
+    """Рассылает события окна: клиенту с accept_batch - одним кадром, остальным - по кадру на событие.
+    Клиенты с одинаковым набором событий и кодеком получают один и тот же закодированный кадр."""
+    global ws_batch_flush_handle
+    ws_batch_flush_handle = None
+    events = list(ws_pending_batch)
+    ws_pending_batch.clear()
+    events_by_client: dict = {}
+    for index, event in enumerate(events):
+        for client in ws_subscriptions.recipients(event["type"], event.get("region")):
+            # Подключившиеся после публикации события и еще догоняющие получат его из буфера (ws_catch_up), не здесь
+            if ws_client_first_live_seq.get(client, 0) <= event["seq"] and client not in ws_held_clients:
+                events_by_client.setdefault(client, []).append(index)
+    clients_by_frames: dict[tuple, list] = {}
+    for client, indices in events_by_client.items():
+        batched = len(indices) > 1 and client in ws_batch_clients
+        clients_by_frames.setdefault((ws_client_codecs.get(client, CODEC_JSON), batched, tuple(indices)), []).append(client)
+    fanout_started_at = time.perf_counter()
+    encoded_events: dict[tuple, str | bytes] = {}
+    for (codec, batched, indices), clients in clients_by_frames.items():
+        if batched:
+            ws_send_frame(clients, encode_ws_message({"type": "batch", "events": [events[i] for i in indices]}, codec))
+            continue
+        for i in indices:
+            if (codec, i) not in encoded_events:
+                encoded_events[codec, i] = encode_ws_message(events[i], codec)
+            ws_send_frame(clients, encoded_events[codec, i], ws_conflation_key(events[i]))
+    if events_by_client:
+        ws_broadcast_fanout.observe(time.perf_counter() - fanout_started_at)
+    broadcast_clients = list(events_by_client)
+    if broadcast_clients and not WS_CLIENT_OUTBOX:
+        asyncio.create_task(ws_evict_after_deadline(broadcast_clients))
+    ws_finish_broadcast_cycle()
+    return broadcast_clients
+
+def ws_send_frame(clients: list, message: str | bytes, conflate_key: tuple | None = None):
+    """Один кадр всем clients без ожидания отправки, с учетом в статистике цикла рассылки.
+    conflate_key - ключ слияния в очереди отстающего клиента (только при --ws-outbox)."""
+    if WS_CLIENT_OUTBOX:
+        ws_deliver_via_outboxes(clients, message, conflate_key)
+    else:
+        websockets.broadcast(clients, message) # type: ignore
+    frame = message.encode("utf-8") if isinstance(message, str) else message
+    ws_cycle_stats.record_frame(clients, len(frame), ws_deflate_size_estimate(frame))
+    if WS_LEAN_CONNECTIONS:
+        send_budget = ws_send_budget_bytes()
+        for client in [client for client in clients if ws_send_buffer_size(client) > send_budget]:
+            ws_evict_slow_client(client, f"буфер отправки больше бюджета {send_budget} байт")
+
+def ws_conflation_key(payload: dict) -> tuple | None:
+    """data_update сливаются по теме и региону: обновление другого региона - другое значение."""
+    if payload.get("type") != "data_update" or not isinstance(payload.get("content"), dict):
+        return None
+    return payload["content"].get("topic"), payload.get("region")
+
+def ws_deliver_via_outboxes(clients: list, message: str | bytes, conflate_key: tuple | None):
+    """Клиентам без очереди и с почти пустым буфером - сразу, отстающим - в их очередь отправки."""
+    direct_clients = []
+    for client in clients:
+        outbox = ws_outboxes.get(client)
+        if outbox is None:
+            if ws_send_buffer_size(client) <= WS_OUTBOX_DIRECT_WRITE_BYTES:
+                direct_clients.append(client)
+                continue
+            if client not in connected_ws_clients:
+                continue # Уже отключен (переполнение очереди), ждет ws_unregister_client
+            outbox = ws_outboxes[client] = ClientOutbox(WS_OUTBOX_MAX_KEPT)
+        result = outbox.put(message, conflate_key)
+        if result == OUTBOX_OVERFLOW:
+            ws_outbox_overflows.inc()
+            del ws_outboxes[client]
+            if outbox.writer is not None:
+                outbox.writer.cancel()
+            ws_evict_slow_client(client, f"в очереди отправки больше {WS_OUTBOX_MAX_KEPT} неслиянных сообщений")
+            continue
+        if result == OUTBOX_CONFLATED:
+            ws_conflated_messages.inc()
+        if outbox.writer is None:
+            outbox.writer = asyncio.create_task(ws_outbox_writer(client, outbox))
+    websockets.broadcast(direct_clients, message) # type: ignore
+
+async def ws_outbox_writer(websocket, outbox: ClientOutbox):
+    """Разбирает очередь одного клиента. send() ждет, пока сокет примет данные, - ждет только этот клиент."""
+    try:
+        while outbox:
+            await websocket.send(outbox.pop())
+    except websockets.ConnectionClosed: # type: ignore
+        pass # Снимет с учета ws_unregister_client
+    finally:
+        if ws_outboxes.get(websocket) is outbox:
+            del ws_outboxes[websocket] # Очередь пуста - следующие кадры снова пойдут напрямую
+
+def ws_deflate_size_estimate(frame: bytes) -> int | None:
+    """Размер кадра после permessage-deflate без учета контекста прошлых сообщений (оценка сверху).
+    Сжимается только каждый WS_DEFLATE_SAMPLE_EVERY-й кадр, остальные оцениваются по коэффициенту выборки."""
+    global ws_deflate_frames, ws_deflate_ratio
+    if WS_COMPRESSION == "none":
+        return None
+    ws_deflate_frames += 1
+    if ws_deflate_ratio is not None and ws_deflate_frames % WS_DEFLATE_SAMPLE_EVERY:
+        return round(len(frame) * ws_deflate_ratio)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -WS_DEFLATE_WINDOW_BITS, 5)
+    deflate_bytes = len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 # Хвост 00 00 ff ff не передается
+    ratio = deflate_bytes / max(1, len(frame))
+    ws_deflate_ratio = ratio if ws_deflate_ratio is None else 0.8 * ws_deflate_ratio + 0.2 * ratio
+    return deflate_bytes
+
+def ws_finish_broadcast_cycle():
+    """Пишет итоги цикла рассылки: кадры и байты на клиента. В пакетном режиме цикл завершает отправка окна."""
+    if ws_batch_flush_handle is not None:
+        return # Цикл завершит отправка окна
+    cycle = ws_cycle_stats.finish_cycle()
+    if cycle["clients"]:
+        server_log.info("WS Broadcast", "ws.cycle", "Цикл рассылки: событий {events}, клиентов {clients}, кадров {frames_per_client} "
+                        "и {bytes_per_client} байт на клиента (сжатие {compression}: ~{deflate_bytes_per_client_estimate})", compression=WS_COMPRESSION, **cycle)
+
+def ws_compression_options() -> dict:
+    """Аргументы websockets.serve для выбранного режима permessage-deflate."""
+    if WS_COMPRESSION == "none":
+        return {"compression": None}
+    return {"compression": None, "extensions": [ServerPerMessageDeflateFactory(
+        server_no_context_takeover=WS_COMPRESSION == "deflate-no-context",
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS, client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={"memLevel": 5})]}
+
+def ws_connection_limits() -> dict:
+    """Аргументы websockets.serve для экономного режима: ограничения входящих сообщений и их очереди."""
+    if not WS_LEAN_CONNECTIONS:
+        return {}
+    return {"max_size": WS_LEAN_MAX_MESSAGE_BYTES, "max_queue": WS_LEAN_MAX_QUEUE}
+
+def ws_send_budget_bytes() -> int:
+    """Часть бюджета памяти соединения, оставшаяся на буфер отправки."""
+    return WS_CONNECTION_MEMORY_BUDGET_BYTES - WS_LEAN_MAX_MESSAGE_BYTES * WS_LEAN_MAX_QUEUE
+
+def ws_memory_report() -> dict:
+    """Оценка памяти на соединение: прирост RSS с запуска WS сервера, деленный на число соединений.
+    Точна для простаивающих соединений после их подключения; освобожденную память Python обычно
+    не возвращает системе, поэтому после массовых отключений оценка завышена."""
+    connections = len(connected_ws_clients)
+    rss_bytes = process_rss_bytes()
+    growth_bytes = rss_bytes - ws_baseline_rss_bytes if rss_bytes is not None and ws_baseline_rss_bytes is not None else None
+    return {
+        "lean": WS_LEAN_CONNECTIONS,
+        "connections": connections,
+        "rss_bytes": rss_bytes,
+        "baseline_rss_bytes": ws_baseline_rss_bytes,
+        "avg_bytes_per_connection": round(growth_bytes / connections) if growth_bytes is not None and connections else None,
+        "budget_bytes": WS_CONNECTION_MEMORY_BUDGET_BYTES if WS_LEAN_CONNECTIONS else None,
+        "send_buffer_bytes": sum(ws_send_buffer_size(client) for client in list(connected_ws_clients)),
+    }
+
+def ws_send_buffer_size(websocket) -> int:
+    transport = getattr(websocket, "transport", None)
+    return transport.get_write_buffer_size() if transport is not None else 0
+
+def ws_evict_slow_client(websocket, reason: str | None = None):
+    """Отключает клиента, не принявшего рассылку за дедлайн (или вышедшего за бюджет памяти). Закрывающее
+    рукопожатие с зависшим клиентом тоже не завершится, поэтому соединение обрывается сразу."""
+    connected_ws_clients.discard(websocket)
+    ws_evicted_clients.inc()
+    server_log.warning("WS", "ws.evicted", "Клиент {addr} отключен: {reason} ({pending} байт в буфере)",
+                       addr=websocket.remote_address, reason=reason or f"не принял рассылку за {WS_SEND_DEADLINE_SECONDS} с",
+                       pending=ws_send_buffer_size(websocket))
+    transport = getattr(websocket, "transport", None)
+    if transport is not None:
+        transport.abort() # ws_message_handler получит разрыв и снимет клиента с учета
+
+def ws_send_buffer_high_water(websocket) -> int:
+    """Верхняя отметка буфера отправки транспорта: выше нее websockets уже ждет слива перед записью."""
+    transport = getattr(websocket, "transport", None)
+    return transport.get_write_buffer_limits()[1] if transport is not None else 0
+
+async def ws_evict_after_deadline(clients: list) -> int:
+    """Через дедлайн отключает клиентов рассылки, которые ее не принимают: буфер отправки выше верхней отметки
+    или не уменьшился с момента рассылки. Клиент, который медленно, но разбирает буфер, остается."""
+    buffered_at_send = {client: buffered for client in clients if (buffered := ws_send_buffer_size(client))}
+    await asyncio.sleep(WS_SEND_DEADLINE_SECONDS)
+    slow_clients = []
+    for client in clients:
+        if client not in connected_ws_clients:
+            continue
+        buffered = ws_send_buffer_size(client)
+        if buffered > ws_send_buffer_high_water(client) or buffered >= buffered_at_send.get(client, buffered + 1):
+            slow_clients.append(client)
+    for client in slow_clients:
+        ws_evict_slow_client(client)
+    return len(slow_clients)
+
+def produce_day_event() -> dict:
+    """Производитель "события дня" (Пункт 7)."""
+    return {
+        "type": "day_event",
+        "event_name": f"Редкий артефакт #{int(time.time() % 1000)} обнаружен!",
+        "description": f"В локации '{random.choice(['Забытые Руины', 'Лес Теней', 'Хрустальная Пещера'])}' появился {random.choice(['Могущественный артефакт', 'Древний свиток', 'Зачарованный кристалл'])}.",
+        "timestamp_event": time.time(), # Используем другое имя, чтобы не конфликтовать с timestamp сообщения
+        "region": random.choice(SERVER_REGIONS) if SERVER_REGIONS else None # Получат подписчики региона и подписчики "всех регионов"
+    }
+
+def produce_data_update(topic: str) -> dict:
+    """Производитель "данных, которые меняются" (Пункт 4) по одной теме: погода, экономика, монстры."""
+    return {
+        "type": "data_update",
+        "source": "server_generator",
+        "content": {
+            "topic": topic,
+            "value": random.randint(1, 100),
+            "details": f"Последнее обновление {time.strftime('%H:%M:%S')}"
+        },
+        "timestamp_update": time.time(),
+        "region": random.choice(SERVER_REGIONS) if SERVER_REGIONS else None
+    }
+
+WS_EVENT_PRODUCER_FUNCTIONS = {
+    "day_event": produce_day_event,
+    "weather": functools.partial(produce_data_update, "Погода"),
+    "economy": functools.partial(produce_data_update, "Экономика игры"),
+    "monsters": functools.partial(produce_data_update, "Активность монстров"),
+}
+
+def ws_publish_scheduled_event(payload: dict):
+    # Отправка всем сразу: медленный клиент не задерживает остальных, а после дедлайна отключается
+    # (с --ws-outbox вместо дедлайна - очередь клиента со слиянием)
+    broadcast_clients = ws_publish_event(payload)
+    if broadcast_clients and not WS_CLIENT_OUTBOX:
+        asyncio.create_task(ws_evict_after_deadline(broadcast_clients))
+
 async def broadcast_server_events():
-    """Генерирует и рассылает "события дня" и другие данные всем WebSocket клиентам."""
-    global server_event_cache
-    while True:
-        # Генерация "события дня" (Пункт 7)
-        day_event_payload = {
-            "type": "day_event",
-            "event_name": f"Редкий артефакт #{int(time.time() % 1000)} обнаружен!",
-            "description": f"В локации '{random.choice(['Забытые Руины', 'Лес Теней', 'Хрустальная Пещера'])}' появился {random.choice(['Могущественный артефакт', 'Древний свиток', 'Зачарованный кристалл'])}.",
-            "timestamp_event": time.time() # Используем другое имя, чтобы не конфликтовать с timestamp сообщения
-        }
-        server_event_cache.append({"timestamp": time.time(), "event": day_event_payload}) # Добавляем в серверный кэш
-        if len(server_event_cache) > MAX_SERVER_CACHE_SIZE:
-            server_event_cache.pop(0)
-        
-        message_to_send_day_event = json.dumps(day_event_payload)
-
-        # Генерация "данных, которые меняются" (Пункт 4)
-        # Пример: информация о погоде в случайном городе или "игровые новости"
-        changing_data_payload = {
-            "type": "data_update",
-            "source": "server_generator",
-            "content": {
-                "topic": random.choice(["Погода", "Экономика игры", "Активность монстров"]),
-                "value": random.randint(1, 100),
-                "details": f"Последнее обновление {time.strftime('%H:%M:%S')}"
-            },
-            "timestamp_update": time.time()
-        }
-        message_to_send_data_update = json.dumps(changing_data_payload)
-
-        # Копируем сет клиентов перед итерацией
-        clients_snapshot = list(connected_ws_clients)
-        if clients_snapshot:
-            print(f"[WS Broadcast] Отправка {len(clients_snapshot)} клиентам...")
-            # Рассылаем событие дня
-            # await websockets.broadcast(clients_snapshot, message_to_send_day_event) # Удобно, но менее гибко с обработкой ошибок
-            for client in clients_snapshot:
-                try:
-                    await client.send(message_to_send_day_event)
-                except Exception: pass # Ошибки обработаются в ws_message_handler при разрыве
-
-            await asyncio.sleep(5) # Небольшая пауза между типами сообщений
-
-            # Рассылаем обновляемые данные
-            for client in clients_snapshot: # Используем тот же снепшот
-                try:
-                    await client.send(message_to_send_data_update)
-                except Exception: pass
-        
-        # Интервал для "данные меняются каждые 1-5 минут"
-        await asyncio.sleep(random.randint(60, 300)) # 1-5 минут
+    """Рассылает события производителей WS_EVENT_PRODUCERS по их расписанию (server/event_scheduler.py)."""
+    global ws_scheduler
+    ws_scheduler = EventScheduler(ws_publish_scheduled_event, on_tick=ws_finish_broadcast_cycle)
+    for name, (period_seconds, jitter_seconds) in WS_EVENT_PRODUCERS.items():
+        ws_scheduler.add_producer(EventProducer(name, WS_EVENT_PRODUCER_FUNCTIONS[name], period_seconds, jitter_seconds))
+    # События нумеруются и попадают в буфер повтора, даже если сейчас никто не подключен
+    await ws_scheduler.run()
 
 async def run_websocket_server():
+    global ws_event_loop, ws_event_epoch, ws_baseline_rss_bytes
+    ws_event_loop = asyncio.get_running_loop()
+    ws_baseline_rss_bytes = process_rss_bytes()
+    if event_log is not None:
+        ws_event_epoch = event_log.epoch # seq продолжаются между запусками - повтор переживает перезапуск
+    else:
+        ws_event_epoch = f"{os.getpid()}-{int(time.time())}" # Задается здесь, а не при импорте: у воркеров свой pid
     # Запускаем фоновую задачу для рассылки событий
     asyncio.create_task(broadcast_server_events())
     
     # Запускаем сервер для приема подключений
     # ping_interval и ping_timeout помогают поддерживать соединение живым и обнаруживать разрывы
-    async with websockets.serve(ws_message_handler, WS_HOST, WS_PORT, ping_interval=20, ping_timeout=20): # type: ignore
-        print(f"[WebSocket] Сервер запущен на {WS_HOST}:{WS_PORT}...")
+    async with websockets.serve(ws_message_handler, WS_HOST, WS_PORT, ping_interval=20, ping_timeout=20, reuse_port=SOCKET_REUSE_PORT,
+                                **ws_compression_options(), **ws_connection_limits()): # type: ignore
+        print(f"[WebSocket] Сервер запущен на {WS_HOST}:{WS_PORT} (сжатие: {WS_COMPRESSION}, пакеты: "
+              f"{f'окно {WS_BATCH_WINDOW_SECONDS} с' if WS_BATCH_WINDOW_SECONDS > 0 else 'выключены'}"
+              f"{f', экономные соединения: бюджет {WS_CONNECTION_MEMORY_BUDGET_BYTES} байт' if WS_LEAN_CONNECTIONS else ''})...")
         await asyncio.Future()  # Держит сервер работающим "вечно"
 
 
 # ========================
 # UDP Server (гео-подсказки)
 # ========================
+def process_location_datagram(raw_data_udp: bytes, addr_udp) -> bytes | None:
+    """Геолокация из датаграммы -> закодированный ответ с подсказкой (None - отбросить без ответа)."""
+    hint = location_hint(raw_data_udp, addr_udp)
+    if hint is None:
+        return None
+    hint_message, reply_codec = hint
+    return encode_message({"hint": hint_message, "timestamp": time.time()}, reply_codec)
+
+def location_coordinates(location_payload: dict) -> tuple[float, float] | None:
+    """(широта, долгота) из геолокации; None - координаты не заданы или вне допустимых пределов."""
+    latitude, longitude = location_payload.get("latitude"), location_payload.get("longitude")
+    if not all(isinstance(value, (int, float)) and math.isfinite(value) for value in (latitude, longitude)):
+        return None
+    if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+        return None
+    return float(latitude), float(longitude)
+
+def poi_hint_text(latitude: float, longitude: float) -> str | None:
+    """Ближайшие к координатам POI для подсказки ("Старый маяк (120 м). ..."); None - рядом ничего нет или POI не загружены."""
+    poi_index = poi_dataset.index if poi_dataset is not None else None # Одна ссылка на запрос: перезагрузка ее не меняет
+    if poi_index is None:
+        return None
+    nearby = poi_index.nearest(latitude, longitude, POI_HINT_COUNT, POI_HINT_RADIUS_METERS)
+    if not nearby:
+        return None
+    distance_m, nearest_poi = nearby[0]
+    hint_text = f"{poi_index.name(nearest_poi)} ({distance_m:.0f} м)."
+    poi_hint = poi_index.hint(nearest_poi)
+    if poi_hint:
+        hint_text += f" {poi_hint}"
+    if len(nearby) > 1:
+        hint_text += " Также поблизости: " + ", ".join(f"{poi_index.name(poi)} ({distance_m:.0f} м)" for distance_m, poi in nearby[1:]) + "."
+    return hint_text
+
+def location_hint(raw_data_udp: bytes, addr_udp) -> tuple[str, str] | None:
+    """Геолокация из датаграммы -> (текст подсказки, кодек ответа); None - отбросить без ответа.
+    Общая для обоих режимов UDP; потокобезопасна (лимитеры и хранилище сессий - под своими замками)."""
+    udp_received_datagrams.inc()
+    try:
+        if rate_limiters["udp_ip"].acquire(addr_udp[0]):
+            return None # Отбрасываем до разбора данных
+        if is_packed_location(raw_data_udp): # Двоичная геолокация (shared/codec.py) - отвечаем в MessagePack
+            location_payload = decode_location(raw_data_udp)
+            reply_codec = CODEC_MSGPACK
+        else:
+            location_payload = decode_message(raw_data_udp)
+            reply_codec = detect_codec(raw_data_udp)
+        server_log.debug("UDP", "udp.location", "Получена геолокация от {addr}: {payload}", addr=addr_udp, payload=location_payload)
+
+        client_session_id_udp = location_payload.get("session_id")
+        if not is_valid_session_id(client_session_id_udp):
+            client_session_id_udp = None # Подсказка без сессии, как для датаграммы без session_id
+        if client_session_id_udp and rate_limiters["udp_session"].acquire(client_session_id_udp):
+            return None
+        session_udp = active_sessions.touch(client_session_id_udp) # Обновляем сессию
+        coordinates = location_coordinates(location_payload)
+        poi_hint = poi_hint_text(*coordinates) if coordinates is not None else None
+        if session_udp is not None:
+            if coordinates is not None and location_history is not None:
+                location_history.record(client_session_id_udp, time.time(), *coordinates)
+            user_name_for_hint = session_udp.get("user_name", "Игрок")
+            if poi_hint is not None:
+                hint_message = f"{user_name_for_hint}, рядом {poi_hint}"
+            else:
+                hint_message = f"{user_name_for_hint}, вы рядом с древним обелиском. Будьте осторожны!"
+        elif poi_hint is not None:
+            hint_message = f"Рядом {poi_hint}"
+        else:
+            hint_message = "Вы находитесь в неизведанной территории. Осторожнее!"
+        return hint_message, reply_codec
+
+    except ValueError: # JSONDecodeError и CodecError
+        server_log.warning("UDP", "udp.invalid", "Ошибка: Неверные данные от {addr}. Данные: '{data}'", addr=addr_udp, data=raw_data_udp.decode(errors='ignore'))
+    except Exception as e_udp:
+        server_log.error("UDP", "udp.error", "Ошибка при обработке UDP запроса от {addr}: {error}", addr=addr_udp or "неизвестного источника", error=e_udp)
+    return None
+
+def udp_socket_drops() -> int | None:
+    """Датаграммы, отброшенные ядром на сокетах порта UDP_PORT (переполнен буфер приема); None - не Linux."""
+    port_suffix = f":{UDP_PORT:04X}"
+    try:
+        with open("/proc/net/udp") as f:
+            next(f) # Заголовок; последняя колонка - drops
+            return sum(int(line.split()[-1]) for line in f if line.split()[1].endswith(port_suffix))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+def create_udp_socket(blocking: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if SOCKET_REUSE_PORT:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if UDP_RECEIVE_BUFFER_BYTES:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER_BYTES) # Ядро может ограничить (net.core.rmem_max)
+    sock.setblocking(blocking)
+    sock.bind((UDP_HOST, UDP_PORT))
+    return sock
+
 def run_udp_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.bind((UDP_HOST, UDP_PORT))
+    with create_udp_socket(blocking=True) as sock:
         print(f"[UDP] Сервер запущен на {UDP_HOST}:{UDP_PORT}...")
 
         while True:
-            raw_data_udp = b""
-            addr_udp = None
             try:
-                raw_data_udp, addr_udp = sock.recvfrom(1024) # Размер буфера
-                location_payload = json.loads(raw_data_udp.decode('utf-8'))
-                print(f"[UDP] Получена геолокация от {addr_udp}: {location_payload}")
-                
-                client_session_id_udp = location_payload.get("session_id")
-                if client_session_id_udp and client_session_id_udp in active_sessions:
-                    active_sessions[client_session_id_udp]["last_seen"] = time.time() # Обновляем сессию
-                    user_name_for_hint = active_sessions[client_session_id_udp].get("user_name", "Игрок")
-                    hint_message = f"{user_name_for_hint}, вы рядом с древним обелиском. Будьте осторожны!"
-                else:
-                    hint_message = "Вы находитесь в неизведанной территории. Осторожнее!"
-                
-                hint_payload = {"hint": hint_message, "timestamp": time.time()}
-                sock.sendto(json.dumps(hint_payload).encode('utf-8'), addr_udp)
+                raw_data_udp, addr_udp = sock.recvfrom(UDP_MAX_DATAGRAM_BYTES)
+                reply = process_location_datagram(raw_data_udp, addr_udp)
+                if reply is not None:
+                    sock.sendto(reply, addr_udp)
+            except OSError as e_udp:
+                server_log.error("UDP", "udp.error", "Ошибка сокета UDP: {error}", error=e_udp)
 
-            except json.JSONDecodeError:
-                print(f"[UDP] Ошибка: Неверный JSON от {addr_udp}. Данные: '{raw_data_udp.decode(errors='ignore')}'")
-            except Exception as e_udp:
-                print(f"[UDP] Ошибка при обработке UDP запроса от {addr_udp if addr_udp else 'неизвестного источника'}: {e_udp}")
+
+class UdpHintProtocol(asyncio.DatagramProtocol):
+    """UDP сервер в цикле событий. На пробуждение цикла вычитывает из сокета пачку до UDP_BATCH_SIZE
+    датаграмм (asyncio сам читает по одной на пробуждение). Пачка от UDP_OFFLOAD_BATCH_SIZE разбирается
+    в пуле потоков: из-за GIL это не ускоряет разбор, но большая пачка не задерживает рассылку WS
+    в том же цикле. В режиме --workers (SESSION_CALLS_BLOCK) в пул уходит любая пачка: промах кэша
+    сессий - синхронный запрос к хабу, который иначе остановил бы цикл. Ответы уходят через transport.sendto - без блокировки (при EAGAIN буферизует asyncio)."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.transport: asyncio.DatagramTransport | None = None
+        self.loop = asyncio.get_running_loop()
+        self.batches = 0
+        self.batched_datagrams = 0
+        self.max_batch = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        batch = [(data, addr)]
+        recvfrom = self.sock.recvfrom
+        while len(batch) < UDP_BATCH_SIZE:
+            try:
+                batch.append(recvfrom(UDP_MAX_DATAGRAM_BYTES))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError: # Ошибки сокета (например, ICMP port unreachable) - прочитаем в следующий раз
+                break
+        self.batches += 1
+        self.batched_datagrams += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        if SESSION_CALLS_BLOCK or (UDP_OFFLOAD_BATCH_SIZE and len(batch) >= UDP_OFFLOAD_BATCH_SIZE):
+            udp_offloaded_batches.inc()
+            future = udp_parse_executor.submit(process_location_batch, batch)
+            future.add_done_callback(lambda done: self.loop.call_soon_threadsafe(self.send_replies, done.result()))
+        else:
+            self.send_replies(process_location_batch(batch))
+
+    def send_replies(self, replies: list):
+        if self.transport is None or self.transport.is_closing():
+            return
+        for reply, addr in replies:
+            self.transport.sendto(reply, addr)
+
+    def error_received(self, exc):
+        server_log.debug("UDP", "udp.socket_error", "Ошибка сокета UDP: {error}", error=exc)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "avg_batch": round(self.batched_datagrams / self.batches, 1) if self.batches else None,
+                "max_batch": self.max_batch}
+
+def process_location_batch(batch: list) -> list:
+    """Пачка датаграмм -> [(ответ, адрес)]. Время ответа одно на пачку, поэтому одинаковые подсказки
+    (одна сессия, все "неизведанные") кодируются один раз."""
+    replies = []
+    encoded_replies: dict[tuple[str, str], bytes] = {}
+    batch_timestamp = time.time()
+    for raw_data_udp, addr_udp in batch:
+        hint = location_hint(raw_data_udp, addr_udp)
+        if hint is None:
+            continue
+        reply = encoded_replies.get(hint)
+        if reply is None:
+            reply = encoded_replies[hint] = encode_message({"hint": hint[0], "timestamp": batch_timestamp}, hint[1])
+        replies.append((reply, addr_udp))
+    return replies
+
+async def run_udp_server_async():
+    global udp_protocol
+    sock = create_udp_socket(blocking=False)
+    loop = asyncio.get_running_loop()
+    _, udp_protocol = await loop.create_datagram_endpoint(lambda: UdpHintProtocol(sock), sock=sock)
+    print(f"[UDP] Сервер запущен на {UDP_HOST}:{UDP_PORT} (asyncio, пачки до {UDP_BATCH_SIZE})...")
+    await asyncio.Future() # Держит сервер работающим "вечно"
 
 
 # ========================
 # Запуск всех серверов
 # ========================
-if __name__ == "__main__":
-    print("[Main Server] Запуск серверов...")
+async def run_async_servers(tcp_mode: str, udp_mode: str):
+    """WebSocket сервер и (в режиме asyncio) TCP и UDP серверы в одном цикле событий."""
+    servers_to_run = [run_websocket_server()]
+    if tcp_mode == "asyncio":
+        servers_to_run.append(run_tcp_server_async())
+    if udp_mode == "asyncio":
+        servers_to_run.append(run_udp_server_async())
+    await asyncio.gather(*servers_to_run)
+
+def parse_producer_schedule(value: str) -> tuple[str, float, float]:
+    """ИМЯ=ПЕРИОД[:РАЗБРОС] из --ws-producer -> (имя, период, разброс)."""
+    name, _, schedule = value.partition("=")
+    if name not in WS_EVENT_PRODUCER_FUNCTIONS:
+        raise argparse.ArgumentTypeError(f"Неизвестный производитель {name!r}. Доступны: {', '.join(WS_EVENT_PRODUCER_FUNCTIONS)}")
+    try:
+        period, _, jitter = schedule.partition(":")
+        period_seconds, jitter_seconds = float(period), float(jitter or 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ожидается ИМЯ=ПЕРИОД[:РАЗБРОС], получено {value!r}")
+    if period_seconds <= 0 or not 0 <= jitter_seconds < period_seconds:
+        raise argparse.ArgumentTypeError(f"Нужно ПЕРИОД > 0 и 0 <= РАЗБРОС < ПЕРИОД: {value!r}")
+    return name, period_seconds, jitter_seconds
 
-    # Запуск TCP сервера в отдельном потоке
-    tcp_server_thread = threading.Thread(target=run_tcp_server, daemon=True)
-    tcp_server_thread.start()
+def parse_server_args():
+    parser = argparse.ArgumentParser(description="All-in-one сервер (TCP, UDP, WebSocket)")
+    parser.add_argument("--tcp-mode", choices=TCP_SERVER_MODES, default=TCP_SERVER_MODE,
+                        help="threaded - поток на соединение, asyncio - asyncio.start_server")
+    parser.add_argument("--tcp-max-connections", type=int, default=TCP_MAX_CONNECTIONS,
+                        help="Макс. одновременно обрабатываемых TCP соединений (asyncio)")
+    parser.add_argument("--tcp-read-timeout", type=float, default=TCP_READ_TIMEOUT_SECONDS,
+                        help="Дедлайн на чтение запроса от клиента, секунд (оба режима TCP: threaded и asyncio)")
+    parser.add_argument("--udp-mode", choices=UDP_SERVER_MODES, default=UDP_SERVER_MODE,
+                        help="threaded - блокирующий recvfrom в потоке, asyncio - DatagramProtocol с чтением пачками")
+    parser.add_argument("--weather-provider", choices=sorted(weather_service.WEATHER_PROVIDERS), default="weatherapi",
+                        help="Источник погоды для get_weather_for_client (static - локальная заглушка без сети)")
+    parser.add_argument("--session-dir", default=SESSION_STORE_DIR,
+                        help="Каталог для журнала сессий; сессии переживут перезапуск сервера")
+    parser.add_argument("--poi-file", default=POI_DATA_PATH,
+                        help="CSV точек интереса (latitude,longitude,name[,hint]) для подсказок UDP; перечитывается при изменении, пусто - без POI")
+    parser.add_argument("--location-history-points", type=int, default=LOCATION_HISTORY_POINTS,
+                        help="Точек в истории геолокаций на сессию (кольцевой буфер, 24 байта на точку); 0 - без истории")
+    parser.add_argument("--event-log-dir", default=EVENT_LOG_DIR,
+                        help="Каталог журнала событий WS; события и их нумерация переживут перезапуск, доступна история (event_history)")
+    parser.add_argument("--log-level", choices=sorted(LEVELS_BY_NAME), default=LOG_LEVEL,
+                        help="Уровень лога горячих путей (debug - с полными payload запросов)")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default=LOG_FORMAT,
+                        help="text - строки вида '[TCP] ...', json - объект JSON на строку")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Порт HTTP сервера метрик Prometheus (0 - выключен; воркеры - порт + номер воркера)")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="Отключить ограничение частоты запросов TCP/UDP (нагрузочные тесты)")
+    parser.add_argument("--ws-test-hooks", action="store_true", default=WS_TEST_HOOKS,
+                        help="Разрешить WS клиентам запускать рассылку сообщением ws_test_broadcast (нагрузочные тесты)")
+    parser.add_argument("--ws-producer", type=parse_producer_schedule, action="append", default=[], metavar="ИМЯ=ПЕРИОД[:РАЗБРОС]",
+                        help=f"Расписание производителя событий WS, секунд (можно несколько раз): {', '.join(WS_EVENT_PRODUCERS)}")
+    parser.add_argument("--ws-batch-window", type=float, default=WS_BATCH_WINDOW_SECONDS,
+                        help="Окно пакетной рассылки WS, секунд: события окна - одним кадром (0 - выключено)")
+    parser.add_argument("--ws-compression", choices=WS_COMPRESSION_MODES, default=None,
+                        help=f"permessage-deflate для WS (deflate-no-context - меньше памяти на соединение); по умолчанию {WS_COMPRESSION}, при --ws-lean - none")
+    parser.add_argument("--ws-outbox", action="store_true", default=WS_CLIENT_OUTBOX,
+                        help="Очереди отправки отстающих WS клиентов со слиянием data_update вместо дедлайна отправки")
+    parser.add_argument("--ws-outbox-max-kept", type=int, default=WS_OUTBOX_MAX_KEPT,
+                        help="Сколько day_event/пакетов может ждать в очереди клиента; больше - клиент отключается")
+    parser.add_argument("--ws-lean", action="store_true", default=WS_LEAN_CONNECTIONS,
+                        help="Экономный режим WS соединений: малые max_size/max_queue и бюджет памяти на соединение")
+    parser.add_argument("--ws-memory-budget", type=int, default=WS_CONNECTION_MEMORY_BUDGET_BYTES,
+                        help="Бюджет памяти на WS соединение в экономном режиме, байт (очередь входящих + буфер отправки)")
+    parser.add_argument("--ws-deflate-window-bits", type=int, choices=range(9, 16), default=WS_DEFLATE_WINDOW_BITS,
+                        help="Размер окна deflate (2^N байт) на соединение")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="Число процессов-воркеров на общих портах (SO_REUSEPORT); 1 - один процесс")
+    return parser.parse_args()
 
-    # Запуск UDP сервера в отдельном потоке
-    udp_server_thread = threading.Thread(target=run_udp_server, daemon=True)
-    udp_server_thread.start()
+def open_session_journal(session_dir: str):
+    """Восстанавливает сессии из журнала в active_sessions и включает запись журнала."""
+    global session_journal
+    session_journal = SessionJournal(session_dir)
+    restore_info = session_journal.load_into(active_sessions)
+    print(f"[Main Server] Сессии восстановлены из '{session_dir}': снапшот {restore_info['snapshot_sessions']}, "
+          f"записей журнала {restore_info['log_records']}, за {restore_info['seconds']:.3f} с.")
+    active_sessions.journal = session_journal
+    session_journal.start(active_sessions)
+
+def open_event_log(event_log_dir: str):
+    """Открывает журнал событий, продолжает нумерацию seq и прогревает буфер повтора последними событиями."""
+    global event_log, ws_last_event_seq
+    if SOCKET_REUSE_PORT: # Воркер режима --workers
+        event_log_dir = os.path.join(event_log_dir, f"worker-{WORKER_INDEX}")
+    event_log = EventLog(event_log_dir, segment_max_bytes=EVENT_LOG_SEGMENT_BYTES,
+                         retention_seconds=EVENT_LOG_RETENTION_SECONDS, max_total_bytes=EVENT_LOG_MAX_BYTES)
+    open_info = event_log.open()
+    ws_last_event_seq = event_log.last_seq
+    server_event_cache.extend(event_log.read_from_seq(max(1, ws_last_event_seq - MAX_SERVER_CACHE_SIZE + 1), MAX_SERVER_CACHE_SIZE))
+    print(f"[Main Server] Журнал событий '{event_log_dir}': сегментов {open_info['segments']}, последний seq {open_info['last_seq']}, "
+          f"в буфере повтора {len(server_event_cache)}, за {open_info['seconds']:.3f} с.")
+
+def run_server_process(server_args):
+    """Запускает все серверы в текущем процессе (блокирует до остановки цикла событий)."""
+    global poi_dataset, location_history
+    if server_args.location_history_points:
+        location_history = LocationHistory(server_args.location_history_points, LOCATION_HISTORY_MAX_SESSIONS)
+    if server_args.poi_file:
+        poi_dataset = PoiDataset(server_args.poi_file, check_interval_seconds=POI_RELOAD_CHECK_SECONDS)
+        poi_dataset.start() # Загрузка - в фоне: до ее окончания подсказки без POI
+    if server_args.event_log_dir:
+        open_event_log(server_args.event_log_dir)
+    if server_args.metrics_port:
+        metrics_port = server_args.metrics_port + WORKER_INDEX
+        try:
+            start_metrics_http_server(METRICS_HOST, metrics_port, collect_prometheus_metrics)
+            print(f"[Metrics] Метрики Prometheus: http://{METRICS_HOST}:{metrics_port}/metrics")
+        except OSError as e_metrics: # Порт занят (например, METRICS_PORT + номер воркера): без метрик, но обслуживаем
+            server_log.error("Metrics", "metrics.start_error", "Не удалось запустить сервер метрик на {host}:{port}: {error}",
+                             host=METRICS_HOST, port=metrics_port, error=e_metrics)
 
-    # Запуск WebSocket сервера (он асинхронный и блокирующий, если не обернут)
-    # asyncio.run() запускает цикл событий и блокирует до завершения run_websocket_server
+    if server_args.tcp_mode == "threaded":
+        # Запуск TCP сервера в отдельном потоке
+        tcp_server_thread = threading.Thread(target=run_tcp_server, daemon=True)
+        tcp_server_thread.start()
+
+    if server_args.udp_mode == "threaded":
+        # Запуск UDP сервера в отдельном потоке
+        udp_server_thread = threading.Thread(target=run_udp_server, daemon=True)
+        udp_server_thread.start()
+
+    # Запуск WebSocket сервера (и asyncio TCP/UDP серверов, если выбран этот режим)
+    # asyncio.run() запускает цикл событий и блокирует до завершения серверов
+    asyncio.run(run_async_servers(server_args.tcp_mode, server_args.udp_mode))
+
+def run_worker_process(worker_index: int, hub_address, hub_authkey: bytes, server_args):
+    """Точка входа воркера: сессии - через хаб главного процесса, порты - общие (SO_REUSEPORT)."""
+    global active_sessions, SOCKET_REUSE_PORT, WORKER_INDEX, SESSION_CALLS_BLOCK
+    SOCKET_REUSE_PORT = True
+    WORKER_INDEX = worker_index
+    SESSION_CALLS_BLOCK = True
+    active_sessions = SharedSessionStore(hub_address, hub_authkey, SESSION_TIMEOUT_SECONDS)
+    print(f"[Worker {worker_index}] Запущен (pid {os.getpid()}).")
     try:
-        asyncio.run(run_websocket_server())
+        run_server_process(server_args)
+    except KeyboardInterrupt:
+        pass # Остановку сообщает главный процесс
+
+def run_worker_pool(server_args):
+    """Главный процесс режима --workers N: держит сессии и журнал, сам запросов не обслуживает."""
+    session_hub = SessionHub(active_sessions)
+    fork_context = multiprocessing.get_context("fork")
+    workers = [
+        fork_context.Process(target=run_worker_process, args=(i, session_hub.address, session_hub.authkey, server_args),
+                             daemon=True, name=f"server-worker-{i}")
+        for i in range(server_args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Потоки главного процесса запускаем только после fork
+    if server_args.session_dir:
+        open_session_journal(server_args.session_dir)
+    session_hub.start()
+    start_session_cleanup_thread()
+    print(f"[Main Server] Запущено воркеров: {len(workers)} (общие порты TCP {TCP_PORT}, UDP {UDP_PORT}, WS {WS_PORT}).")
+
+    while workers:
+        for worker in list(workers):
+            worker.join(timeout=1)
+            if not worker.is_alive():
+                print(f"[Main Server] Воркер {worker.name} завершился (код {worker.exitcode}).")
+                workers.remove(worker)
+
+if __name__ == "__main__":
+    server_args = parse_server_args()
+    TCP_MAX_CONNECTIONS = server_args.tcp_max_connections
+    TCP_READ_TIMEOUT_SECONDS = server_args.tcp_read_timeout
+    server_log.level = LEVELS_BY_NAME[server_args.log_level]
+    server_log.log_format = server_args.log_format
+    server_log.max_queue_size = LOG_QUEUE_SIZE
+    server_log.sample_every = dict(LOG_SAMPLE_EVERY)
+    WS_TEST_HOOKS = server_args.ws_test_hooks
+    UDP_SERVER_MODE = server_args.udp_mode
+    WS_BATCH_WINDOW_SECONDS = server_args.ws_batch_window
+    for producer_name, period_seconds, jitter_seconds in server_args.ws_producer:
+        WS_EVENT_PRODUCERS[producer_name] = (period_seconds, jitter_seconds)
+    WS_CLIENT_OUTBOX = server_args.ws_outbox
+    WS_OUTBOX_MAX_KEPT = server_args.ws_outbox_max_kept
+    WS_LEAN_CONNECTIONS = server_args.ws_lean
+    WS_CONNECTION_MEMORY_BUDGET_BYTES = server_args.ws_memory_budget
+    if server_args.ws_compression:
+        WS_COMPRESSION = server_args.ws_compression
+    elif WS_LEAN_CONNECTIONS and "WS_COMPRESSION" not in os.environ:
+        WS_COMPRESSION = "none"
+    if WS_LEAN_CONNECTIONS and ws_send_budget_bytes() <= 0:
+        print(f"[Main Server] Бюджет памяти WS соединения {WS_CONNECTION_MEMORY_BUDGET_BYTES} байт меньше очереди входящих "
+              f"({WS_LEAN_MAX_QUEUE} x {WS_LEAN_MAX_MESSAGE_BYTES} байт).")
+        sys.exit(2)
+    WS_DEFLATE_WINDOW_BITS = server_args.ws_deflate_window_bits
+    if server_args.no_rate_limit:
+        TCP_CONNECTION_RATE_PER_IP = TCP_REQUEST_RATE_PER_IP = TCP_REQUEST_RATE_PER_SESSION = 0
+        UDP_RATE_PER_IP = UDP_RATE_PER_SESSION = 0
+        rate_limiters = create_rate_limiters()
+    print(f"[Main Server] Запуск серверов (режим TCP: {server_args.tcp_mode})...")
+    weather_service.set_weather_provider(server_args.weather_provider)
+
+    use_workers = server_args.workers > 1
+    if use_workers and not reuse_port_supported():
+        print("[Main Server] SO_REUSEPORT недоступен на этой платформе, --workers игнорируется: запуск в одном процессе.")
+        use_workers = False
+
+    try:
+        if use_workers:
+            run_worker_pool(server_args)
+        else:
+            if server_args.session_dir:
+                # Восстанавливаем сессии до запуска серверов, чтобы клиенты не создавали их заново
+                open_session_journal(server_args.session_dir)
+            run_server_process(server_args)
     except KeyboardInterrupt:
         print("\n[Main Server] Сервер останавливается по команде пользователя (Ctrl+C)...")
     except Exception as main_loop_error:
         print(f"[Main Server] Критическая ошибка в основном цикле asyncio: {main_loop_error}")
     finally:
+        if session_journal is not None:
+            session_journal.close() # Дописываем буфер журнала сессий
+        if event_log is not None:
+            event_log.close()
         print("[Main Server] Все серверные потоки должны завершиться.")
\ No newline at end of file
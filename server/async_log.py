@@ -0,0 +1,145 @@
+# server/async_log.py
+# Асинхронный структурированный лог для горячих путей сервера (вместо print на каждый запрос).
+#
+# log() на пути запроса только проверяет уровень и сэмплирование и кладет запись в ограниченную
+# очередь (deque.append атомарен, замков нет). Форматирование и запись в stdout делает фоновый
+# поток пачками. Если очередь заполнена, запись отбрасывается и учитывается в счетчике dropped -
+# обработка запроса никогда не ждет вывод.
+#
+# Запись: (время, уровень, компонент, событие, шаблон сообщения, поля). Шаблон форматируется
+# полями (str.format) уже в фоновом потоке. Формат вывода: "text" - как прежние print ("[TCP] ...")
+# или "json" - по объекту JSON на строку со всеми полями.
+import atexit
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from server.metrics import Counter
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LEVELS_BY_NAME = {name: level for level, name in LEVEL_NAMES.items()}
+LOG_FORMATS = ("text", "json")
+
+
+class AsyncLogger:
+    def __init__(self, level: int = INFO, log_format: str = "text", max_queue_size: int = 10_000,
+                 sample_every: dict[str, int] | None = None, flush_interval_seconds: float = 0.05, stream=None):
+        self.level = level
+        self.log_format = log_format
+        self.max_queue_size = max_queue_size
+        self.sample_every = dict(sample_every or {}) # событие -> писать каждое N-е
+        self.flush_interval_seconds = flush_interval_seconds
+        self.stream = stream or sys.stdout
+        self._records: deque = deque()
+        self._sample_counters: dict[str, itertools.count] = {}
+        self._writer_thread: threading.Thread | None = None
+        self._write_lock = threading.Lock() # Только между фоновым потоком и flush() при выходе
+        self.dropped = Counter() # Очередь была заполнена
+        self.sampled_out = Counter() # Пропущены сэмплированием
+        self.writer_errors = Counter() # Ошибки фонового потока записи (поток при этом продолжает работу)
+
+    # ---- Путь запроса ----
+
+    def log(self, level: int, component: str, event: str, message: str, **fields):
+        if level < self.level:
+            return
+        every = self.sample_every.get(event)
+        if every is not None and every > 1:
+            counter = self._sample_counters.get(event)
+            if counter is None:
+                counter = self._sample_counters.setdefault(event, itertools.count())
+            if next(counter) % every:
+                self.sampled_out.inc()
+                return
+        if len(self._records) >= self.max_queue_size:
+            self.dropped.inc()
+            return
+        self._records.append((time.time(), level, component, event, message, fields))
+
+    def debug(self, component: str, event: str, message: str, **fields):
+        self.log(DEBUG, component, event, message, **fields)
+
+    def info(self, component: str, event: str, message: str, **fields):
+        self.log(INFO, component, event, message, **fields)
+
+    def warning(self, component: str, event: str, message: str, **fields):
+        self.log(WARNING, component, event, message, **fields)
+
+    def error(self, component: str, event: str, message: str, **fields):
+        self.log(ERROR, component, event, message, **fields)
+
+    # ---- Фоновая запись ----
+
+    def start(self):
+        if self._writer_thread is None or not self._writer_thread.is_alive():
+            self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True, name="async-log")
+            self._writer_thread.start()
+
+    def restart_after_fork(self):
+        """В дочернем процессе нет фонового потока, а замок мог остаться захваченным им."""
+        self._write_lock = threading.Lock()
+        self._writer_thread = None
+        self.start()
+
+    def _writer_loop(self):
+        while True:
+            try:
+                if self.flush():
+                    continue
+            except Exception: # Поток записи не должен умирать: иначе очередь заполнится и лог замолчит навсегда
+                self.writer_errors.inc()
+            time.sleep(self.flush_interval_seconds)
+
+    def flush(self) -> int:
+        """Форматирует и пишет накопленные записи (до 1000) одной операцией записи."""
+        with self._write_lock:
+            records = self._records
+            lines = []
+            while records and len(lines) < 1000: # Пачка ограничена, чтобы поток не застрял при постоянном потоке записей
+                lines.append(self._format(records.popleft()))
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass # stdout закрыт - лог не должен ронять сервер
+            return len(lines)
+
+    def _format(self, record: tuple) -> str:
+        timestamp, level, component, event, message, fields = record
+        try:
+            text = message.format(**fields) if fields else message
+        except Exception: # Поле не подходит к шаблону (например, None для "{x:.2f}") - пишем как есть
+            text = f"{message!r} {self._safe_repr(fields)}"
+        if self.log_format == "json":
+            try:
+                return json.dumps({"ts": round(timestamp, 6), "level": LEVEL_NAMES.get(level, level), "component": component,
+                                   "event": event, "msg": text, **fields}, ensure_ascii=False, default=str)
+            except Exception:
+                return json.dumps({"ts": round(timestamp, 6), "level": LEVEL_NAMES.get(level, level), "component": component,
+                                   "event": event, "msg": text, "fields": self._safe_repr(fields)}, ensure_ascii=False)
+        return f"[{component}] {text}"
+
+    @staticmethod
+    def _safe_repr(fields: dict) -> str:
+        try:
+            return repr(fields)
+        except Exception:
+            return "<поля не выводятся>"
+
+    def stats(self) -> dict:
+        return {"queued": len(self._records), "dropped": self.dropped.value, "sampled_out": self.sampled_out.value,
+                "writer_errors": self.writer_errors.value}
+
+
+server_log = AsyncLogger()
+server_log.start()
+atexit.register(server_log.flush) # Дописываем остаток очереди при нормальном завершении
+if hasattr(os, "register_at_fork"):
+    # Потоки не переживают fork: воркеры режима --workers запускают свой поток записи
+    os.register_at_fork(after_in_child=server_log.restart_after_fork)
@@ -0,0 +1,266 @@
+# server/event_log.py
+# Долговременный журнал событий рассылки WebSocket: append-only сегменты с разреженным индексом.
+#
+# Файлы в каталоге журнала:
+#   <first_seq>.seg - записи подряд: [RECORD_HEADER][тип события, UTF-8][тело: JSON события];
+#   <first_seq>.idx - разреженный индекс сегмента: каждая INDEX_INTERVAL-я запись -> (seq, время, смещение);
+#   epoch           - идентификатор журнала: нумерация seq продолжается между перезапусками сервера.
+# Время записей не убывает (если часы перевели назад, берется время предыдущей записи),
+# поэтому по индексу можно искать бинарным поиском и по seq, и по времени.
+#
+# Чтение - через mmap: запрос истории находит по индексу смещение, читает только заголовки
+# записей и декодирует JSON лишь подходящих по типу; сегмент целиком в память не загружается.
+# Старые сегменты удаляются целиком по политике хранения (возраст и общий размер журнала).
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+
+RECORD_HEADER = struct.Struct("!IQdH") # длина тела, seq, время (unix), длина типа
+INDEX_ENTRY = struct.Struct("!QdQ") # seq, время, смещение записи в сегменте
+INDEX_INTERVAL = 32 # Запись индекса на каждые N записей сегмента
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+EPOCH_FILE_NAME = "epoch"
+
+
+class _Segment:
+    __slots__ = ("first_seq", "path", "index_path", "size", "records", "last_seq", "first_ts", "last_ts",
+                 "index_seq", "index_ts", "index_offset")
+
+    def __init__(self, directory: str, first_seq: int):
+        self.first_seq = first_seq
+        self.path = os.path.join(directory, f"{first_seq:020d}{SEGMENT_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{first_seq:020d}{INDEX_SUFFIX}")
+        self.size = 0
+        self.records = 0
+        self.last_seq = first_seq - 1
+        self.first_ts = 0.0
+        self.last_ts = 0.0
+        # Разреженный индекс; массивы только растут, читатели берут длину под замком
+        self.index_seq = array("Q")
+        self.index_ts = array("d")
+        self.index_offset = array("Q")
+
+
+def _scan(data, offset: int, end: int):
+    """Заголовки записей с offset до end: (смещение, seq, время, тип, начало тела, конец тела)."""
+    while offset + RECORD_HEADER.size <= end:
+        body_len, seq, timestamp, type_len = RECORD_HEADER.unpack_from(data, offset)
+        type_start = offset + RECORD_HEADER.size
+        body_start = type_start + type_len
+        body_end = body_start + body_len
+        if body_end > end:
+            return # Недописанная запись (аварийное завершение)
+        yield offset, seq, timestamp, bytes(data[type_start:body_start]).decode("utf-8"), body_start, body_end
+        offset = body_end
+
+
+class EventLog:
+    """Запись - из одного потока (цикл событий WS), чтение истории - из любых потоков."""
+
+    def __init__(self, directory: str, segment_max_bytes: int = 8 * 1024 * 1024,
+                 retention_seconds: float = 7 * 24 * 3600, max_total_bytes: int = 1024 * 1024 * 1024, fsync: bool = False):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.retention_seconds = retention_seconds
+        self.max_total_bytes = max_total_bytes
+        self.fsync = fsync
+        self.epoch = ""
+        self.last_seq = 0
+        self._last_ts = 0.0
+        self._segments: list[_Segment] = []
+        self._lock = threading.Lock()
+        self._file = None
+        self._index_file = None
+        self.dropped_segments = 0
+
+    # ---- Открытие и восстановление ----
+
+    def open(self) -> dict:
+        """Загружает индексы сегментов, отрезает недописанный хвост. Возвращает сводку восстановления."""
+        started_at = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        epoch_path = os.path.join(self.directory, EPOCH_FILE_NAME)
+        if os.path.exists(epoch_path):
+            with open(epoch_path, "r", encoding="utf-8") as f:
+                self.epoch = f.read().strip()
+        if not self.epoch:
+            self.epoch = uuid.uuid4().hex
+            with open(epoch_path, "w", encoding="utf-8") as f:
+                f.write(self.epoch)
+        first_seqs = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        for first_seq in first_seqs:
+            segment = _Segment(self.directory, first_seq)
+            self._load_segment(segment)
+            if segment.records:
+                self._segments.append(segment)
+            elif first_seq != first_seqs[-1]:
+                self._remove_files(segment) # Пустой сегмент в середине - остаток прерванной ротации
+        if self._segments:
+            self.last_seq = self._segments[-1].last_seq
+            self._last_ts = self._segments[-1].last_ts
+        self._apply_retention()
+        self._open_active_segment()
+        return {"segments": len(self._segments), "last_seq": self.last_seq, "seconds": time.perf_counter() - started_at}
+
+    def _load_segment(self, segment: _Segment):
+        segment.size = os.path.getsize(segment.path)
+        entries = b""
+        if os.path.exists(segment.index_path):
+            with open(segment.index_path, "rb") as f:
+                entries = f.read()
+        for pos in range(0, len(entries) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            seq, timestamp, offset = INDEX_ENTRY.unpack_from(entries, pos)
+            if offset >= segment.size:
+                break # Индекс дописан дальше сегмента - остальное пересоберем сканированием
+            segment.index_seq.append(seq); segment.index_ts.append(timestamp); segment.index_offset.append(offset)
+        # Досканируем сегмент от последней записи индекса: последние seq/время и проверка хвоста
+        scan_from = segment.index_offset[-1] if segment.index_offset else 0
+        records_before = (len(segment.index_offset) - 1) * INDEX_INTERVAL if segment.index_offset else 0
+        valid_end = scan_from
+        if segment.size:
+            with open(segment.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for i, (offset, seq, timestamp, _, _, body_end) in enumerate(_scan(data, scan_from, segment.size)):
+                    record_number = records_before + i
+                    if record_number % INDEX_INTERVAL == 0 and record_number // INDEX_INTERVAL >= len(segment.index_offset):
+                        segment.index_seq.append(seq); segment.index_ts.append(timestamp); segment.index_offset.append(offset)
+                    if record_number == 0:
+                        segment.first_ts = timestamp
+                    segment.records = record_number + 1
+                    segment.last_seq = seq
+                    segment.last_ts = timestamp
+                    valid_end = body_end
+        if segment.records and not segment.first_ts:
+            segment.first_ts = segment.index_ts[0]
+        if valid_end < segment.size: # Обрезаем недописанную запись, иначе новые записи пойдут после мусора
+            with open(segment.path, "r+b") as f:
+                f.truncate(valid_end)
+            segment.size = valid_end
+        with open(segment.index_path, "wb") as f: # Индекс приводим в соответствие с сегментом
+            f.write(b"".join(INDEX_ENTRY.pack(s, t, o) for s, t, o in zip(segment.index_seq, segment.index_ts, segment.index_offset)))
+
+    def _open_active_segment(self):
+        if not self._segments or self._segments[-1].size >= self.segment_max_bytes:
+            segment = _Segment(self.directory, self.last_seq + 1)
+            with self._lock:
+                self._segments.append(segment)
+        segment = self._segments[-1]
+        self._file = open(segment.path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+
+    # ---- Запись ----
+
+    def append(self, payload: dict) -> int:
+        """Дописывает событие (payload["seq"] должен расти). Возвращает seq."""
+        seq = payload["seq"]
+        if seq <= self.last_seq:
+            raise ValueError(f"seq {seq} не больше последнего в журнале ({self.last_seq})")
+        segment = self._segments[-1]
+        if segment.size >= self.segment_max_bytes and segment.records:
+            self._roll()
+            segment = self._segments[-1]
+        timestamp = max(time.time(), self._last_ts)
+        type_bytes = str(payload.get("type", "")).encode("utf-8")
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        offset = segment.size
+        self._file.write(RECORD_HEADER.pack(len(body), seq, timestamp, len(type_bytes)) + type_bytes + body)
+        self._file.flush() # Видно читателям через mmap сразу после записи
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        with self._lock:
+            if segment.records % INDEX_INTERVAL == 0:
+                self._index_file.write(INDEX_ENTRY.pack(seq, timestamp, offset))
+                self._index_file.flush()
+                segment.index_seq.append(seq); segment.index_ts.append(timestamp); segment.index_offset.append(offset)
+            if not segment.records:
+                segment.first_ts = timestamp
+            segment.records += 1
+            segment.size = offset + RECORD_HEADER.size + len(type_bytes) + len(body)
+            segment.last_seq = seq
+            segment.last_ts = timestamp
+        self.last_seq = seq
+        self._last_ts = timestamp
+        return seq
+
+    def _roll(self):
+        self._file.close()
+        self._index_file.close()
+        with self._lock:
+            self._segments.append(_Segment(self.directory, self.last_seq + 1))
+        self._file = open(self._segments[-1].path, "ab")
+        self._index_file = open(self._segments[-1].index_path, "ab")
+        self._apply_retention()
+
+    def _apply_retention(self):
+        """Удаляет самые старые сегменты (кроме активного): старше retention_seconds или сверх max_total_bytes."""
+        cutoff = time.time() - self.retention_seconds
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            total_bytes = sum(segment.size for segment in self._segments)
+            if oldest.last_ts >= cutoff and total_bytes <= self.max_total_bytes:
+                break
+            with self._lock:
+                self._segments.pop(0)
+            self._remove_files(oldest)
+            self.dropped_segments += 1
+
+    def _remove_files(self, segment: _Segment):
+        for path in (segment.path, segment.index_path):
+            try:
+                os.remove(path)
+            except OSError as e_remove:
+                # Windows не дает удалить файл, открытый читателем; удалим при следующем запуске
+                print(f"[Event Log] Не удалось удалить {path}: {e_remove}")
+
+    def close(self):
+        for f in (self._file, self._index_file):
+            if f is not None:
+                f.close()
+        self._file = self._index_file = None
+
+    # ---- Чтение ----
+
+    def _segments_snapshot(self) -> list[tuple[_Segment, int, int]]:
+        with self._lock:
+            return [(segment, segment.size, len(segment.index_offset)) for segment in self._segments if segment.records]
+
+    def query(self, event_type: str | None, from_ts: float, to_ts: float, limit: int, after_seq: int = 0) -> tuple[list[dict], int | None]:
+        """События типа event_type (None - любого) со временем в [from_ts, to_ts] и seq > after_seq,
+        не больше limit. Возвращает (события, after_seq для следующей страницы или None)."""
+        events: list[dict] = []
+        for segment, size, index_len in self._segments_snapshot():
+            if segment.last_seq <= after_seq or segment.last_ts < from_ts:
+                continue
+            if segment.first_ts > to_ts:
+                break
+            # Стартовая точка - последняя запись индекса не позже from_ts и не дальше after_seq
+            by_time = bisect_left(segment.index_ts, from_ts, 0, index_len) - 1
+            by_seq = bisect_right(segment.index_seq, after_seq, 0, index_len) - 1
+            start = segment.index_offset[max(0, by_time, by_seq)] if index_len else 0
+            with open(segment.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for _, seq, timestamp, record_type, body_start, body_end in _scan(data, start, size):
+                    if timestamp > to_ts:
+                        return events, None
+                    if seq <= after_seq or timestamp < from_ts or (event_type is not None and record_type != event_type):
+                        continue
+                    events.append(json.loads(bytes(data[body_start:body_end])))
+                    if len(events) >= limit:
+                        return events, seq
+        return events, None
+
+    def read_from_seq(self, from_seq: int, limit: int) -> list[dict]:
+        """До limit событий начиная с from_seq (для прогрева кольцевого буфера повтора)."""
+        return self.query(None, 0.0, float("inf"), limit, after_seq=from_seq - 1)[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"segments": len(self._segments), "bytes": sum(segment.size for segment in self._segments),
+                    "first_seq": self._segments[0].first_seq if self._segments else None, "last_seq": self.last_seq,
+                    "dropped_segments": self.dropped_segments}
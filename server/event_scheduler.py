@@ -0,0 +1,187 @@
+# server/event_scheduler.py
+# Планировщик производителей событий рассылки WebSocket: куча (heapq) ближайших срабатываний в цикле asyncio.
+#
+# Производитель - функция без аргументов, возвращающая payload события (dict), список payload или None
+# (нечего рассылать); может быть корутинной функцией. У каждого свой период и разброс (jitter):
+# следующее срабатывание считается от запланированного времени предыдущего, расписание не "уплывает".
+# Синхронные производители выполняются прямо в цикле событий и должны быть быстрыми,
+# корутинные - отдельными задачами и не задерживают остальных.
+# Перегрузка: пока предыдущий запуск корутинного производителя не завершен, его срабатывания пропускаются;
+# если цикл отстал больше чем на период (долгий синхронный производитель), пропущенные
+# срабатывания не догоняются пачкой, а тоже считаются пропущенными.
+import asyncio
+import heapq
+import inspect
+import itertools
+import random
+import time
+from typing import Callable
+
+from server.async_log import server_log
+from server.metrics import LatencyHistogram
+
+
+class EventProducer:
+    def __init__(self, name: str, produce: Callable, period_seconds: float, jitter_seconds: float = 0.0):
+        if period_seconds <= 0:
+            raise ValueError(f"Период производителя {name!r} должен быть больше 0")
+        if not 0 <= jitter_seconds < period_seconds:
+            raise ValueError(f"Разброс производителя {name!r} должен быть в [0, период)")
+        self.name = name
+        self.produce = produce
+        self.period_seconds = period_seconds
+        self.jitter_seconds = jitter_seconds
+        self.is_async = inspect.iscoroutinefunction(produce)
+        self.next_fire = 0.0 # Время цикла событий (loop.time()) следующего срабатывания
+        self.running: asyncio.Task | None = None
+        self.runs = 0
+        self.events = 0
+        self.errors = 0
+        self.overruns = 0 # Запуски дольше периода
+        self.skipped = 0 # Срабатывания, пропущенные из-за перегрузки
+        self.duration = LatencyHistogram() # Время работы produce()
+        self.lag = LatencyHistogram() # Опоздание запуска относительно расписания
+
+    def next_interval(self) -> float:
+        return self.period_seconds + random.uniform(-self.jitter_seconds, self.jitter_seconds)
+
+    def stats(self) -> dict:
+        return {
+            "period_seconds": self.period_seconds,
+            "jitter_seconds": self.jitter_seconds,
+            "runs": self.runs,
+            "events": self.events,
+            "errors": self.errors,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "duration": self.duration.snapshot(),
+            "lag": self.lag.snapshot(),
+        }
+
+
+class EventScheduler:
+    """publish(payload) рассылает событие; on_tick() вызывается после запусков, опубликовавших события
+    (конец цикла рассылки). Все методы - только из цикла событий, где работает run()."""
+
+    def __init__(self, publish: Callable[[dict], object], on_tick: Callable[[], None] | None = None):
+        self.publish = publish
+        self.on_tick = on_tick
+        self.producers: dict[str, EventProducer] = {}
+        self._heap: list[tuple[float, int, EventProducer]] = []
+        self._order = itertools.count() # Порядок при равном времени; EventProducer не сравниваются
+        self._wakeup: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def add_producer(self, producer: EventProducer, first_fire_in: float | None = None):
+        """Регистрирует производителя; первое срабатывание - через first_fire_in (по умолчанию через интервал)."""
+        if producer.name in self.producers:
+            raise ValueError(f"Производитель {producer.name!r} уже зарегистрирован")
+        self.producers[producer.name] = producer
+        if self._loop is not None:
+            self._schedule(producer, self._loop.time() + (producer.next_interval() if first_fire_in is None else first_fire_in))
+        else:
+            producer.next_fire = producer.next_interval() if first_fire_in is None else first_fire_in # Относительно запуска run()
+
+    def remove_producer(self, name: str):
+        producer = self.producers.pop(name, None)
+        if producer is not None and producer.running is not None:
+            producer.running.cancel()
+        # Записи в куче удаляются лениво: при извлечении проверяется, что производитель еще зарегистрирован
+
+    def fire_now(self, names: list | None = None):
+        """Запустить производителей (всех или перечисленных) сейчас, не дожидаясь расписания."""
+        if self._loop is None:
+            return
+        now = self._loop.time()
+        for name in names if names is not None else list(self.producers):
+            producer = self.producers.get(name)
+            if producer is not None:
+                self._schedule(producer, now)
+        self._wakeup.set()
+
+    def _schedule(self, producer: EventProducer, fire_at: float):
+        producer.next_fire = fire_at
+        heapq.heappush(self._heap, (fire_at, next(self._order), producer))
+        if self._wakeup is not None and fire_at <= self._heap[0][0]:
+            self._wakeup.set() # Новое ближайшее срабатывание - пересчитать ожидание
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        started_at = self._loop.time()
+        for producer in self.producers.values():
+            self._schedule(producer, started_at + producer.next_fire)
+        while True:
+            now = self._loop.time()
+            published = False
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, _, producer = heapq.heappop(self._heap)
+                if self.producers.get(producer.name) is not producer or fire_at != producer.next_fire:
+                    continue # Снят с учета или перепланирован (fire_now) - запись устарела
+                published |= self._fire(producer, fire_at, now)
+                next_fire = fire_at + producer.next_interval()
+                now = self._loop.time()
+                if next_fire <= now:
+                    missed = int((now - next_fire) // producer.period_seconds) + 1
+                    producer.skipped += missed
+                    next_fire += missed * producer.period_seconds
+                self._schedule(producer, next_fire)
+            if published and self.on_tick is not None:
+                self.on_tick()
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - self._loop.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _fire(self, producer: EventProducer, fire_at: float, now: float) -> bool:
+        """Запускает производителя; True - синхронный запуск опубликовал события."""
+        if producer.running is not None and not producer.running.done():
+            producer.skipped += 1
+            server_log.warning("WS Scheduler", "scheduler.skip", "Производитель {name} еще работает - срабатывание пропущено", name=producer.name)
+            return False
+        producer.lag.observe(now - fire_at)
+        if producer.is_async:
+            producer.running = asyncio.create_task(self._run_async(producer))
+            return False
+        started_at = time.perf_counter()
+        try:
+            result = producer.produce()
+        except Exception as e_produce:
+            return self._finish(producer, started_at, None, e_produce)
+        return self._finish(producer, started_at, result, None)
+
+    async def _run_async(self, producer: EventProducer):
+        started_at = time.perf_counter()
+        try:
+            result = await producer.produce()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e_produce:
+            self._finish(producer, started_at, None, e_produce)
+            return
+        if self._finish(producer, started_at, result, None) and self.on_tick is not None:
+            self.on_tick()
+
+    def _finish(self, producer: EventProducer, started_at: float, result, error: Exception | None) -> bool:
+        duration = time.perf_counter() - started_at
+        producer.runs += 1
+        producer.duration.observe(duration)
+        if duration > producer.period_seconds:
+            producer.overruns += 1
+            server_log.warning("WS Scheduler", "scheduler.overrun", "Производитель {name} работал {duration:.3f} с - дольше периода {period} с",
+                               name=producer.name, duration=duration, period=producer.period_seconds)
+        if error is not None:
+            producer.errors += 1
+            server_log.error("WS Scheduler", "scheduler.error", "Ошибка производителя {name}: {error}", name=producer.name, error=error)
+            return False
+        payloads = [result] if isinstance(result, dict) else list(result or ())
+        for payload in payloads:
+            self.publish(payload)
+        producer.events += len(payloads)
+        return bool(payloads)
+
+    def stats(self) -> dict:
+        return {name: producer.stats() for name, producer in self.producers.items()}
@@ -0,0 +1,192 @@
+# server/location_history.py
+# История геолокаций сессий (UDP location_update): кольцевой буфер фиксированного размера на сессию.
+#
+# Буферы всех сессий лежат в общих плоских массивах array('d') - время, широта, долгота, по capacity точек
+# на слот. Сессия получает слот при первой геолокации; после простоя слот освобождается и достается
+# следующей сессии. На слот также хранятся позиция записи, число точек (array('L')), пройденный путь
+# ("одометр" за все время сессии, а не только по точкам буфера) и время последней точки (array('d')).
+# Объектов на точку нет, на сессию - только запись словаря session_id -> слот, поэтому память ограничена:
+#   capacity * 24 байт (3 double на точку) + 32 байта служебных массивов + ~150 байт записи словаря и строки id.
+# По умолчанию capacity 32: ~0.95 КБ на сессию, 100k активных сессий - ~95 МБ; больше max_sessions сессий
+# история не заводится (rejected_sessions в stats()).
+# Время точки - время сервера при приеме: часам клиентов не доверяем; датаграммы, пришедшие не по порядку
+# (время меньше последней точки), отбрасываются.
+import math
+import threading
+from array import array
+
+EARTH_RADIUS_METERS = 6_371_000.0
+GROW_SLOTS = 1024 # Слотов за одно расширение массивов
+EXPIRE_CHUNK = 4096 # Сессий за один захват замка при очистке простаивающих
+
+
+def haversine_meters(latitude_1: float, longitude_1: float, latitude_2: float, longitude_2: float) -> float:
+    phi_1, phi_2 = math.radians(latitude_1), math.radians(latitude_2)
+    half_dphi = (phi_2 - phi_1) / 2
+    half_dlambda = math.radians(longitude_2 - longitude_1) / 2
+    a = math.sin(half_dphi) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(half_dlambda) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class LocationHistory:
+    """Потокобезопасна: запись из потоков приема/разбора UDP, запросы из обработчиков TCP (один замок,
+    под ним - только O(1) работа или проход по буферу одной сессии)."""
+
+    def __init__(self, capacity: int = 32, max_sessions: int = 200_000):
+        if capacity < 2:
+            raise ValueError("Размер буфера истории должен быть не меньше 2 точек")
+        self.capacity = capacity
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.slots: dict[str, int] = {} # session_id -> слот
+        self._free_slots: list[int] = []
+        self.times = array('d')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.heads = array('L') # Куда пишется следующая точка слота (0..capacity-1)
+        self.counts = array('L') # Точек в буфере слота (до capacity)
+        self.odometers = array('d') # Пройденный путь сессии, метров
+        self.last_times = array('d') # Время последней точки (простой - для очистки)
+        self.recorded = 0
+        self.out_of_order = 0
+        self.rejected_sessions = 0
+        self.expired_sessions = 0
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def _grow(self):
+        slots_before = len(self.heads)
+        points = array('d', bytes(8 * self.capacity * GROW_SLOTS))
+        self.times.extend(points)
+        self.latitudes.extend(points)
+        self.longitudes.extend(points)
+        self.heads.extend(array('L', bytes(self.heads.itemsize * GROW_SLOTS)))
+        self.counts.extend(array('L', bytes(self.counts.itemsize * GROW_SLOTS)))
+        self.odometers.extend(array('d', bytes(8 * GROW_SLOTS)))
+        self.last_times.extend(array('d', bytes(8 * GROW_SLOTS)))
+        self._free_slots.extend(range(slots_before + GROW_SLOTS - 1, slots_before - 1, -1)) # pop() выдает младшие слоты первыми
+
+    def record(self, session_id: str, timestamp: float, latitude: float, longitude: float) -> bool:
+        """Добавляет точку в историю сессии; False - точка отброшена (не по порядку или нет места для новой сессии)."""
+        with self.lock:
+            slot = self.slots.get(session_id)
+            if slot is None:
+                if len(self.slots) >= self.max_sessions:
+                    self.rejected_sessions += 1
+                    return False
+                if not self._free_slots:
+                    self._grow()
+                slot = self.slots[session_id] = self._free_slots.pop()
+                self.heads[slot] = self.counts[slot] = 0
+                self.odometers[slot] = 0.0
+            capacity = self.capacity
+            head, count = self.heads[slot], self.counts[slot]
+            if count:
+                if timestamp < self.last_times[slot]:
+                    self.out_of_order += 1
+                    return False
+                last = slot * capacity + (head - 1) % capacity
+                self.odometers[slot] += haversine_meters(self.latitudes[last], self.longitudes[last], latitude, longitude)
+            position = slot * capacity + head
+            self.times[position] = timestamp
+            self.latitudes[position] = latitude
+            self.longitudes[position] = longitude
+            self.heads[slot] = (head + 1) % capacity
+            if count < capacity:
+                self.counts[slot] = count + 1
+            self.last_times[slot] = timestamp
+            self.recorded += 1
+            return True
+
+    def _positions(self, slot: int, newest_first: bool = False) -> list[int]:
+        """Индексы точек слота в массивах от старой к новой (или наоборот). Только под замком."""
+        capacity, head, count = self.capacity, self.heads[slot], self.counts[slot]
+        base = slot * capacity
+        positions = [base + (head - count + i) % capacity for i in range(count)]
+        if newest_first:
+            positions.reverse()
+        return positions
+
+    def last_position(self, session_id: str) -> tuple[float, float, float] | None:
+        """(время, широта, долгота) последней точки; None - истории нет."""
+        with self.lock:
+            slot = self.slots.get(session_id)
+            if slot is None:
+                return None
+            last = slot * self.capacity + (self.heads[slot] - 1) % self.capacity
+            return self.times[last], self.latitudes[last], self.longitudes[last]
+
+    def speed_mps(self, session_id: str, window_seconds: float = 60.0) -> float | None:
+        """Средняя скорость по точкам буфера за последние window_seconds, м/с (путь по точкам / время);
+        None - меньше двух точек в окне."""
+        with self.lock:
+            slot = self.slots.get(session_id)
+            if slot is None:
+                return None
+            times, latitudes, longitudes = self.times, self.latitudes, self.longitudes
+            positions = self._positions(slot, newest_first=True)
+            newest = positions[0]
+            distance_m, previous, oldest = 0.0, newest, newest
+            for position in positions[1:]:
+                if times[position] < times[newest] - window_seconds:
+                    break
+                distance_m += haversine_meters(latitudes[position], longitudes[position], latitudes[previous], longitudes[previous])
+                previous = oldest = position
+            elapsed = times[newest] - times[oldest]
+            return distance_m / elapsed if elapsed > 0 else None
+
+    def distance_m(self, session_id: str) -> float | None:
+        """Путь сессии с первой геолокации, метров; None - истории нет."""
+        with self.lock:
+            slot = self.slots.get(session_id)
+            return self.odometers[slot] if slot is not None else None
+
+    def track(self, session_id: str) -> list[tuple[float, float, float]]:
+        """Точки буфера (время, широта, долгота) от старой к новой."""
+        with self.lock:
+            slot = self.slots.get(session_id)
+            if slot is None:
+                return []
+            return [(self.times[i], self.latitudes[i], self.longitudes[i]) for i in self._positions(slot)]
+
+    def remove(self, session_id: str) -> bool:
+        with self.lock:
+            slot = self.slots.pop(session_id, None)
+            if slot is None:
+                return False
+            self._free_slots.append(slot)
+            return True
+
+    def expire_idle(self, cutoff_timestamp: float) -> int:
+        """Освобождает слоты сессий без геолокаций с cutoff_timestamp. Проверка - без замка по снимку,
+        удаление - частями, чтобы запись из потоков UDP не ждала проход по всем сессиям."""
+        with self.lock:
+            snapshot = list(self.slots.items())
+        last_times = self.last_times
+        idle = [(session_id, slot) for session_id, slot in snapshot if last_times[slot] < cutoff_timestamp]
+        expired = 0
+        for chunk_start in range(0, len(idle), EXPIRE_CHUNK):
+            with self.lock:
+                for session_id, slot in idle[chunk_start:chunk_start + EXPIRE_CHUNK]:
+                    # Перепроверка: с момента снимка сессия могла прислать точку или слот мог смениться
+                    if self.slots.get(session_id) == slot and self.last_times[slot] < cutoff_timestamp:
+                        del self.slots[session_id]
+                        self._free_slots.append(slot)
+                        expired += 1
+        with self.lock:
+            self.expired_sessions += expired
+        return expired
+
+    def array_bytes(self) -> int:
+        """Память массивов истории (все выделенные слоты, включая свободные)."""
+        return sum(len(values) * values.itemsize for values in (self.times, self.latitudes, self.longitudes, self.heads,
+                                                                self.counts, self.odometers, self.last_times))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"sessions": len(self.slots), "capacity_points": self.capacity, "max_sessions": self.max_sessions,
+                    "allocated_slots": len(self.heads), "free_slots": len(self._free_slots),
+                    "array_bytes": self.array_bytes(), "bytes_per_slot": self.capacity * 24 + 32,
+                    "recorded": self.recorded, "out_of_order": self.out_of_order,
+                    "rejected_sessions": self.rejected_sessions, "expired_sessions": self.expired_sessions}
@@ -0,0 +1,315 @@
+# server/metrics.py
+# Счетчики и гистограммы задержек для сервера, экспорт в текстовом формате Prometheus.
+import os
+import threading
+import weakref
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+# Границы корзин гистограммы задержек, секунды (последняя корзина - "больше 10 с")
+LATENCY_BUCKETS_SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """Гистограмма с фиксированными корзинами: observe() - O(log корзин), память постоянная."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_SECONDS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_seconds = 0.0
+
+    def observe(self, seconds: float):
+        self.bucket_counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+
+    def copy(self) -> "LatencyHistogram":
+        histogram = LatencyHistogram(self.buckets)
+        histogram.bucket_counts = list(self.bucket_counts)
+        histogram.count = self.count
+        histogram.total_seconds = self.total_seconds
+        return histogram
+
+    def quantile(self, q: float) -> float | None:
+        """Оценка квантиля - верхняя граница корзины, в которую он попадает."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_seconds / self.count * 1000, 3) if self.count else None,
+            "p50_le_ms": _ms(self.quantile(0.5)),
+            "p95_le_ms": _ms(self.quantile(0.95)),
+            "p99_le_ms": _ms(self.quantile(0.99)),
+            "buckets_le_ms": {_bucket_label(b): c for b, c in zip(self.buckets + (float("inf"),), self.bucket_counts)},
+        }
+
+
+def _ms(seconds: float | None):
+    if seconds is None:
+        return None
+    return "inf" if seconds == float("inf") else round(seconds * 1000, 3)
+
+def _bucket_label(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else f"{bound * 1000:g}"
+
+
+class ActionStats:
+    __slots__ = ("requests", "errors", "latency")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+
+class ActionMetrics:
+    """Счетчики запросов/ошибок и гистограммы задержек по имени действия."""
+
+    def __init__(self):
+        self._actions: dict[str, ActionStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, action: str, seconds: float, error: bool = False):
+        with self._lock:
+            stats = self._actions.get(action)
+            if stats is None:
+                stats = self._actions[action] = ActionStats()
+            stats.requests += 1
+            if error:
+                stats.errors += 1
+            stats.latency.observe(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                action: {"requests": stats.requests, "errors": stats.errors,
+                         "total_seconds": round(stats.latency.total_seconds, 6), "latency": stats.latency.snapshot()}
+                for action, stats in self._actions.items()
+            }
+
+    def copy_stats(self) -> dict[str, tuple[int, int, LatencyHistogram]]:
+        """action -> (запросы, ошибки, копия гистограммы) - согласованный срез для экспорта."""
+        with self._lock:
+            return {action: (stats.requests, stats.errors, stats.latency.copy()) for action, stats in self._actions.items()}
+
+
+# ========================
+# Счетчики для горячих путей (циклы recv/accept): без замков
+# ========================
+class _CellOwner:
+    """Живет в threading.local потока: сборка после завершения потока переносит его счет в базу."""
+    __slots__ = ("cell", "__weakref__")
+
+    def __init__(self, cell: list):
+        self.cell = cell
+
+
+class Counter:
+    """Монотонный счетчик. У каждого потока своя ячейка (список из одного int), которую пишет только он,
+    поэтому inc() обходится без замка; value суммирует ячейки при чтении. Ячейка завершившегося потока
+    переносится в _base, и потоки на соединение (ThreadingTCPServer) не копят ячейки."""
+    __slots__ = ("_local", "_cells", "_base", "_lock")
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells: list[list] = []
+        self._base = 0
+        self._lock = threading.RLock() # Регистрация и перенос ячеек; перенос может сработать из сборки мусора в value
+
+    def inc(self):
+        try:
+            self._local.owner.cell[0] += 1
+        except AttributeError:
+            self._new_cell()[0] += 1
+
+    def _new_cell(self) -> list:
+        cell = [0]
+        owner = self._local.owner = _CellOwner(cell)
+        with self._lock:
+            self._cells.append(cell)
+        weakref.finalize(owner, self._retire_cell, cell)
+        return cell
+
+    def _retire_cell(self, cell: list):
+        with self._lock:
+            self._base += cell[0]
+            self._cells.remove(cell)
+
+    @property
+    def value(self) -> int:
+        with self._lock: # Только чтение при экспорте; inc() этот замок не берет
+            return self._base + sum(cell[0] for cell in self._cells)
+
+
+class ActiveGauge:
+    """Число активных обработчиков как разность двух счетчиков без замка (вход - выход)."""
+    __slots__ = ("entered", "exited")
+
+    def __init__(self):
+        self.entered = Counter()
+        self.exited = Counter()
+
+    def enter(self):
+        self.entered.inc()
+
+    def exit(self):
+        self.exited.inc()
+
+    @property
+    def value(self) -> int:
+        exited = self.exited.value # Сначала выходы: значение не уйдет в минус при гонке с чтением
+        return self.entered.value - exited
+
+
+class BroadcastCycleStats:
+    """Сообщения и байты рассылки WebSocket по циклам рассылки. Пишет только цикл событий WS;
+    экспорт читает готовые числа (last_cycle и итоги), замок не нужен."""
+
+    def __init__(self):
+        self.events = 0
+        self.frames = 0
+        self.bytes = 0
+        self.deflate_bytes_estimate = 0
+        self._clients: set = set()
+        self.last_cycle: dict | None = None
+        self.cycles = 0
+        self.total_frames = 0
+        self.total_bytes = 0
+
+    def record_events(self, count: int = 1):
+        self.events += count
+
+    def record_frame(self, clients: list, frame_bytes: int, deflate_bytes: int | None = None):
+        """Один кадр размером frame_bytes отправлен каждому из clients."""
+        self.frames += len(clients)
+        self.bytes += frame_bytes * len(clients)
+        self.deflate_bytes_estimate += (deflate_bytes if deflate_bytes is not None else frame_bytes) * len(clients)
+        self._clients.update(clients)
+        self.total_frames += len(clients)
+        self.total_bytes += frame_bytes * len(clients)
+
+    def finish_cycle(self) -> dict:
+        clients = len(self._clients)
+        self.last_cycle = {
+            "events": self.events,
+            "clients": clients,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "deflate_bytes_estimate": self.deflate_bytes_estimate,
+            "frames_per_client": round(self.frames / clients, 3) if clients else 0,
+            "bytes_per_client": round(self.bytes / clients, 1) if clients else 0,
+            "deflate_bytes_per_client_estimate": round(self.deflate_bytes_estimate / clients, 1) if clients else 0,
+        }
+        self.cycles += 1
+        self.events = self.frames = self.bytes = self.deflate_bytes_estimate = 0
+        self._clients = set()
+        return self.last_cycle
+
+    def snapshot(self) -> dict:
+        return {"cycles": self.cycles, "total_frames": self.total_frames, "total_bytes": self.total_bytes, "last_cycle": self.last_cycle}
+
+
+# ========================
+# Память процесса
+# ========================
+PAGE_SIZE_BYTES = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_rss_bytes() -> int | None:
+    """Текущий RSS своего процесса из /proc/self/statm (Linux); None - недоступно на платформе."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE_BYTES
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# ========================
+# Текстовый формат Prometheus (exposition format 0.0.4)
+# ========================
+class PrometheusText:
+    """Собирает метрики одного ответа /metrics. Сэмплы группируются по имени метрики:
+    формат требует, чтобы строки одной метрики шли подряд, даже если добавлялись вперемешку."""
+
+    def __init__(self):
+        self._families: dict[str, list[str]] = {} # имя -> строки HELP/TYPE и сэмплы
+
+    def _family(self, name: str, metric_type: str, help_text: str) -> list[str]:
+        lines = self._families.get(name)
+        if lines is None:
+            lines = self._families[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        return lines
+
+    def counter(self, name: str, help_text: str, value: float, labels: dict | None = None):
+        self._family(name, "counter", help_text).append(_format_sample(name, value, labels))
+
+    def gauge(self, name: str, help_text: str, value: float, labels: dict | None = None):
+        self._family(name, "gauge", help_text).append(_format_sample(name, value, labels))
+
+    def histogram(self, name: str, help_text: str, histogram: LatencyHistogram, labels: dict | None = None):
+        lines = self._family(name, "histogram", help_text)
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + (float("inf"),), histogram.bucket_counts):
+            cumulative += bucket_count
+            lines.append(_format_sample(f"{name}_bucket", cumulative, {**(labels or {}), "le": "+Inf" if bound == float("inf") else f"{bound:g}"}))
+        lines.append(_format_sample(f"{name}_sum", histogram.total_seconds, labels))
+        lines.append(_format_sample(f"{name}_count", histogram.count, labels))
+
+    def render(self) -> str:
+        return "\n".join(line for lines in self._families.values() for line in lines) + "\n"
+
+
+def _format_sample(name: str, value: float, labels: dict | None) -> str:
+    return f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+def _format_labels(labels: dict | None) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(str(value))}"' for key, value in labels.items()) + "}"
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(value) if isinstance(value, float) else str(int(value))
+
+
+def start_metrics_http_server(host: str, port: int, collect: Callable[[], str]) -> ThreadingHTTPServer:
+    """HTTP сервер метрик в фоновом потоке: GET /metrics -> collect()."""
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            try:
+                body = collect().encode("utf-8")
+            except Exception as e_collect:
+                self.send_error(500, f"metrics collection failed: {e_collect}")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Запросы сборщика метрик не пишем в лог
+
+    http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True, name="metrics-http").start()
+    return http_server
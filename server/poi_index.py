@@ -0,0 +1,283 @@
+# server/poi_index.py
+# Точки интереса (POI) для гео-подсказок UDP сервера: пространственный индекс и горячая перезагрузка файла.
+#
+# Файл POI - CSV в UTF-8 с заголовком latitude,longitude,name[,hint]; строки с неверными координатами пропускаются.
+# Индекс - сетка по широте/долготе с квадратной ячейкой cell_degrees (по умолчанию подбирается по плотности
+# точек: в среднем ~TARGET_POIS_PER_CELL на занятую ячейку). Точки отсортированы по ячейке и лежат в плоских массивах
+# array('d'), словарь ключ ячейки -> ее номер, границы ячеек - в array('L'). Поиск k ближайших в радиусе обходит ячейки
+# кольцами вокруг ячейки запроса и останавливается, когда следующее кольцо заведомо дальше радиуса или k-й
+# найденной точки: время запроса зависит от плотности точек рядом, а не от их общего числа.
+# Расстояние - равнопромежуточная проекция вокруг точки запроса (для радиусов до десятков км ошибка < 0.1%);
+# точки по ту сторону линии смены дат (долгота +-180) не ищутся.
+# Названия и подсказки хранятся одной строкой со смещениями: в индексе нет миллионов объектов,
+# которые сборщик мусора обходил бы на каждой полной сборке (паузы всех потоков, в том числе приема UDP).
+#
+# Перезагрузка: PoiDataset следит за mtime файла из фонового потока, новый индекс строится там же
+# и подменяет старый одним присваиванием - поток приема UDP загрузку никогда не ждет.
+# Файл лучше заменять атомарно (запись во временный файл + rename), иначе можно прочитать его наполовину.
+import csv
+import heapq
+import math
+import os
+import threading
+import time
+from array import array
+
+from server.async_log import server_log
+
+METERS_PER_DEGREE = 111_195.0 # Длина градуса меридиана (сфера радиусом 6371 км)
+TARGET_POIS_PER_CELL = 8
+CELL_SIZE_SAMPLE = 20_000 # Точек выборки для подбора размера ячейки
+CELL_SIZE_ROUNDS = 6 # Максимум уточнений размера ячейки по выборке
+MIN_CELL_DEGREES = 0.001 # ~110 м
+MAX_CELL_DEGREES = 1.0
+MAX_COS_LATITUDE_DEGREES = 89.0 # Ближе к полюсу ячейки по долготе не сужаем - иначе колец становится слишком много
+# Предел колец на запрос (до (2 * 64 + 1)^2 ~ 16.6k ячеек): у полюса узкие по долготе ячейки требовали бы сотни
+# колец на радиус, и одна датаграмма с широтой ~89 занимала бы поток на секунды. Там поиск ограничен этими кольцами.
+MAX_SEARCH_RINGS = 64
+CELL_KEY_STRIDE = 1 << 20 # Ключ ячейки = строка * CELL_KEY_STRIDE + столбец; |столбец| <= 180 / MIN_CELL_DEGREES < CELL_KEY_STRIDE / 2
+
+
+def pack_texts(texts: list[str]) -> tuple[str, array]:
+    """Список строк -> (одна строка, смещения начала каждой и конца последней)."""
+    offsets = array('L', [0])
+    position = 0
+    for text in texts:
+        position += len(text)
+        offsets.append(position)
+    return "".join(texts), offsets
+
+
+def choose_cell_degrees(latitudes: array, longitudes: array) -> float:
+    """Размер ячейки, при котором на занятую ячейку в среднем приходится ~TARGET_POIS_PER_CELL точек.
+    Реальные POI сосредоточены в городах, поэтому средняя плотность ограничивающего прямоугольника не годится:
+    по выборке считается, какую площадь точки занимают на самом деле (занятые ячейки), и сетка мельчает,
+    пока в занятой ячейке остается хотя бы пара точек выборки - мельче площадь по выборке уже не оценить."""
+    if not latitudes:
+        return MAX_CELL_DEGREES
+    step = max(1, len(latitudes) // CELL_SIZE_SAMPLE)
+    sample_latitudes, sample_longitudes = latitudes[::step], longitudes[::step]
+    area = (max(max(sample_latitudes) - min(sample_latitudes), MIN_CELL_DEGREES)
+            * max(max(sample_longitudes) - min(sample_longitudes), MIN_CELL_DEGREES))
+    cell = math.sqrt(area * TARGET_POIS_PER_CELL / len(sample_latitudes)) # ~TARGET точек выборки на ячейку без кучности
+    for _ in range(CELL_SIZE_ROUNDS):
+        if cell <= MIN_CELL_DEGREES:
+            break
+        occupied_cells = len({(math.floor(latitude / cell), math.floor(longitude / cell))
+                              for latitude, longitude in zip(sample_latitudes, sample_longitudes)})
+        if len(sample_latitudes) < 2 * occupied_cells:
+            break
+        finer_cell = math.sqrt(occupied_cells * cell * cell * TARGET_POIS_PER_CELL / len(latitudes))
+        if finer_cell >= cell * 0.9:
+            cell = min(cell, finer_cell)
+            break
+        cell = finer_cell
+    return min(MAX_CELL_DEGREES, max(MIN_CELL_DEGREES, cell))
+
+
+class PoiIndex:
+    """Неизменяемый после построения индекс; nearest() можно вызывать из любых потоков одновременно."""
+
+    def __init__(self, latitudes: array, longitudes: array, names: list[str], hints: list[str],
+                 cell_degrees: float | None = None):
+        count = len(latitudes)
+        self.cell_degrees = cell_degrees or choose_cell_degrees(latitudes, longitudes)
+        floor = math.floor
+        inverse_cell = 1.0 / self.cell_degrees
+        # Группировка циклом Python, а не sorted(): один долгий вызов C держит GIL и на секунды остановил бы
+        # поток приема UDP, пока индекс перестраивается в фоне
+        buckets: dict[int, list[int]] = {}
+        for i in range(count):
+            key = floor(latitudes[i] * inverse_cell) * CELL_KEY_STRIDE + floor(longitudes[i] * inverse_cell)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [i]
+            else:
+                bucket.append(i)
+        self.cells: dict[int, int] = {} # Ключ ячейки -> номер; только int - сборщик мусора словарь не отслеживает
+        self.cell_starts = array('L', [0]) # Точки ячейки j - [cell_starts[j], cell_starts[j + 1]) в массивах
+        order: list[int] = []
+        for key, bucket in buckets.items():
+            self.cells[key] = len(self.cells)
+            order.extend(bucket)
+            self.cell_starts.append(len(order))
+        del buckets
+        self.latitudes = array('d', [latitudes[i] for i in order])
+        self.longitudes = array('d', [longitudes[i] for i in order])
+        self._names, self._name_offsets = pack_texts([names[i].replace("\n", " ") for i in order])
+        self._hints, self._hint_offsets = pack_texts([hints[i] for i in order])
+
+    def name(self, i: int) -> str:
+        return self._names[self._name_offsets[i]:self._name_offsets[i + 1]]
+
+    def hint(self, i: int) -> str:
+        return self._hints[self._hint_offsets[i]:self._hint_offsets[i + 1]]
+
+    def __len__(self) -> int:
+        return len(self.latitudes)
+
+    def nearest(self, latitude: float, longitude: float, k: int = 3, radius_m: float = 1000.0) -> list[tuple[float, int]]:
+        """k ближайших POI не дальше radius_m: [(расстояние в метрах, номер POI)] по возрастанию расстояния.
+        Обходит не больше MAX_SEARCH_RINGS колец: у полюсов дальние точки в пределах радиуса могут не найтись."""
+        cells, cell_starts = self.cells, self.cell_starts
+        if not cells or k <= 0:
+            return []
+        cell_degrees = self.cell_degrees
+        row_key, column = math.floor(latitude / cell_degrees) * CELL_KEY_STRIDE, math.floor(longitude / cell_degrees)
+        meters_per_degree_lon = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+        # Кольцо ячеек не ближе ширины ячейки по самой узкой ее стороне в пределах радиуса (к полюсу ячейки сужаются)
+        widest_latitude = min(MAX_COS_LATITUDE_DEGREES, abs(latitude) + radius_m / METERS_PER_DEGREE + cell_degrees)
+        ring_step_m = cell_degrees * METERS_PER_DEGREE * math.cos(math.radians(widest_latitude))
+        latitudes, longitudes = self.latitudes, self.longitudes
+        radius_sq = radius_m * radius_m
+        best: list[tuple[float, int]] = [] # Куча (-квадрат расстояния, номер) размером до k
+        limit_sq = radius_sq
+        ring = 0
+        while ring <= MAX_SEARCH_RINGS:
+            if ring > 0:
+                gap_m = (ring - 1) * ring_step_m # Точки кольца ring не ближе этого
+                if gap_m * gap_m > limit_sq:
+                    break
+            if ring == 0:
+                ring_keys = (row_key + column,)
+            else:
+                ring_keys = [row_key + dy * CELL_KEY_STRIDE + column + dx for dy in (-ring, ring) for dx in range(-ring, ring + 1)]
+                ring_keys += [row_key + dy * CELL_KEY_STRIDE + column + dx for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+            for key in ring_keys:
+                cell = cells.get(key)
+                if cell is None:
+                    continue
+                for i in range(cell_starts[cell], cell_starts[cell + 1]):
+                    dy_m = (latitudes[i] - latitude) * METERS_PER_DEGREE
+                    dx_m = (longitudes[i] - longitude) * meters_per_degree_lon
+                    distance_sq = dy_m * dy_m + dx_m * dx_m
+                    if distance_sq > limit_sq:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance_sq, i))
+                        if len(best) == k:
+                            limit_sq = -best[0][0]
+                    else:
+                        heapq.heapreplace(best, (-distance_sq, i))
+                        limit_sq = -best[0][0]
+            ring += 1
+        return sorted((math.sqrt(-negative_sq), i) for negative_sq, i in best)
+
+    def scan_nearest(self, latitude: float, longitude: float, k: int = 3, radius_m: float = 1000.0) -> list[tuple[float, int]]:
+        """То же, что nearest(), полным перебором точек (проверка индекса в нагрузочном тесте)."""
+        meters_per_degree_lon = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+        found = []
+        for i, (poi_latitude, poi_longitude) in enumerate(zip(self.latitudes, self.longitudes)):
+            distance = math.hypot((poi_latitude - latitude) * METERS_PER_DEGREE, (poi_longitude - longitude) * meters_per_degree_lon)
+            if distance <= radius_m:
+                found.append((distance, i))
+        return heapq.nsmallest(k, found)
+
+
+def load_poi_csv(path: str, cell_degrees: float | None = None) -> tuple[PoiIndex, int]:
+    """Читает файл POI и строит индекс -> (индекс, число пропущенных строк). ValueError - нет нужных колонок."""
+    latitudes, longitudes = array('d'), array('d')
+    names: list[str] = []
+    hints: list[str] = []
+    skipped_rows = 0
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = [column.strip().lower() for column in next(reader, [])]
+        missing = [column for column in ("latitude", "longitude", "name") if column not in header]
+        if missing:
+            raise ValueError(f"В заголовке файла POI нет колонок {missing}")
+        latitude_column, longitude_column, name_column = header.index("latitude"), header.index("longitude"), header.index("name")
+        hint_column = header.index("hint") if "hint" in header else None
+        for row in reader:
+            try:
+                latitude, longitude = float(row[latitude_column]), float(row[longitude_column])
+                name = row[name_column].strip()
+                hint = row[hint_column].strip() if hint_column is not None and hint_column < len(row) else ""
+            except (ValueError, IndexError):
+                skipped_rows += 1
+                continue
+            if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0) or not name:
+                skipped_rows += 1
+                continue
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            names.append(name)
+            hints.append(hint)
+    return PoiIndex(latitudes, longitudes, names, hints, cell_degrees), skipped_rows
+
+
+class PoiDataset:
+    """Текущий индекс POI из файла. Читатели берут self.index один раз на запрос (присваивание ссылки
+    атомарно, индекс после построения не меняется), поэтому замки им не нужны; None - файл еще не загружен."""
+
+    def __init__(self, path: str, check_interval_seconds: float = 10.0, cell_degrees: float | None = None):
+        self.path = path
+        self.check_interval_seconds = check_interval_seconds
+        self.cell_degrees = cell_degrees
+        self.index: PoiIndex | None = None
+        self.loaded_mtime_ns: int | None = None
+        self.loads = 0
+        self.load_errors = 0
+        self.skipped_rows = 0
+        self.last_load_seconds: float | None = None
+        self.last_error: str | None = None
+        self._reload_lock = threading.Lock() # Только между фоновым потоком и явным reload()
+        self._stop_event = threading.Event()
+        self._watcher_thread: threading.Thread | None = None
+
+    def reload(self, force: bool = False) -> bool:
+        """Перечитывает файл, если он изменился (или force); True - индекс заменен. Старый индекс
+        остается в работе, пока строится новый, и при ошибке чтения."""
+        with self._reload_lock:
+            try:
+                mtime_ns = os.stat(self.path).st_mtime_ns
+            except OSError as e_stat:
+                if self.last_error != str(e_stat): # Не повторяем одно и то же сообщение каждую проверку
+                    self.last_error = str(e_stat)
+                    server_log.warning("UDP", "poi.missing", "Файл POI недоступен: {error}", error=e_stat)
+                return False
+            if not force and mtime_ns == self.loaded_mtime_ns:
+                return False
+            self.loaded_mtime_ns = mtime_ns # И при ошибке: битый файл перечитаем только после следующего изменения
+            started_at = time.perf_counter()
+            try:
+                index, skipped_rows = load_poi_csv(self.path, self.cell_degrees)
+            except (OSError, ValueError, UnicodeDecodeError, csv.Error) as e_load:
+                self.load_errors += 1
+                self.last_error = str(e_load)
+                server_log.error("UDP", "poi.load_error", "Ошибка загрузки POI из '{path}': {error}", path=self.path, error=e_load)
+                return False
+            self.index = index
+            self.loads += 1
+            self.skipped_rows = skipped_rows
+            self.last_load_seconds = time.perf_counter() - started_at
+            self.last_error = None
+            server_log.info("UDP", "poi.loaded", "POI загружены из '{path}': {count} точек (пропущено строк {skipped}), ячейка {cell:.4f} град., за {seconds:.2f} с",
+                            path=self.path, count=len(index), skipped=skipped_rows, cell=index.cell_degrees, seconds=self.last_load_seconds)
+            return True
+
+    def start(self):
+        """Первая загрузка и слежение за файлом - в фоновом потоке; UDP сервер до загрузки отвечает без POI."""
+        self._watcher_thread = threading.Thread(target=self._watch_loop, daemon=True, name="poi-reload")
+        self._watcher_thread.start()
+
+    def _watch_loop(self):
+        self.reload()
+        while not self._stop_event.wait(self.check_interval_seconds):
+            try:
+                self.reload()
+            except Exception as e_reload: # Поток слежения не должен умирать
+                server_log.error("UDP", "poi.reload_error", "Ошибка перезагрузки POI: {error}", error=e_reload)
+
+    def close(self):
+        self._stop_event.set()
+        if self._watcher_thread is not None:
+            self._watcher_thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        index = self.index
+        return {"path": self.path, "pois": len(index) if index is not None else 0,
+                "cells": len(index.cells) if index is not None else 0,
+                "cell_degrees": index.cell_degrees if index is not None else None,
+                "loads": self.loads, "load_errors": self.load_errors, "skipped_rows": self.skipped_rows,
+                "last_load_seconds": self.last_load_seconds, "last_error": self.last_error}
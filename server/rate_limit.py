@@ -0,0 +1,70 @@
+# server/rate_limit.py
+# Ограничение частоты запросов: token bucket на каждый ключ (IP клиента или session_id).
+# Корзина пополняется со скоростью rate токенов в секунду до burst; запрос тратит один токен.
+# Пополнение считается "лениво" при обращении к ключу - фоновых таймеров нет.
+import threading
+import time
+
+
+class TokenBucketLimiter:
+    """Потокобезопасный набор token bucket по ключам. rate <= 0 - ограничение выключено.
+    Полностью пополненные корзины неотличимы от новых, поэтому при росте числа ключей
+    сверх max_keys они удаляются без изменения поведения. Если удалять нечего (все ключи
+    активны или чистка была меньше секунды назад), вытесняется самый старый ключ: число
+    корзин не превышает max_keys, даже если клиент перебирает ключи."""
+
+    def __init__(self, rate_per_second: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate_per_second
+        self.burst = max(1.0, float(burst))
+        self.max_keys = max_keys
+        self._buckets: dict = {} # ключ -> [токены, время последнего пополнения (monotonic)]
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self.allowed = 0
+        self.dropped = 0
+        self.evicted = 0 # Ключей, вытесненных при полной таблице
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key) -> float:
+        """Тратит токен ключа. Возвращает 0.0, если запрос разрешен,
+        иначе - через сколько секунд появится следующий токен (запрос нужно отклонить)."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._prune(now)
+                    if len(self._buckets) >= self.max_keys:
+                        del self._buckets[next(iter(self._buckets))] # Порядок вставки: первый - самый старый
+                        self.evicted += 1
+                self._buckets[key] = [self.burst - 1.0, now]
+                self.allowed += 1
+                return 0.0
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1.0:
+                bucket[0] = tokens - 1.0
+                self.allowed += 1
+                return 0.0
+            bucket[0] = tokens
+            self.dropped += 1
+            return (1.0 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        """Удаляет корзины, которые успели пополниться полностью (вызывать под self._lock)."""
+        if now - self._last_prune < 1.0:
+            return # Все ключи активны - не сканируем словарь на каждом новом ключе
+        self._last_prune = now
+        refill_seconds = self.burst / self.rate
+        for key in [k for k, (tokens, updated_at) in self._buckets.items() if now - updated_at >= refill_seconds]:
+            del self._buckets[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst, "keys": len(self._buckets),
+                    "allowed": self.allowed, "dropped": self.dropped, "evicted": self.evicted}
@@ -0,0 +1,205 @@
+# server/session_journal.py
+# Журнал сессий на диске: переживает перезапуск сервера без массового пересоздания сессий.
+#
+# Файлы в каталоге журнала:
+#   sessions.snapshot  - компактный бинарный снапшот всех живых сессий (пишется при компакции);
+#   sessions.log       - append-only журнал изменений после снапшота, по строке JSON на запись;
+#   sessions.log.old   - журнал прерванной компакции прежних версий (воспроизводится при загрузке,
+#                        удаляется следующей компакцией).
+#
+# Изменения из SessionStore попадают в буфер (словарь session_id -> последнее состояние),
+# фоновый поток раз в flush_interval_seconds дописывает буфер в журнал. Повторные
+# продления одной сессии между сбросами схлопываются в одну запись.
+import json
+import os
+import sys
+import struct
+import threading
+import time
+from array import array
+
+from server.session_store import ColdSessions, SessionStore
+
+SNAPSHOT_FILE_NAME = "sessions.snapshot"
+LOG_FILE_NAME = "sessions.log"
+
+# Формат снапшота: MAGIC, заголовок, затем блоки:
+#   session_id через "\n" (отсортированы), user_name через "\0",
+#   last_seen (double[n]), tcp_connection_time (double[n]), порядок истечения (uint32[n]).
+SNAPSHOT_MAGIC = b"PR7SNAP1"
+SNAPSHOT_HEADER = struct.Struct("!BQQQ") # порядок байт массивов (0 - little, 1 - big), n, длина блока id, длина блока имен
+
+
+class SessionJournal:
+    def __init__(self, directory: str, flush_interval_seconds: float = 1.0,
+                 compact_after_records: int = 200_000, fsync: bool = False):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE_NAME)
+        self.log_path = os.path.join(directory, LOG_FILE_NAME)
+        self.old_log_path = self.log_path + ".old"
+        self.flush_interval_seconds = flush_interval_seconds
+        self.compact_after_records = compact_after_records
+        self.fsync = fsync
+
+        self._pending: dict[str, tuple | None] = {} # None - сессия удалена
+        self._pending_lock = threading.Lock()
+        self._log_file = None
+        self._records_since_compaction = 0
+        self._stop_event = threading.Event()
+        self._writer_thread: threading.Thread | None = None
+
+    # ---- Вызывается из SessionStore (на пути запроса - только запись в словарь) ----
+
+    def record_put(self, session_id: str, session: dict):
+        with self._pending_lock:
+            self._pending[session_id] = (session["user_name"], session["last_seen"], session["tcp_connection_time"])
+
+    def record_remove(self, session_id: str):
+        with self._pending_lock:
+            self._pending[session_id] = None
+
+    # ---- Восстановление ----
+
+    def load_into(self, store: SessionStore) -> dict:
+        """Загружает снапшот и воспроизводит журнал поверх него. Вызывать до start()."""
+        started_at = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_count = 0
+        if os.path.exists(self.snapshot_path):
+            cold = read_snapshot(self.snapshot_path)
+            snapshot_count = cold.remaining
+            store.load_cold(cold)
+        replayed = 0
+        for path in (self.old_log_path, self.log_path): # .old старше, если компакция прервалась
+            replayed += self._replay_log(path, store)
+        self._records_since_compaction = replayed
+        return {"snapshot_sessions": snapshot_count, "log_records": replayed,
+                "seconds": time.perf_counter() - started_at}
+
+    def _replay_log(self, path: str, store: SessionStore) -> int:
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Недописанная последняя строка после аварийного завершения
+                if record.get("op") == "put":
+                    store.restore_session(record["sid"], record["u"], record["ls"], record["ct"])
+                else:
+                    store.forget_session(record["sid"])
+                replayed += 1
+        return replayed
+
+    # ---- Фоновая запись ----
+
+    def start(self, store: SessionStore):
+        os.makedirs(self.directory, exist_ok=True)
+        self._log_file = open(self.log_path, "a", encoding="utf-8")
+        self._writer_thread = threading.Thread(target=self._writer_loop, args=(store,), daemon=True, name="session-journal")
+        self._writer_thread.start()
+
+    def _writer_loop(self, store: SessionStore):
+        while not self._stop_event.wait(self.flush_interval_seconds):
+            try:
+                self.flush()
+                if self._records_since_compaction >= self.compact_after_records:
+                    self.compact(store)
+            except Exception as e_journal:
+                print(f"[Sessions Journal] Ошибка записи журнала: {e_journal}")
+
+    def flush(self) -> int:
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self._log_file is None:
+            return 0
+        lines = []
+        for session_id, state in pending.items():
+            if state is None:
+                lines.append(json.dumps({"op": "del", "sid": session_id}))
+            else:
+                lines.append(json.dumps({"op": "put", "sid": session_id, "u": state[0], "ls": state[1], "ct": state[2]}, ensure_ascii=False))
+        self._log_file.write("\n".join(lines) + "\n")
+        self._log_file.flush()
+        if self.fsync:
+            os.fsync(self._log_file.fileno())
+        self._records_since_compaction += len(lines)
+        return len(lines)
+
+    def compact(self, store: SessionStore):
+        """Пишет свежий снапшот и только после этого обнуляет журнал: если запись снапшота упала,
+        старый снапшот и журнал не тронуты. Изменения после снимка хранилища ждут в буфере
+        и попадают уже в новый журнал, поверх снапшота."""
+        started_at = time.perf_counter()
+        self.flush()
+        records = store.snapshot_records()
+        write_snapshot(self.snapshot_path, records, fsync=self.fsync)
+        # Все записи журнала (и .old, воспроизведенного при загрузке) уже в снапшоте
+        self._log_file.close()
+        self._log_file = open(self.log_path, "w", encoding="utf-8")
+        self._records_since_compaction = 0
+        if os.path.exists(self.old_log_path):
+            os.remove(self.old_log_path)
+        print(f"[Sessions Journal] Компакция: {len(records)} сессий за {time.perf_counter() - started_at:.2f} с.")
+
+    def close(self):
+        self._stop_event.set()
+        if self._writer_thread is not None:
+            self._writer_thread.join(timeout=5)
+        if self._log_file is not None:
+            self.flush()
+            self._log_file.close()
+            self._log_file = None
+
+
+def write_snapshot(path: str, records: list[tuple[str, str, float, float]], fsync: bool = False):
+    records.sort() # По session_id - для бинарного поиска при загрузке
+    count = len(records)
+    sid_blob = "\n".join(r[0] for r in records).encode("utf-8")
+    name_blob = "\0".join(str(r[1]).replace("\0", " ") for r in records).encode("utf-8") # str: имя приходит от клиента
+    last_seen = array("d", (r[2] for r in records))
+    created = array("d", (r[3] for r in records))
+    expiry_order = array("I", sorted(range(count), key=last_seen.__getitem__))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(SNAPSHOT_HEADER.pack(0 if sys.byteorder == "little" else 1, count, len(sid_blob), len(name_blob)))
+        f.write(sid_blob)
+        f.write(name_blob)
+        f.write(last_seen.tobytes())
+        f.write(created.tobytes())
+        f.write(expiry_order.tobytes())
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path) # Атомарная замена: старый снапшот валиден до последнего момента
+
+
+def read_snapshot(path: str) -> ColdSessions:
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+    if bytes(data[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path}: неизвестный формат снапшота")
+    pos = len(SNAPSHOT_MAGIC)
+    byteorder_flag, count, sid_len, name_len = SNAPSHOT_HEADER.unpack_from(data, pos)
+    pos += SNAPSHOT_HEADER.size
+
+    def take(length: int) -> memoryview:
+        nonlocal pos
+        chunk = data[pos:pos + length]
+        pos += length
+        return chunk
+
+    sids = str(take(sid_len), "utf-8").split("\n") if count else []
+    names = str(take(name_len), "utf-8").split("\0") if count else []
+    last_seen, created, expiry_order = array("d"), array("d"), array("I")
+    last_seen.frombytes(take(8 * count))
+    created.frombytes(take(8 * count))
+    expiry_order.frombytes(take(expiry_order.itemsize * count))
+    if byteorder_flag != (0 if sys.byteorder == "little" else 1): # Снапшот с машины с другим порядком байт
+        for arr in (last_seen, created, expiry_order):
+            arr.byteswap()
+    return ColdSessions(sids, names, last_seen, created, expiry_order)
@@ -0,0 +1,271 @@
+# server/session_store.py
+# Потокобезопасное хранилище сессий для all_in_one_server.py.
+#
+# Сессии разбиты на шарды, у каждого шарда свой замок (lock striping), поэтому
+# TCP потоки, UDP поток и очистка не блокируют друг друга на одном глобальном замке.
+# Для истечения в каждом шарде ведется куча (heap) дедлайнов: очистка снимает
+# с вершины только те записи, чей дедлайн уже наступил, - O(истекших), а не O(всех).
+#
+# После перезапуска сервера сессии из снапшота (server/session_journal.py) загружаются
+# "холодными": в компактные отсортированные массивы без создания словаря на каждую сессию.
+# Запись переносится в шард при первом обращении к ней, поэтому восстановление 1М сессий
+# занимает доли секунды.
+import heapq
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left
+
+
+class _SessionShard:
+    __slots__ = ("lock", "sessions", "expiry_heap", "created", "expired")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions: dict[str, dict] = {}
+        # (дедлайн, session_id). На каждую живую сессию - ровно одна запись;
+        # продление сессии не трогает кучу: запись переставляется, когда дойдет до вершины.
+        self.expiry_heap: list[tuple[float, str]] = []
+        self.created = 0
+        self.expired = 0
+
+
+class ColdSessions:
+    """Восстановленные из снапшота сессии, к которым еще не обращались.
+    sids отсортированы (поиск - бинарный), expiry_order - индексы в порядке last_seen
+    (истечение - сдвиг указателя). Записи только "забираются", новых не добавляется."""
+
+    def __init__(self, sids: list[str], names: list[str], last_seen: array, created: array, expiry_order: array):
+        self.sids = sids
+        self.names = names
+        self.last_seen = last_seen
+        self.created = created
+        self.expiry_order = expiry_order
+        self.claimed = bytearray(len(sids)) # 1 - запись забрана в шард, удалена или истекла
+        self.remaining = len(sids)
+        self.expiry_pos = 0
+        self.lock = threading.Lock()
+
+    def _index_of(self, session_id: str) -> int | None:
+        i = bisect_left(self.sids, session_id)
+        if i < len(self.sids) and self.sids[i] == session_id and not self.claimed[i]:
+            return i
+        return None
+
+    def claim(self, session_id: str) -> dict | None:
+        """Забирает запись (она больше не считается холодной) и возвращает ее как словарь сессии."""
+        with self.lock:
+            i = self._index_of(session_id)
+            if i is None:
+                return None
+            self.claimed[i] = 1
+            self.remaining -= 1
+            return {"user_name": self.names[i], "last_seen": self.last_seen[i],
+                    "addr": None, "tcp_connection_time": self.created[i]}
+
+    def expire_due(self, now: float, timeout_seconds: float) -> list[str]:
+        expired_ids = []
+        with self.lock:
+            order, last_seen = self.expiry_order, self.last_seen
+            while self.expiry_pos < len(order) and last_seen[order[self.expiry_pos]] + timeout_seconds <= now:
+                i = order[self.expiry_pos]
+                self.expiry_pos += 1
+                if not self.claimed[i]:
+                    self.claimed[i] = 1
+                    self.remaining -= 1
+                    expired_ids.append(self.sids[i])
+        return expired_ids
+
+    def unclaimed_records(self) -> list[tuple[str, str, float, float]]:
+        with self.lock:
+            return [(self.sids[i], self.names[i], self.last_seen[i], self.created[i])
+                    for i in range(len(self.sids)) if not self.claimed[i]]
+
+
+class SessionStore:
+    """Хранилище сессий: { session_id: {"user_name", "last_seen", "addr", "tcp_connection_time"} }.
+    Наружу отдаются копии записей, изменять сессии можно только методами хранилища.
+    Если задан journal (SessionJournal), каждое изменение передается ему для записи на диск
+    в фоне - сам вызов только кладет запись в буфер журнала."""
+
+    def __init__(self, timeout_seconds: float, shard_count: int = 16):
+        if shard_count <= 0 or shard_count & (shard_count - 1):
+            raise ValueError("shard_count должен быть степенью двойки")
+        self.timeout_seconds = timeout_seconds
+        self._shards = [_SessionShard() for _ in range(shard_count)]
+        self._shard_mask = shard_count - 1
+        self._cold: ColdSessions | None = None
+        self.restored = 0
+        self.journal = None
+
+    def _shard_for(self, session_id: str) -> _SessionShard:
+        return self._shards[hash(session_id) & self._shard_mask]
+
+    def _lookup(self, shard: _SessionShard, session_id: str) -> dict | None:
+        """Ищет сессию в шарде, при промахе - среди холодных (вызывать под shard.lock)."""
+        session = shard.sessions.get(session_id)
+        if session is None and self._cold is not None:
+            session = self._cold.claim(session_id)
+            if session is not None:
+                shard.sessions[session_id] = session
+                heapq.heappush(shard.expiry_heap, (session["last_seen"] + self.timeout_seconds, session_id))
+        return session
+
+    def create(self, user_name: str, addr=None, session_id: str | None = None) -> str:
+        """Создает новую сессию и возвращает ее id."""
+        session_id = session_id or str(uuid.uuid4())
+        now = time.time()
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            shard.sessions[session_id] = {
+                "user_name": user_name,
+                "last_seen": now,
+                "addr": addr, # Сохраняем адрес для информации
+                "tcp_connection_time": now
+            }
+            heapq.heappush(shard.expiry_heap, (now + self.timeout_seconds, session_id))
+            shard.created += 1
+            if self.journal is not None:
+                self.journal.record_put(session_id, shard.sessions[session_id])
+        return session_id
+
+    def touch(self, session_id: str | None, user_name: str | None = None) -> dict | None:
+        """Продлевает сессию (и при необходимости меняет имя пользователя).
+        Возвращает копию записи или None, если сессии нет или она уже истекла."""
+        if not session_id or not isinstance(session_id, str): # id приходит от клиента: не строка - не ключ шарда
+            return None
+        now = time.time()
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            session = self._lookup(shard, session_id)
+            if session is None:
+                return None
+            if now - session["last_seen"] > self.timeout_seconds:
+                # Истекла, но очистка до нее еще не дошла - удаляем сразу
+                del shard.sessions[session_id]
+                shard.expired += 1
+                if self.journal is not None:
+                    self.journal.record_remove(session_id)
+                return None
+            session["last_seen"] = now
+            if user_name is not None:
+                session["user_name"] = user_name
+            if self.journal is not None:
+                self.journal.record_put(session_id, session)
+            return dict(session)
+
+    def get(self, session_id: str | None) -> dict | None:
+        if not session_id or not isinstance(session_id, str):
+            return None
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            session = self._lookup(shard, session_id)
+            return dict(session) if session is not None else None
+
+    def remove(self, session_id: str) -> bool:
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            # Запись в куче остается и будет отброшена при снятии с вершины
+            removed = self._lookup(shard, session_id) is not None
+            shard.sessions.pop(session_id, None)
+            if removed and self.journal is not None:
+                self.journal.record_remove(session_id)
+            return removed
+
+    def __contains__(self, session_id) -> bool:
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            return self._lookup(shard, session_id) is not None
+
+    def __len__(self) -> int:
+        cold_count = self._cold.remaining if self._cold is not None else 0
+        return sum(len(shard.sessions) for shard in self._shards) + cold_count
+
+    def expire_due(self, now: float | None = None) -> list[str]:
+        """Удаляет сессии, неактивные дольше timeout_seconds. Возвращает их id.
+        Каждый шард блокируется отдельно и только на время снятия своих записей."""
+        now = time.time() if now is None else now
+        expired_ids = []
+        for shard in self._shards:
+            with shard.lock:
+                heap = shard.expiry_heap
+                while heap and heap[0][0] <= now:
+                    _, session_id = heapq.heappop(heap)
+                    session = shard.sessions.get(session_id)
+                    if session is None:
+                        continue # Сессия уже удалена (remove/touch) - запись устарела
+                    deadline = session["last_seen"] + self.timeout_seconds
+                    if deadline <= now:
+                        del shard.sessions[session_id]
+                        shard.expired += 1
+                        expired_ids.append(session_id)
+                        if self.journal is not None:
+                            self.journal.record_remove(session_id)
+                    else:
+                        heapq.heappush(heap, (deadline, session_id)) # Сессию продлевали - переставляем
+        cold = self._cold
+        if cold is not None:
+            cold_expired_ids = cold.expire_due(now, self.timeout_seconds)
+            expired_ids.extend(cold_expired_ids)
+            with self._shards[0].lock: # Счетчик общий, шард - любой
+                self._shards[0].expired += len(cold_expired_ids)
+            if self.journal is not None:
+                for session_id in cold_expired_ids:
+                    self.journal.record_remove(session_id)
+            if cold.remaining == 0:
+                self._cold = None # Все холодные записи разобраны - освобождаем массивы
+        return expired_ids
+
+    # ---- Восстановление и снапшоты (используется SessionJournal) ----
+
+    def load_cold(self, cold: ColdSessions):
+        """Подключает сессии из снапшота. Вызывается один раз при старте, до обработки запросов."""
+        self._cold = cold
+        self.restored += cold.remaining
+
+    def restore_session(self, session_id: str, user_name: str, last_seen: float, created: float):
+        """Вставляет/перезаписывает сессию при воспроизведении журнала (без записи в журнал)."""
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            session = self._lookup(shard, session_id)
+            if session is None:
+                session = {"user_name": user_name, "last_seen": last_seen, "addr": None, "tcp_connection_time": created}
+                shard.sessions[session_id] = session
+                heapq.heappush(shard.expiry_heap, (last_seen + self.timeout_seconds, session_id))
+                self.restored += 1
+            else:
+                session.update(user_name=user_name, last_seen=last_seen, tcp_connection_time=created)
+
+    def forget_session(self, session_id: str):
+        """Удаляет сессию при воспроизведении журнала (без записи в журнал)."""
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            if self._lookup(shard, session_id) is not None:
+                del shard.sessions[session_id]
+
+    def snapshot_records(self) -> list[tuple[str, str, float, float]]:
+        """Все живые сессии в виде (session_id, user_name, last_seen, tcp_connection_time).
+        Шарды копируются по очереди, каждый под своим замком."""
+        records = []
+        for shard in self._shards:
+            with shard.lock:
+                records.extend((sid, s["user_name"], s["last_seen"], s["tcp_connection_time"])
+                               for sid, s in shard.sessions.items())
+        cold = self._cold
+        if cold is not None:
+            records.extend(cold.unclaimed_records())
+        return records
+
+    def stats(self) -> dict:
+        """Счетчики: живые сессии, созданные, истекшие и восстановленные после перезапуска."""
+        live = created = expired = 0
+        for shard in self._shards:
+            with shard.lock:
+                live += len(shard.sessions)
+                created += shard.created
+                expired += shard.expired
+        cold = self._cold
+        if cold is not None:
+            live += cold.remaining
+        return {"live": live, "created": created, "expired": expired, "restored": self.restored}
@@ -0,0 +1,210 @@
+# server/weather_service.py
+# Погода для действия "get_weather_for_client": общий для всех клиентов кэш с TTL
+# по ключу (город, дата) и склейкой одновременных запросов в один запрос к провайдеру.
+# N пользователей из Москвы в пределах TTL стоят одного обращения к публичному API.
+import os
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Callable
+
+try:
+    import requests
+except ImportError:
+    requests = None
+    print("[Weather] Библиотека requests не найдена. Провайдер WeatherAPI недоступен.")
+
+WEATHER_CACHE_TTL_SECONDS = 10 * 60 # Погода меняется медленно
+WEATHER_ERROR_TTL_SECONDS = 30 # Ошибки провайдера кэшируем коротко, чтобы не долбить API при сбое
+WEATHER_CACHE_MAX_ENTRIES = 10_000
+
+PUBLIC_WEATHER_API_KEY = os.getenv("PUBLIC_WEATHER_API_KEY", "")
+PUBLIC_WEATHER_API_FORECAST_URL = "https://api.weatherapi.com/v1/forecast.json"
+
+# Пороги штормового предупреждения (weather_alert_text)
+ALERT_MAX_TEMP_C = 35.0
+ALERT_MIN_TEMP_C = -25.0
+ALERT_WIND_KPH = 60.0
+ALERT_PRECIP_MM = 30.0
+ALERT_AQI_VALUE = 4 # EPA: 4 - нездоровое и хуже
+
+# Провайдер: (город, смещение дня) -> словарь в формате, который ждет voice_client
+# (city_resolved, temp_c, condition_text, min_t, max_t, aqi_text, ...).
+# Если провайдер не смог получить данные, он заполняет "error_message".
+WeatherProvider = Callable[[str, int], dict]
+
+
+class CoalescingTTLCache:
+    """Потокобезопасный TTL-кэш. Для промаха по ключу только один поток идет к провайдеру,
+    остальные ждут его результат (Future), а не делают параллельные запросы."""
+
+    def __init__(self, ttl_seconds: float, error_ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.error_ttl_seconds = error_ttl_seconds
+        self.max_entries = max_entries
+        self._entries: dict = {} # key -> (истекает_в, значение)
+        self._inflight: dict = {} # key -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_errors = 0
+
+    def get_or_fetch(self, key, fetch: Callable[[], dict]) -> dict:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                self.misses += 1
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            return future.result() # Ждем запрос, который уже выполняет другой поток
+
+        try:
+            value = fetch()
+        except Exception as e_fetch:
+            with self._lock:
+                self.upstream_errors += 1
+                self._inflight.pop(key, None)
+            future.set_exception(e_fetch)
+            raise
+        ttl = self.error_ttl_seconds if value.get("error_message") else self.ttl_seconds
+        with self._lock:
+            if value.get("error_message"):
+                self.upstream_errors += 1
+            if len(self._entries) >= self.max_entries:
+                self._evict_expired(time.time())
+            if len(self._entries) < self.max_entries:
+                self._entries[key] = (time.time() + ttl, value)
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def _evict_expired(self, now: float):
+        for key in [k for k, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced, "upstream_errors": self.upstream_errors}
+
+
+def weatherapi_provider(city: str, date_offset: int) -> dict:
+    """Провайдер по умолчанию - WeatherAPI.com (ключ в переменной окружения PUBLIC_WEATHER_API_KEY)."""
+    requested_date_str = (datetime.now() + timedelta(days=date_offset)).strftime('%Y-%m-%d')
+    weather_data = {
+        "city_resolved": city, "requested_date": requested_date_str,
+        "temp_c": None, "condition_text": "неизвестно (сервер)", "wind_kph": None, "humidity": None,
+        "is_day": 1, "precip_mm": None, "aqi_value": None, "aqi_text": "неизвестно (сервер)",
+        "aqi_source": "N/A", "min_t": None, "max_t": None, "error_message": None,
+    }
+    if requests is None or not PUBLIC_WEATHER_API_KEY:
+        weather_data["error_message"] = "Провайдер погоды на сервере не настроен."
+        return weather_data
+
+    params = {"key": PUBLIC_WEATHER_API_KEY, "q": city, "lang": "ru", "alerts": "no"}
+    if date_offset == 0:
+        params["aqi"] = "yes"; params["days"] = 1
+    else:
+        params["aqi"] = "no"; params["dt"] = requested_date_str
+    try:
+        response = requests.get(PUBLIC_WEATHER_API_FORECAST_URL, params=params, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+    except Exception as e_api:
+        print(f"[Weather] Ошибка WeatherAPI для '{city}', дата {requested_date_str}: {e_api}")
+        weather_data["error_message"] = f"Ошибка провайдера погоды: {str(e_api)[:50]}"
+        return weather_data
+
+    if data.get("location"):
+        weather_data["city_resolved"] = data["location"].get("name", city)
+    forecast_days = data.get("forecast", {}).get("forecastday") or []
+    if forecast_days:
+        day = forecast_days[0]["day"]
+        weather_data.update({
+            "min_t": day.get("mintemp_c"), "max_t": day.get("maxtemp_c"), "temp_c": day.get("avgtemp_c"),
+            "condition_text": day.get("condition", {}).get("text", weather_data["condition_text"]),
+            "wind_kph": day.get("maxwind_kph"), "humidity": day.get("avghumidity"),
+            "precip_mm": day.get("totalprecip_mm"),
+        })
+    if date_offset == 0 and data.get("current"):
+        current = data["current"]
+        weather_data.update({
+            "temp_c": current.get("temp_c"), "wind_kph": current.get("wind_kph"),
+            "humidity": current.get("humidity"), "precip_mm": current.get("precip_mm"),
+            "is_day": current.get("is_day", 1),
+            "condition_text": current.get("condition", {}).get("text", weather_data["condition_text"]),
+        })
+        epa_index = current.get("air_quality", {}).get("us-epa-index")
+        if epa_index is not None:
+            epa_map = {1: "хорошее", 2: "умеренное", 3: "нездоровое для чувствительных групп", 4: "нездоровое", 5: "очень нездоровое", 6: "опасное"}
+            weather_data.update({"aqi_value": epa_index, "aqi_source": "WeatherAPI (сервер)",
+                                 "aqi_text": epa_map.get(epa_index, f"EPA индекс {epa_index}")})
+    if weather_data["temp_c"] is None and not forecast_days:
+        weather_data["error_message"] = "Отсутствуют данные о погоде в ответе WeatherAPI."
+    return weather_data
+
+
+def static_provider(city: str, date_offset: int) -> dict:
+    """Локальная заглушка без сети - для тестов и нагрузочных прогонов."""
+    return {
+        "city_resolved": city, "requested_date": (datetime.now() + timedelta(days=date_offset)).strftime('%Y-%m-%d'),
+        "temp_c": 20.0, "condition_text": "ясно (тестовые данные)", "wind_kph": 5.0, "humidity": 50,
+        "is_day": 1, "precip_mm": 0.0, "aqi_value": 1, "aqi_text": "хорошее", "aqi_source": "заглушка",
+        "min_t": 15.0, "max_t": 24.0, "error_message": None,
+    }
+
+
+def weather_alert_text(weather_data: dict) -> str | None:
+    """Текст предупреждения об опасной погоде или None, если все в пределах порогов."""
+    alerts = []
+    temp_c = weather_data.get("max_t") if weather_data.get("max_t") is not None else weather_data.get("temp_c")
+    if temp_c is not None and temp_c >= ALERT_MAX_TEMP_C:
+        alerts.append(f"жара до {temp_c:g}°C")
+    temp_c = weather_data.get("min_t") if weather_data.get("min_t") is not None else weather_data.get("temp_c")
+    if temp_c is not None and temp_c <= ALERT_MIN_TEMP_C:
+        alerts.append(f"мороз до {temp_c:g}°C")
+    if (weather_data.get("wind_kph") or 0) >= ALERT_WIND_KPH:
+        alerts.append(f"ветер {weather_data['wind_kph']:g} км/ч")
+    if (weather_data.get("precip_mm") or 0) >= ALERT_PRECIP_MM:
+        alerts.append(f"осадки {weather_data['precip_mm']:g} мм")
+    if (weather_data.get("aqi_value") or 0) >= ALERT_AQI_VALUE:
+        alerts.append(f"качество воздуха: {weather_data.get('aqi_text')}")
+    if not alerts:
+        return None
+    return f"Погодное предупреждение для {weather_data.get('city_resolved')} на {weather_data.get('requested_date')}: " + ", ".join(alerts) + "."
+
+
+WEATHER_PROVIDERS: dict[str, WeatherProvider] = {
+    "weatherapi": weatherapi_provider,
+    "static": static_provider,
+}
+
+weather_provider: WeatherProvider = weatherapi_provider
+weather_cache = CoalescingTTLCache(WEATHER_CACHE_TTL_SECONDS, WEATHER_ERROR_TTL_SECONDS, WEATHER_CACHE_MAX_ENTRIES)
+
+
+def set_weather_provider(provider: WeatherProvider | str):
+    """Подменяет провайдера (имя из WEATHER_PROVIDERS или любой callable). Кэш сбрасывается."""
+    global weather_provider, weather_cache
+    weather_provider = WEATHER_PROVIDERS[provider] if isinstance(provider, str) else provider
+    weather_cache = CoalescingTTLCache(WEATHER_CACHE_TTL_SECONDS, WEATHER_ERROR_TTL_SECONDS, WEATHER_CACHE_MAX_ENTRIES)
+
+
+def get_weather(city: str, date_offset: int) -> dict:
+    """Погода из кэша; ключ - (нормализованный город, запрошенная дата)."""
+    requested_date_str = (datetime.now() + timedelta(days=date_offset)).strftime('%Y-%m-%d')
+    cache_key = (city.strip().lower(), requested_date_str)
+    provider = weather_provider
+    return weather_cache.get_or_fetch(cache_key, lambda: provider(city, date_offset))
@@ -0,0 +1,148 @@
+# server/worker_pool.py
+# Многопроцессный режим сервера (--workers N): N процессов слушают одни и те же
+# TCP/UDP/WS порты через SO_REUSEPORT, ядро распределяет между ними соединения.
+#
+# Общий вид сессий: главный процесс держит авторитетное хранилище (SessionHub),
+# воркеры обращаются к нему по локальному IPC (multiprocessing.connection).
+# У каждого воркера есть локальный кэш сессий (SharedSessionStore):
+#   - создание сессии и промах кэша - синхронный запрос к хабу (цикл событий воркера
+#     вызывает хранилище из пула потоков - SESSION_CALLS_BLOCK в all_in_one_server.py);
+#   - продление уже известной сессии - только локально, хабу уходит пачкой раз в секунду.
+import os
+import socket
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+from server.session_store import SessionStore
+
+HUB_TOUCH_FLUSH_INTERVAL_SECONDS = 1.0
+
+
+def reuse_port_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+class SessionHub:
+    """Авторитетное хранилище сессий в главном процессе и IPC сервер для воркеров."""
+
+    def __init__(self, store: SessionStore):
+        self.store = store
+        self.authkey = os.urandom(16)
+        self._listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+        self.address = self._listener.address
+
+    def start(self):
+        """Запускать после fork воркеров: в дочерние процессы не должны попасть потоки хаба."""
+        threading.Thread(target=self._accept_loop, daemon=True, name="session-hub").start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception as e_accept:
+                print(f"[Session Hub] Ошибка при подключении воркера: {e_accept}")
+                continue
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def _serve_worker(self, conn):
+        store = self.store
+        try:
+            while True:
+                op, args = conn.recv()
+                if op == "create":
+                    session_id, user_name = args
+                    result = store.create(user_name, None, session_id)
+                elif op == "touch":
+                    result = store.touch(*args)
+                elif op == "touch_batch":
+                    for session_id, user_name in args:
+                        store.touch(session_id, user_name)
+                    result = None
+                elif op == "get":
+                    result = store.get(args)
+                elif op == "remove":
+                    result = store.remove(args)
+                elif op == "stats":
+                    result = store.stats()
+                else:
+                    result = None
+                if op != "touch_batch": # Пачки продлений отправляются без ожидания ответа
+                    conn.send(result)
+        except (EOFError, OSError):
+            pass # Воркер завершился
+
+
+class SharedSessionStore:
+    """Хранилище сессий воркера: тот же интерфейс, что у SessionStore,
+    локальный кэш + авторитетные данные в SessionHub главного процесса."""
+
+    def __init__(self, hub_address, authkey: bytes, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        self.local = SessionStore(timeout_seconds)
+        self.journal = None # Журнал ведет главный процесс
+        self._conn = Client(hub_address, authkey=authkey)
+        self._conn_lock = threading.Lock()
+        self._pending_touches: dict[str, str | None] = {}
+        self._pending_lock = threading.Lock()
+        threading.Thread(target=self._flush_loop, daemon=True, name="session-hub-flush").start()
+
+    def _call(self, op: str, args=None):
+        with self._conn_lock:
+            self._conn.send((op, args))
+            return self._conn.recv()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(HUB_TOUCH_FLUSH_INTERVAL_SECONDS)
+            with self._pending_lock:
+                pending, self._pending_touches = self._pending_touches, {}
+            if pending:
+                try:
+                    with self._conn_lock:
+                        self._conn.send(("touch_batch", list(pending.items())))
+                except OSError as e_send:
+                    print(f"[Worker Sessions] Не удалось отправить продления сессий хабу: {e_send}")
+
+    def create(self, user_name: str, addr=None, session_id: str | None = None) -> str:
+        session_id = self.local.create(user_name, addr, session_id)
+        self._call("create", (session_id, user_name))
+        return session_id
+
+    def touch(self, session_id: str | None, user_name: str | None = None) -> dict | None:
+        if not session_id:
+            return None
+        session = self.local.touch(session_id, user_name)
+        if session is not None:
+            with self._pending_lock:
+                # Имя, переданное ранее в этой пачке, не затираем продлением без имени
+                if user_name is not None or session_id not in self._pending_touches:
+                    self._pending_touches[session_id] = user_name
+            return session
+        session = self._call("touch", (session_id, user_name)) # Сессия создана другим воркером (или истекла)
+        if session is not None:
+            self.local.restore_session(session_id, session["user_name"], session["last_seen"], session["tcp_connection_time"])
+        return session
+
+    def get(self, session_id: str | None) -> dict | None:
+        if not session_id:
+            return None
+        return self.local.get(session_id) or self._call("get", session_id)
+
+    def remove(self, session_id: str) -> bool:
+        removed_locally = self.local.remove(session_id)
+        return self._call("remove", session_id) or removed_locally
+
+    def __contains__(self, session_id) -> bool:
+        return self.get(session_id) is not None
+
+    def __len__(self) -> int:
+        return self.stats()["live"]
+
+    def expire_due(self, now: float | None = None) -> list[str]:
+        return self.local.expire_due(now) # Авторитетное хранилище чистит главный процесс
+
+    def stats(self) -> dict:
+        hub_stats = self._call("stats")
+        hub_stats["worker_cached"] = len(self.local)
+        return hub_stats
@@ -0,0 +1,49 @@
+# server/ws_outbox.py
+# Ограниченная очередь отправки одного WebSocket клиента со слиянием (conflation) обновлений.
+#
+# Очередь появляется только у отстающего клиента: пока буфер отправки соединения почти пуст,
+# рассылка пишет в сокет напрямую. В очереди:
+#   - сливаемые сообщения (data_update) - по ключу (тема, регион) остается только последнее значение;
+#   - остальные (day_event, пакеты событий) - все, но не больше max_kept; переполнение означает,
+#     что клиент безнадежно отстал, и его отключают.
+# Поэтому память на медленного клиента ограничена: (число ключей слияния + max_kept) ссылок
+# на уже закодированные кадры (кадр кодируется один раз на всю рассылку).
+import itertools
+from collections import OrderedDict
+
+OUTBOX_QUEUED = "queued"
+OUTBOX_CONFLATED = "conflated" # Заменено более старое сообщение с тем же ключом
+OUTBOX_OVERFLOW = "overflow"
+
+
+class ClientOutbox:
+    """Вызывается только из цикла событий WebSocket сервера, замки не нужны."""
+    __slots__ = ("max_kept", "pending", "kept", "writer")
+    _kept_keys = itertools.count()
+
+    def __init__(self, max_kept: int):
+        self.max_kept = max_kept
+        self.pending: OrderedDict = OrderedDict() # ключ -> кадр, в порядке отправки
+        self.kept = 0 # Несливаемых кадров в очереди
+        self.writer = None # asyncio.Task, разбирающая очередь
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def put(self, message, conflate_key=None) -> str:
+        if conflate_key is None:
+            if self.kept >= self.max_kept:
+                return OUTBOX_OVERFLOW
+            self.kept += 1
+            self.pending[("kept", next(self._kept_keys))] = message
+            return OUTBOX_QUEUED
+        key = ("conflate", conflate_key)
+        conflated = self.pending.pop(key, None) is not None
+        self.pending[key] = message # Новое значение - в конец: порядок отправки не нарушает порядок seq
+        return OUTBOX_CONFLATED if conflated else OUTBOX_QUEUED
+
+    def pop(self):
+        key, message = self.pending.popitem(last=False)
+        if key[0] == "kept":
+            self.kept -= 1
+        return message
@@ -0,0 +1,120 @@
+# server/ws_subscriptions.py
+# Подписки WebSocket клиентов на типы событий и регионы.
+#
+# Индекс: (тип события, регион) -> множество клиентов; регион None в ключе - "все регионы".
+# Получатели события (тип, регион) - объединение подписчиков (тип, регион) и (тип, None),
+# поэтому рассылка не перебирает всех подключенных клиентов.
+# Клиенты, ни разу не приславшие subscribe/unsubscribe (старые клиенты), получают все события.
+#
+# Сообщения клиента:
+#   {"action": "subscribe", "topics": [...], "regions": [...]}   - добавить пары тип x регион;
+#   {"action": "unsubscribe", "topics": [...], "regions": [...]} - убрать подходящие пары.
+# Не указанный список - все типы (все регионы). Первый subscribe начинает с пустого набора,
+# первый unsubscribe - с "все типы во всех регионах".
+
+ALL_REGIONS_LABEL = "*" # Регион None в ответах клиенту
+
+
+class SubscriptionError(ValueError):
+    """Неизвестный тип события или регион в запросе подписки."""
+
+
+class SubscriptionIndex:
+    """Вызывается только из цикла событий WebSocket сервера, замки не нужны."""
+
+    def __init__(self, topics: tuple, regions: tuple):
+        self.topics = tuple(topics)
+        self.regions = tuple(regions)
+        self._subscribers: dict[tuple, set] = {} # (тип, регион | None) -> клиенты
+        self._client_keys: dict = {} # клиент -> множество своих ключей индекса
+        self._all_events: set = set() # Клиенты без явной подписки
+
+    def add_client(self, client):
+        self._all_events.add(client)
+
+    def remove_client(self, client):
+        self._all_events.discard(client)
+        for key in self._client_keys.pop(client, ()):
+            self._discard(key, client)
+
+    def _discard(self, key: tuple, client):
+        subscribers = self._subscribers.get(key)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del self._subscribers[key]
+
+    def _keys(self, topics, regions) -> tuple[list[str], list[str | None]]:
+        """Проверяет и нормализует списки из сообщения клиента."""
+        if topics is None:
+            topics = list(self.topics)
+        if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+            raise SubscriptionError("topics должен быть списком строк")
+        unknown_topics = [topic for topic in topics if topic not in self.topics]
+        if unknown_topics:
+            raise SubscriptionError(f"Неизвестные типы событий: {unknown_topics}. Доступны: {list(self.topics)}")
+        if regions is None:
+            return topics, [None]
+        if not isinstance(regions, list) or not all(isinstance(region, str) for region in regions):
+            raise SubscriptionError("regions должен быть списком строк")
+        regions = [region.strip().lower() for region in regions]
+        unknown_regions = [region for region in regions if region not in self.regions]
+        if unknown_regions:
+            raise SubscriptionError(f"Неизвестные регионы: {unknown_regions}. Доступны: {list(self.regions)}")
+        return topics, regions
+
+    def _explicit_keys(self, client, start_with_all: bool) -> set:
+        keys = self._client_keys.get(client)
+        if keys is None:
+            self._all_events.discard(client)
+            keys = self._client_keys[client] = set()
+            if start_with_all:
+                for topic in self.topics:
+                    keys.add((topic, None))
+                    self._subscribers.setdefault((topic, None), set()).add(client)
+        return keys
+
+    def subscribe(self, client, topics: list | None = None, regions: list | None = None) -> dict:
+        topics, regions = self._keys(topics, regions)
+        keys = self._explicit_keys(client, start_with_all=False)
+        for topic in topics:
+            for region in regions:
+                keys.add((topic, region))
+                self._subscribers.setdefault((topic, region), set()).add(client)
+        return self.subscription(client)
+
+    def unsubscribe(self, client, topics: list | None = None, regions: list | None = None) -> dict:
+        any_region = regions is None
+        topics, regions = self._keys(topics, regions)
+        keys = self._explicit_keys(client, start_with_all=True)
+        for key in [key for key in keys if key[0] in topics and (any_region or key[1] in regions)]:
+            keys.discard(key)
+            self._discard(key, client)
+        return self.subscription(client)
+
+    def subscription(self, client) -> dict:
+        """Тип события -> регионы ("*" - все); для клиента без явной подписки - все типы."""
+        keys = self._client_keys.get(client)
+        if keys is None:
+            return {topic: [ALL_REGIONS_LABEL] for topic in self.topics}
+        subscription: dict[str, list[str]] = {}
+        for topic, region in sorted(keys, key=lambda key: (key[0], key[1] or "")):
+            subscription.setdefault(topic, []).append(region or ALL_REGIONS_LABEL)
+        return subscription
+
+    def is_subscribed(self, client, topic: str, region: str | None = None) -> bool:
+        keys = self._client_keys.get(client)
+        if keys is None:
+            return True
+        return (topic, None) in keys or (region is not None and (topic, region) in keys)
+
+    def recipients(self, topic: str, region: str | None = None) -> set:
+        recipients = set(self._all_events)
+        recipients.update(self._subscribers.get((topic, None), ()))
+        if region is not None:
+            recipients.update(self._subscribers.get((topic, region), ()))
+        return recipients
+
+    def stats(self) -> dict:
+        return {"all_events_clients": len(self._all_events), "subscribed_clients": len(self._client_keys),
+                "index_keys": len(self._subscribers)}
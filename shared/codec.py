@@ -0,0 +1,242 @@
+# shared/codec.py
+# Кодеки сообщений: JSON (по умолчанию, понимают все клиенты) и компактный двоичный
+# формат MessagePack. Двоичный формат используется, только если обе стороны договорились:
+#   TCP (фреймы) - клиент присылает "accept_codecs": [...], сервер отвечает "codec": выбранный;
+#                  дальше клиент шлет фреймы в этом кодеке, сервер отвечает тем же кодеком, что и запрос;
+#   WebSocket    - "accept_codecs" в сообщении ws_identify, рассылки такому клиенту идут бинарными кадрами;
+#   UDP          - геолокация фиксированной struct-структурой (LOCATION_MAGIC), если сервер
+#                  подтвердил двоичный кодек по TCP; ответ - в MessagePack.
+# decode() определяет кодек по первому байту: JSON объект начинается с "{", MessagePack map - с 0x80..0x8f/0xde/0xdf.
+import json
+import struct
+from typing import Any
+
+try:
+    import msgpack # Необязательно: C-реализация быстрее встроенной
+except ImportError:
+    msgpack = None
+
+CODEC_JSON = "json"
+CODEC_MSGPACK = "msgpack"
+SUPPORTED_CODECS = (CODEC_MSGPACK, CODEC_JSON) # В порядке предпочтения
+
+_JSON_FIRST_BYTES = frozenset(b"{[ \t\r\n")
+
+
+class CodecError(ValueError):
+    """Данные не удалось разобрать ни одним кодеком."""
+
+
+def choose_codec(offered) -> str:
+    """Первый из SUPPORTED_CODECS, который предложил собеседник; иначе JSON."""
+    if isinstance(offered, (list, tuple)):
+        for codec in SUPPORTED_CODECS:
+            if codec in offered:
+                return codec
+    return CODEC_JSON
+
+
+def detect_codec(data: bytes) -> str:
+    return CODEC_JSON if not data or data[0] in _JSON_FIRST_BYTES else CODEC_MSGPACK
+
+
+def encode(payload: Any, codec: str = CODEC_JSON) -> bytes:
+    if codec == CODEC_MSGPACK:
+        return pack(payload)
+    return json.dumps(payload).encode('utf-8')
+
+
+def decode(data: bytes | str) -> Any:
+    if isinstance(data, str):
+        return json.loads(data)
+    if detect_codec(data) == CODEC_JSON:
+        return json.loads(data.decode('utf-8'))
+    return unpack(data)
+
+
+# ========================
+# MessagePack (подмножество: None, bool, int, float, str, bytes, list/tuple, dict)
+# ========================
+_UINT8, _UINT16, _UINT32, _UINT64 = (struct.Struct(f) for f in ("!B", "!H", "!I", "!Q"))
+_INT8, _INT16, _INT32, _INT64 = (struct.Struct(f) for f in ("!b", "!h", "!i", "!q"))
+_FLOAT32, _FLOAT64 = struct.Struct("!f"), struct.Struct("!d")
+
+
+def pack(payload: Any) -> bytes:
+    if msgpack is not None:
+        return msgpack.packb(payload, use_bin_type=True)
+    out = bytearray()
+    _pack_into(payload, out)
+    return bytes(out)
+
+
+def _pack_length(out: bytearray, length: int, fix_base: int | None, fix_limit: int, codes: tuple[int, int, int]):
+    if fix_base is not None and length < fix_limit:
+        out.append(fix_base | length)
+    elif codes[0] and length <= 0xff:
+        out.append(codes[0]); out += _UINT8.pack(length)
+    elif length <= 0xffff:
+        out.append(codes[1]); out += _UINT16.pack(length)
+    else:
+        out.append(codes[2]); out += _UINT32.pack(length)
+
+
+def _pack_into(obj: Any, out: bytearray):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj >= 0:
+            for code, fmt in ((0xcc, _UINT8), (0xcd, _UINT16), (0xce, _UINT32), (0xcf, _UINT64)):
+                if obj < 1 << (fmt.size * 8):
+                    out.append(code); out += fmt.pack(obj)
+                    return
+            raise TypeError(f"Целое {obj} не помещается в MessagePack")
+        else:
+            for code, fmt in ((0xd0, _INT8), (0xd1, _INT16), (0xd2, _INT32), (0xd3, _INT64)):
+                if obj >= -(1 << (fmt.size * 8 - 1)):
+                    out.append(code); out += fmt.pack(obj)
+                    return
+            raise TypeError(f"Целое {obj} не помещается в MessagePack")
+    elif isinstance(obj, float):
+        out.append(0xcb); out += _FLOAT64.pack(obj)
+    elif isinstance(obj, str):
+        encoded = obj.encode('utf-8')
+        _pack_length(out, len(encoded), 0xa0, 32, (0xd9, 0xda, 0xdb))
+        out += encoded
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _pack_length(out, len(obj), None, 0, (0xc4, 0xc5, 0xc6))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(out, len(obj), 0x90, 16, (0, 0xdc, 0xdd))
+        for item in obj:
+            _pack_into(item, out)
+    elif isinstance(obj, dict):
+        _pack_length(out, len(obj), 0x80, 16, (0, 0xde, 0xdf))
+        for key, value in obj.items():
+            _pack_into(key, out)
+            _pack_into(value, out)
+    else:
+        raise TypeError(f"Объект типа {type(obj).__name__} не сериализуется в MessagePack")
+
+
+def unpack(data: bytes) -> Any:
+    if msgpack is not None:
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e_unpack:
+            raise CodecError(f"Неверные данные MessagePack: {e_unpack}") from None
+    try:
+        obj, pos = _unpack_from(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, RecursionError) as e_unpack:
+        raise CodecError(f"Неверные данные MessagePack: {e_unpack}") from None
+    if pos != len(data):
+        raise CodecError(f"Лишние данные после MessagePack объекта: {len(data) - pos} байт")
+    return obj
+
+
+def _unpack_from(data: bytes, pos: int) -> tuple[Any, int]:
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if 0xa0 <= code <= 0xbf:
+        return _read_str(data, pos, code & 0x1f)
+    if 0x90 <= code <= 0x9f:
+        return _read_array(data, pos, code & 0x0f)
+    if 0x80 <= code <= 0x8f:
+        return _read_map(data, pos, code & 0x0f)
+    if code == 0xc0:
+        return None, pos
+    if code == 0xc2:
+        return False, pos
+    if code == 0xc3:
+        return True, pos
+    fixed = _FIXED_WIDTH.get(code)
+    if fixed is not None:
+        return fixed.unpack_from(data, pos)[0], pos + fixed.size
+    sized = _SIZED.get(code)
+    if sized is None:
+        raise CodecError(f"Неподдерживаемый код MessagePack: 0x{code:02x}")
+    length_fmt, reader = sized
+    (length,) = length_fmt.unpack_from(data, pos)
+    return reader(data, pos + length_fmt.size, length)
+
+
+def _read_str(data: bytes, pos: int, length: int) -> tuple[str, int]:
+    end = pos + length
+    if end > len(data):
+        raise CodecError("Строка MessagePack обрезана")
+    return data[pos:end].decode('utf-8'), end
+
+def _read_bin(data: bytes, pos: int, length: int) -> tuple[bytes, int]:
+    end = pos + length
+    if end > len(data):
+        raise CodecError("Бинарные данные MessagePack обрезаны")
+    return bytes(data[pos:end]), end
+
+def _read_array(data: bytes, pos: int, length: int) -> tuple[list, int]:
+    items = []
+    for _ in range(length):
+        item, pos = _unpack_from(data, pos)
+        items.append(item)
+    return items, pos
+
+def _read_map(data: bytes, pos: int, length: int) -> tuple[dict, int]:
+    result = {}
+    for _ in range(length):
+        key, pos = _unpack_from(data, pos)
+        if not isinstance(key, (str, int, bytes)): # Массив или словарь ключом не хешируется; msgpack дал бы TypeError
+            raise CodecError(f"Недопустимый тип ключа MessagePack: {type(key).__name__}")
+        value, pos = _unpack_from(data, pos)
+        result[key] = value
+    return result, pos
+
+
+_FIXED_WIDTH = {
+    0xcc: _UINT8, 0xcd: _UINT16, 0xce: _UINT32, 0xcf: _UINT64,
+    0xd0: _INT8, 0xd1: _INT16, 0xd2: _INT32, 0xd3: _INT64,
+    0xca: _FLOAT32, 0xcb: _FLOAT64,
+}
+_SIZED = {
+    0xd9: (_UINT8, _read_str), 0xda: (_UINT16, _read_str), 0xdb: (_UINT32, _read_str),
+    0xc4: (_UINT8, _read_bin), 0xc5: (_UINT16, _read_bin), 0xc6: (_UINT32, _read_bin),
+    0xdc: (_UINT16, _read_array), 0xdd: (_UINT32, _read_array),
+    0xde: (_UINT16, _read_map), 0xdf: (_UINT32, _read_map),
+}
+
+
+# ========================
+# UDP геолокация: фиксированная структура вместо JSON (самое частое сообщение)
+# ========================
+LOCATION_MAGIC = b"PR7L"
+LOCATION_STRUCT = struct.Struct("!4sdd") # MAGIC, широта, долгота; далее session_id в UTF-8 (может отсутствовать)
+
+
+def encode_location(latitude: float, longitude: float, session_id: str | None = None) -> bytes:
+    return LOCATION_STRUCT.pack(LOCATION_MAGIC, latitude, longitude) + (session_id or "").encode('utf-8')
+
+
+def is_packed_location(data: bytes) -> bool:
+    return data[:len(LOCATION_MAGIC)] == LOCATION_MAGIC
+
+
+def decode_location(data: bytes) -> dict:
+    """Возвращает тот же словарь, что присылают JSON-клиенты (action "location_update")."""
+    if len(data) < LOCATION_STRUCT.size:
+        raise CodecError(f"Пакет геолокации короче {LOCATION_STRUCT.size} байт")
+    _, latitude, longitude = LOCATION_STRUCT.unpack_from(data)
+    location = {"latitude": latitude, "longitude": longitude, "action": "location_update"}
+    session_id = data[LOCATION_STRUCT.size:].decode('utf-8')
+    if session_id:
+        location["session_id"] = session_id
+    return location
@@ -0,0 +1,185 @@
+# shared/tcp_framing.py
+# Фреймированный TCP протокол (версия 2) для постоянных соединений с конвейеризацией запросов.
+#
+# Формат соединения:
+#   клиент сразу после connect() отправляет FRAMED_PROTOCOL_MAGIC (4 байта),
+#   далее обе стороны обмениваются фреймами: [длина тела, 4 байта big-endian][тело: JSON в UTF-8 или MessagePack].
+# Каждый запрос содержит "request_id", сервер возвращает его в ответе.
+# Ответы могут приходить в любом порядке - клиент сопоставляет их по request_id.
+# Клиенты без MAGIC обслуживаются сервером по старому протоколу "один JSON - один ответ".
+#
+# Кодек тела (см. shared/codec.py): клиент пишет в JSON и добавляет "accept_codecs", пока сервер
+# не ответит "codec"; дальше фреймы идут в согласованном кодеке. Сервер отвечает кодеком запроса.
+import socket
+import struct
+import threading
+import itertools
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from shared.codec import CODEC_JSON, SUPPORTED_CODECS, decode as decode_message, encode as encode_message
+
+FRAMED_PROTOCOL_MAGIC = b"PR7F"
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1024 * 1024 # 1 МБ на фрейм, больше - ошибка протокола
+
+
+class FrameProtocolError(Exception):
+    """Нарушение формата фреймов (слишком большой фрейм, неверный заголовок)."""
+
+
+def encode_frame(payload: dict, codec: str = CODEC_JSON) -> bytes:
+    body = encode_message(payload, codec)
+    if len(body) > MAX_FRAME_SIZE:
+        raise FrameProtocolError(f"Фрейм слишком большой: {len(body)} байт")
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class FrameDecoder:
+    """Накопительный декодер: feed() принимает произвольные куски байт из сокета
+    и возвращает список полностью полученных тел фреймов (bytes)."""
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            (body_len,) = FRAME_HEADER.unpack_from(self._buffer)
+            if body_len > self.max_frame_size:
+                raise FrameProtocolError(f"Заявленный размер фрейма {body_len} превышает лимит {self.max_frame_size}")
+            frame_end = FRAME_HEADER.size + body_len
+            if len(self._buffer) < frame_end:
+                break
+            frames.append(bytes(self._buffer[FRAME_HEADER.size:frame_end]))
+            del self._buffer[:frame_end]
+        return frames
+
+
+class FramedTcpClient:
+    """Постоянное TCP соединение по фреймированному протоколу.
+    Потокобезопасен: несколько потоков могут вызывать request() одновременно,
+    запросы уходят в одно соединение, ответы разбираются фоновым потоком по request_id."""
+
+    def __init__(self, ip: str, port: int, connect_timeout: float = 10, codecs: tuple = SUPPORTED_CODECS):
+        self.ip = ip
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.codecs = codecs # Предлагаемые серверу кодеки; (CODEC_JSON,) - только JSON
+        self.codec = CODEC_JSON # Согласованный кодек текущего соединения
+        self._codec_negotiated = False
+        self._sock: socket.socket | None = None
+        self._connect_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending: dict[int, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def _ensure_connected(self) -> socket.socket:
+        with self._connect_lock:
+            if self._sock is None:
+                sock = socket.create_connection((self.ip, self.port), timeout=self.connect_timeout)
+                sock.settimeout(None) # Дальше читает фоновый поток, таймауты - на уровне request()
+                sock.sendall(FRAMED_PROTOCOL_MAGIC)
+                self._sock = sock
+                threading.Thread(target=self._reader_loop, args=(sock,), daemon=True).start()
+            return self._sock
+
+    def _reader_loop(self, sock: socket.socket):
+        decoder = FrameDecoder()
+        error: Exception = ConnectionError("Сервер закрыл соединение")
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                for body in decoder.feed(chunk):
+                    response = decode_message(body)
+                    if not self._codec_negotiated: # Первый ответ: сервер без поддержки кодеков не пришлет "codec"
+                        self.codec = response.get("codec") if response.get("codec") in self.codecs else CODEC_JSON
+                        self._codec_negotiated = True
+                    with self._pending_lock:
+                        future = self._pending.pop(response.get("request_id"), None)
+                    if future is not None and not future.done():
+                        future.set_result(response)
+        except Exception as e_reader:
+            error = e_reader
+        finally:
+            self._drop_connection(sock, error)
+
+    def _drop_connection(self, sock: socket.socket, error: Exception):
+        with self._connect_lock:
+            if self._sock is sock:
+                self._sock = None
+                self.codec = CODEC_JSON # Новое соединение может попасть на другой (старый) сервер
+                self._codec_negotiated = False
+        try: sock.close()
+        except OSError: pass
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not isinstance(error, FrameProtocolError): # Ошибку протокола отдаем как есть - по ней клиент откатывается на старый протокол
+            error = ConnectionError(f"Соединение с {self.ip}:{self.port} потеряно: {error}")
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def request(self, payload: dict, timeout: float = 10) -> dict:
+        """Отправляет запрос и ждет ответ с тем же request_id.
+        Исключения: socket.timeout / TimeoutError, ConnectionError, FrameProtocolError."""
+        sock = self._ensure_connected()
+        request_id = next(self._request_ids)
+        future: Future = Future()
+        with self._pending_lock:
+            self._pending[request_id] = future
+        try:
+            if self._codec_negotiated or self.codecs == (CODEC_JSON,):
+                frame = encode_frame({**payload, "request_id": request_id}, self.codec)
+            else:
+                frame = encode_frame({**payload, "request_id": request_id, "accept_codecs": list(self.codecs)})
+            try:
+                with self._send_lock:
+                    sock.sendall(frame)
+            except OSError as e_send:
+                self._drop_connection(sock, e_send)
+                raise
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"Нет ответа на запрос {request_id} за {timeout} с")
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+
+    def close(self):
+        with self._connect_lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try: sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            sock.close()
+
+
+# ========================
+# Пул постоянных соединений (одно соединение на сервер)
+# ========================
+_clients: dict[tuple[str, int], FramedTcpClient] = {}
+_clients_lock = threading.Lock()
+
+def get_framed_client(ip: str, port: int) -> FramedTcpClient:
+    with _clients_lock:
+        client = _clients.get((ip, port))
+        if client is None:
+            client = FramedTcpClient(ip, port)
+            _clients[(ip, port)] = client
+        return client
+
+def close_framed_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()